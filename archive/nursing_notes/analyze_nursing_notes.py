@@ -11,6 +11,8 @@ import sys
 
 sys.path.append('../..')
 from utilities import *
+from snomed_ct import snomed
+from snomed_ct.term_matcher import SnomedTermMatcher
 
 categories = [
     "Clinical Status",
@@ -20,6 +22,9 @@ categories = [
     "Behaviour",
 ]
 
+# SNOMED categories that mark a phrase as Clinical Status
+snomed_categories = ["findings", "disorders"]
+
 
 def match_regex_full_term(pattern, phrase):
     return re.search("(^| |:|-){}($| |:|-)".format(pattern), phrase, re.IGNORECASE)
@@ -80,26 +85,31 @@ def build_summary(note_for_day):
                 break
         if phrase_matched:
             continue
-        for term in terms:
-            if len(term) > len(phrase):
-                continue
-            if match_full_term(term, phrase):
+        for term_id, _, _ in term_matcher.find_matches(phrase):
+            if term_matcher.category(term_id) in snomed_categories:
                 summary["Clinical Status"].append(phrase)
-                # print("Phrase: {} | Term: {} | Category: Clinical Status (SNOMED CT)".format(phrase, term))
+                # print("Phrase: {} | Term: {} | Category: Clinical Status (SNOMED CT)".format(phrase, term_matcher.term(term_id)))
                 break
     return summary
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("--terms_file", type=str, required=True, help="Use SNOMED CT findings_and_disorders_terms.txt")
+    parser.add_argument("--terms_file", type=str, required=False, help="Use SNOMED CT findings_and_disorders_terms.txt")
+    parser.add_argument("--terms_folder", type=str, required=False, help="Use the compiled SNOMED CT index of this terms folder")
     parser.add_argument("--notes_file", type=str, required=True)
     args = parser.parse_args()
 
-    terms = []
-    with open(args.terms_file, 'r') as f:
-        for line in f:
-            terms.append(line.rstrip())
+    if args.terms_folder:
+        term_matcher = snomed.load_snomed_index(args.terms_folder)
+    elif args.terms_file:
+        terms = []
+        with open(args.terms_file, 'r') as f:
+            for line in f:
+                terms.append(line.rstrip())
+        term_matcher = SnomedTermMatcher.from_terms({"findings": terms})
+    else:
+        raise ValueError("One of --terms_file or --terms_folder is required")
 
     note_lines = []
     # Need 'utf-8-sig' to account for BOM character at the beginning (that docx->txt creates)
@@ -26,7 +26,9 @@ REGEX_MARKERS = {
         r"(I got[^\.\?\!]+(\.|\?|\!))"
     ],
     "TIME": [
-        r"((every|since|)? ?((couple)|(a few)|(several)|(one)|(two)|(three)|(four)|(five)|(six)|(seven)|(eight)|(nine)|(ten)|\d+)? ?(minutes?|hours?|days?|weeks?|months?|years?) ?(ago|after|before)?)",
+        # Atomic groups: backtracking into them can never produce a match, but without them
+        # long runs of digits backtrack catastrophically (see profile_regex_markers.py)
+        r"((?>every|since)? ?(?>couple|a few|several|one|two|three|four|five|six|seven|eight|nine|ten|\d++)? ?(?:minutes?|hours?|days?|weeks?|months?|years?) ?(?:ago|after|before)?)",
     ],
     "CC_CATEGORY": [
         r"(what brings you in today)",
@@ -76,6 +78,38 @@ REGEX_MARKERS = {
 }
 
 
+# Anchors for marker regexes that are slow to try at every position of a turn.
+# Every match of the marker must contain a match of the anchor regex starting at most
+# max_distance characters after the start of the match. The marker is then only tried
+# at positions up to max_distance before each anchor, which gives the same matches.
+# Check equivalence and timing with profile_regex_markers.py.
+REGEX_MARKER_ANCHORS = {
+    # TIME: a digit is at most 6 characters in ("every "), a unit at most 14 ("every several ")
+    "TIME": (r"\d|minute|hour|day|week|month|year", 14),
+}
+
+
+# Labels (type, category) that put a Q&A pair in a category, in priority order.
+# Q&A pairs with none of them are HPI, or PMH once PMH has been mentioned.
+CATEGORY_LABEL_TYPES = [
+    (ALLERGIES, "REGEX", "ALLERGIES_CATEGORY"),
+    (MEDICATIONS, "SNOMED_CT", "products"),
+    (FH, "REGEX", "FH_CATEGORY"),
+    (SH, "REGEX", "SH_CATEGORY"),
+    (PSH, "REGEX", "PSH_CATEGORY"),
+    (PMH, "REGEX", "PMH_CATEGORY"),
+]
+
+
+# SNOMED CT concepts whose descendants (is-a) mark a category.
+# Only used when the is-a hierarchy has been built (see snomed_ct/snomed.py).
+SNOMED_CATEGORY_ANCESTORS = {
+    ALLERGIES: [
+        609328004, # Allergic disposition (finding)
+    ],
+}
+
+
 COLOUR_MAP = {
     "SNOMED_CT": Fore.GREEN,
     "REGEX_QUESTION": Fore.RED,
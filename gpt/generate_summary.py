@@ -7,9 +7,6 @@ import os
 import numpy as np
 import argparse
 import sys
-from nltk.stem import WordNetLemmatizer
-from nltk.stem.snowball import SnowballStemmer
-from nltk.stem.porter import *
 import tensorflow as tf
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
@@ -19,60 +16,9 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # I
 from snomed_ct import snomed
 from utilities import *
 from constants import REGEX_MARKERS
+from summary_check import check_summary
 
 
-# ------------- Checking summary -------------
-def clean_word(word):
-    word = word.lower()
-    # word = lemmatizer.lemmatize(word)
-    word = stemmer.stem(word)
-    return word
-
-lemmatizer = WordNetLemmatizer()
-stemmer = SnowballStemmer("english")
-allowed_words = [
-    "to", "the", "a", "it", "and", "patient", "says", "had", "in", "his",
-    "her", "he", "she", '.', 'as', ',', 'start', 'at', 'while', 'was', "began",
-    "noticing", "does", "not", "saw", "that", "patient's", "doesn't", "is",
-    "felt", "feels",
-]
-allowed_words = [clean_word(word) for word in allowed_words]
-not_allowed_words = [
-    "I", "my", "?", "!", "your", '..', "I'll",
-]
-not_allowed_words = [clean_word(word) for word in not_allowed_words]
-
-def check_summary(terms, question, answer, summary,
-                  require_snomed_terms=False):
-    """
-    Check that summary only contains words from the question and answer, or stop words,
-    and also contains all of the SNOMED terms present in the question and answer.
-    """
-    question_words = [clean_word(word) for word in split_on_spaces_and_punctuation(question)]
-    answer_words = [clean_word(word) for word in split_on_spaces_and_punctuation(answer)]
-    all_allowed_words = set(question_words + answer_words + allowed_words)
-
-    snomed_terms = []
-    for term_category, terms_list in terms.items():
-        for term in terms_list:
-            if match_full_term(term, question):
-                snomed_terms.append(term)
-            elif match_full_term(term, answer):
-                snomed_terms.append(term)
-
-    summary_words = [clean_word(word) for word in split_on_spaces_and_punctuation(summary)]
-    for summary_word in summary_words:
-        if summary_word.lower() not in all_allowed_words:
-            return False, "{} not in allowed words".format(summary_word)
-        if summary_word.lower() in not_allowed_words:
-            return False, "{} not allowed".format(summary_word)
-    if require_snomed_terms:
-        for snomed_term in snomed_terms:
-            if not match_full_term(snomed_term, summary):
-                return False, "SNOMED term '{}' missing".format(snomed_term)
-    
-    return True, "Passed"
-
 # ------------- Determine context category -------------
 
 with open('context.json', 'r') as f:
@@ -118,7 +64,7 @@ def summarize(question, answer, batch_size=10, max_batches=3):
             text = enc.decode(out[i])
             text = text.replace(u'\xa0', '') # Remove non-breaking space which, for some reason, is at the beginning of text
             summary = text.split('\n')[0]
-            summary_valid, reason = check_summary(snomed_terms, question, answer, summary)
+            summary_valid, reason = check_summary(term_matcher, question, answer, summary)
             summaries_batch.append({
                 "context_category": context_category,
                 "summary": summary,
@@ -131,13 +77,13 @@ sess = None
 context = None
 enc = None
 output = None
-snomed_terms = None
+term_matcher = None
 
 def init_model(model_name="774M", length=30, batch_size=10, terms_folder="terms", temperature=1.0,
                top_k=40, top_p=1.0, seed=None):
-    global sess, context, enc, output, snomed_terms
+    global sess, context, enc, output, term_matcher
     models_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
-    snomed_terms = snomed.load_snomed_terms(terms_folder)
+    term_matcher = snomed.load_snomed_index(terms_folder)
 
     enc = encoder.get_encoder(model_name, models_dir)
     hparams = model.default_hparams()
@@ -4,13 +4,13 @@ import pytest
 
 from generate_summary import *
 
-snomed_terms = snomed.load_snomed_terms('terms')
+term_matcher = snomed.load_snomed_index('terms')
 
 def test_check_summary_1():
     question = "AA BB?"
     answer = "AA."
     summary = "AA."
-    summary_valid, _ = check_summary(snomed_terms, question, answer, summary)
+    summary_valid, _ = check_summary(term_matcher, question, answer, summary)
     assert summary_valid == True
 
 
@@ -18,7 +18,7 @@ def test_check_summary_2():
     question = "AA BB?"
     answer = "CC."
     summary = "AA."
-    summary_valid, _ = check_summary(snomed_terms, question, answer, summary)
+    summary_valid, _ = check_summary(term_matcher, question, answer, summary)
     assert summary_valid == True
 
 
@@ -26,7 +26,7 @@ def test_check_summary_3():
     question = "AA BB?"
     answer = "CC."
     summary = "his she AA."
-    summary_valid, _ = check_summary(snomed_terms, question, answer, summary)
+    summary_valid, _ = check_summary(term_matcher, question, answer, summary)
     assert summary_valid == True
 
 
@@ -34,7 +34,7 @@ def test_check_summary_4():
     question = "AA BB?"
     answer = "CC."
     summary = "his she AAA."
-    summary_valid, _ = check_summary(snomed_terms, question, answer, summary)
+    summary_valid, _ = check_summary(term_matcher, question, answer, summary)
     assert summary_valid == False
 
 
@@ -42,7 +42,7 @@ def test_check_summary_5():
     question = "AA BB hypertension?"
     answer = "CC."
     summary = "his she AAA."
-    summary_valid, _ = check_summary(snomed_terms, question, answer, summary)
+    summary_valid, _ = check_summary(term_matcher, question, answer, summary)
     assert summary_valid == False
 
 
@@ -50,5 +50,5 @@ def test_check_summary_6():
     question = "AA BB AAA hypertension?"
     answer = "CC."
     summary = "his she AAA hypertension."
-    summary_valid, _ = check_summary(snomed_terms, question, answer, summary)
+    summary_valid, _ = check_summary(term_matcher, question, answer, summary)
     assert summary_valid == True
@@ -0,0 +1,182 @@
+"""
+Profiles the REGEX_MARKERS regexes over a corpus of transcripts.
+
+Reports the time and number of matches of every marker regex, checks that the
+rewritten (fast) marker regexes give the same matches as the originals, and can
+compare against a saved baseline so a new or changed marker can't silently make
+labelling much slower.
+
+Example:
+    python profile_regex_markers.py --transcripts transcripts/*.json --save_baseline regex_baseline.json
+    python profile_regex_markers.py --transcripts transcripts/*.json --baseline regex_baseline.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from utilities import *
+
+
+# Original versions of marker regexes that were rewritten for speed.
+# check_equivalence compares them to REGEX_MARKERS on a corpus.
+REFERENCE_REGEX_MARKERS = {
+    "TIME": [
+        r"((every|since|)? ?((couple)|(a few)|(several)|(one)|(two)|(three)|(four)|(five)|(six)|(seven)|(eight)|(nine)|(ten)|\d+)? ?(minutes?|hours?|days?|weeks?|months?|years?) ?(ago|after|before)?)",
+    ],
+}
+
+# Times are reported relative to this regex, so baselines can be compared across machines
+UNIT_REGEX = r"(the)"
+
+
+def load_corpus(transcript_files):
+    texts = []
+    for transcript_file in transcript_files:
+        with open(transcript_file, 'r') as f:
+            transcript = json.load(f)
+        for turn in transcript['transcript']:
+            texts.append(turn['text'])
+    return texts
+
+
+def time_marker_regex(marker_regex, texts, anchor=None, repeat=3):
+    """
+    Returns (best time in seconds over repeat runs, number of matches).
+    """
+    best_time = None
+    for _ in range(repeat):
+        num_matches = 0
+        start_time = time.perf_counter()
+        for text in texts:
+            num_matches += len(find_marker_regex_matches(marker_regex, text, anchor))
+        elapsed_time = time.perf_counter() - start_time
+        if best_time is None or elapsed_time < best_time:
+            best_time = elapsed_time
+    return best_time, num_matches
+
+
+def get_marker_key(marker_category, marker_regex):
+    return "{}: {}".format(marker_category, marker_regex.pattern)
+
+
+def profile_regex_markers(texts, compiled_markers=COMPILED_REGEX_MARKERS, repeat=3):
+    """
+    Time every marker regex over texts. Returns a dict with:
+        - unit_seconds: time of UNIT_REGEX over texts
+        - markers: dict of marker key -> {category, seconds, cost, matches}, where
+          cost is seconds relative to unit_seconds
+    """
+    unit_seconds, _ = time_marker_regex(re.compile(UNIT_REGEX, re.IGNORECASE), texts, repeat=repeat)
+    unit_seconds = max(unit_seconds, 1e-9)
+    markers = {}
+    for marker_category, marker_regex, anchor in compiled_markers:
+        seconds, num_matches = time_marker_regex(marker_regex, texts, anchor, repeat)
+        markers[get_marker_key(marker_category, marker_regex)] = {
+            "category": marker_category,
+            "seconds": seconds,
+            "cost": seconds / unit_seconds,
+            "matches": num_matches,
+        }
+    return {"unit_seconds": unit_seconds, "markers": markers}
+
+
+def check_equivalence(texts, compiled_markers=COMPILED_REGEX_MARKERS,
+                      reference_markers=REFERENCE_REGEX_MARKERS):
+    """
+    Check that every marker regex gives the same matches as its reference (original)
+    regex, and that anchored markers give the same matches as a plain overlapped search.
+    Returns a list of (marker key, text) for the texts where they differ.
+    """
+    mismatches = []
+    num_category_markers = {}
+    for marker_category, marker_regex, anchor in compiled_markers:
+        marker_idx = num_category_markers.get(marker_category, 0)
+        num_category_markers[marker_category] = marker_idx + 1
+        reference_regex = marker_regex
+        if marker_category in reference_markers:
+            reference_regex = re.compile(reference_markers[marker_category][marker_idx], re.IGNORECASE)
+        for text in texts:
+            matches = [(match.group(1), match.span(1))
+                       for match in find_marker_regex_matches(marker_regex, text, anchor)]
+            reference_matches = [(match.group(1), match.span(1))
+                                 for match in reference_regex.finditer(text, overlapped=True)]
+            if matches != reference_matches:
+                mismatches.append((get_marker_key(marker_category, marker_regex), text))
+    return mismatches
+
+
+def check_regression(profile, baseline, max_slowdown=10):
+    """
+    Compare a profile to a baseline profile (both from profile_regex_markers).
+    Returns a list of error messages if the total cost of all markers, or the cost
+    of any marker in the baseline, grew by more than max_slowdown times.
+    """
+    errors = []
+    total_cost = sum(marker['cost'] for marker in profile['markers'].values())
+    baseline_total_cost = sum(marker['cost'] for marker in baseline['markers'].values())
+    if total_cost > max_slowdown * baseline_total_cost:
+        errors.append("Total cost {:.1f} is more than {}x the baseline ({:.1f})".format(
+            total_cost, max_slowdown, baseline_total_cost))
+    for marker_key, marker in profile['markers'].items():
+        if marker_key not in baseline['markers']:
+            continue
+        baseline_cost = baseline['markers'][marker_key]['cost']
+        if marker['cost'] > max_slowdown * baseline_cost:
+            errors.append("{} cost {:.1f} is more than {}x the baseline ({:.1f})".format(
+                marker_key, marker['cost'], max_slowdown, baseline_cost))
+    return errors
+
+
+def print_profile(profile):
+    markers = sorted(profile['markers'].items(), key=lambda item: item[1]['seconds'], reverse=True)
+    median_cost = statistics.median(marker['cost'] for _, marker in markers)
+    print("{:>10} {:>8} {:>8} {:>8}  {}".format("Time (ms)", "Cost", "x Median", "Matches", "Marker"))
+    for marker_key, marker in markers:
+        print("{:>10.2f} {:>8.1f} {:>8.1f} {:>8}  {}".format(
+            marker['seconds'] * 1000, marker['cost'], marker['cost'] / median_cost,
+            marker['matches'], marker_key[:100]))
+    print("Total time: {:.2f} ms".format(sum(marker['seconds'] for _, marker in markers) * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transcripts", type=str, nargs='+', required=True)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save_baseline", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--max_slowdown", type=float, default=10)
+    args = parser.parse_args()
+
+    texts = load_corpus(args.transcripts)
+    print("{} turns, {} characters".format(len(texts), sum(len(text) for text in texts)))
+
+    profile = profile_regex_markers(texts, repeat=args.repeat)
+    print_profile(profile)
+
+    failed = False
+    mismatches = check_equivalence(texts)
+    for marker_key, text in mismatches:
+        print("MISMATCH {} in: {}".format(marker_key, text))
+    if len(mismatches) > 0:
+        failed = True
+    else:
+        print("Rewritten and anchored markers match the reference markers on all turns")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(profile, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        errors = check_regression(profile, baseline, args.max_slowdown)
+        for error in errors:
+            print("REGRESSION {}".format(error))
+        if len(errors) > 0:
+            failed = True
+        else:
+            print("No marker is more than {}x slower than the baseline".format(args.max_slowdown))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,40 @@
+# To run: python -m pytest profile_regex_markers_test.py
+
+import random
+import time
+import pytest
+
+from profile_regex_markers import *
+
+
+def build_fuzz_corpus(num_texts=500, seed=0):
+    pieces = ['every', 'since', ' ', '  ', 'one', 'seven', 'several', 'a few', 'couple', 'ten',
+              '1', '23', 'day', 'days', 'Hours', 's', 'ago', 'before', 'x', '.', 'today', 'year']
+    rng = random.Random(seed)
+    return [''.join(rng.choice(pieces) for _ in range(30)) for _ in range(num_texts)]
+
+
+def test_markers_match_reference_markers():
+    texts = build_fuzz_corpus() + [
+        "I've been having chest pain for about two days now.",
+        "It started every 2 hours since 10 years ago, and a few weeks before Monday.",
+    ]
+    assert check_equivalence(texts) == []
+
+
+def test_time_marker_long_digit_run():
+    marker_category, marker_regex, anchor = next(
+        marker for marker in COMPILED_REGEX_MARKERS if marker[0] == "TIME")
+    text = "1" * 3000 + " x"
+    start_time = time.perf_counter()
+    matches = find_marker_regex_matches(marker_regex, text, anchor)
+    assert time.perf_counter() - start_time < 1
+    assert matches == []
+
+
+def test_check_regression():
+    baseline = {"markers": {"A": {"cost": 1.0}, "B": {"cost": 2.0}}}
+    assert check_regression({"markers": {"A": {"cost": 5.0}, "B": {"cost": 2.0}}}, baseline) == []
+    assert len(check_regression({"markers": {"A": {"cost": 11.0}, "B": {"cost": 2.0}}}, baseline)) == 1
+    # A new marker can't make all markers together more than 10x slower
+    assert len(check_regression({"markers": {"A": {"cost": 1.0}, "B": {"cost": 2.0}, "C": {"cost": 50.0}}}, baseline)) == 1
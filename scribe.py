@@ -3,7 +3,12 @@ Parses patient-doctor conversation and generates admission note
 """
 
 import argparse
+import concurrent.futures
 import json
+import os
+import sys
+import time
+import numpy as np
 import regex as re
 
 from utilities import *
@@ -19,49 +24,110 @@ def find_first_sentence_response_to_question(next_turn, start_index=0):
 
 
 def find_qa_label_in_list_format(list_format):
-    for token in list_format:
-        for label in token['labels']:
-            if label['type'] == "QUESTION_RESPONSE":
-                return label
+    if not list_format_contains_type(list_format, "QUESTION_RESPONSE"):
+        return None
+    for label in list_format_labels(list_format):
+        if label['type'] == "QUESTION_RESPONSE":
+            return label
     return None
 
 
 def qa_is_important(question_list_format, response_list_format):
-    for token in question_list_format:
-        for label in token['labels']:
-            if not (label['type'] == "REGEX" and label['category'] == "QUESTION"):
-                return True
-    for token in response_list_format:
-        for label in token['labels']:
-            if label['type'] != "QUESTION_RESPONSE":
-                return True
+    for label in list_format_labels(question_list_format):
+        if not (label['type'] == "REGEX" and label['category'] == "QUESTION"):
+            return True
+    for label in list_format_labels(response_list_format):
+        if label['type'] != "QUESTION_RESPONSE":
+            return True
     return False
 
 
-def determine_category_of_qa(question_list_format, response_list_format, pmh_mentioned):
-    if ((list_format_contains_type(question_list_format, "REGEX", "ALLERGIES_CATEGORY")) or
-        (list_format_contains_type(response_list_format, "REGEX", "ALLERGIES_CATEGORY"))):
-        return ALLERGIES
-    if ((list_format_contains_type(question_list_format, "SNOMED_CT", "products")) or
-        (list_format_contains_type(response_list_format, "SNOMED_CT", "products"))):
-        return MEDICATIONS
-    if ((list_format_contains_type(question_list_format, "REGEX", "FH_CATEGORY")) or
-        (list_format_contains_type(response_list_format, "REGEX", "FH_CATEGORY"))):
-        return FH
-    if ((list_format_contains_type(question_list_format, "REGEX", "SH_CATEGORY")) or
-        (list_format_contains_type(response_list_format, "REGEX", "SH_CATEGORY"))):
-        return SH
-    if ((list_format_contains_type(question_list_format, "REGEX", "PSH_CATEGORY")) or
-        (list_format_contains_type(response_list_format, "REGEX", "PSH_CATEGORY"))):
-        return PSH
-    if ((list_format_contains_type(question_list_format, "REGEX", "PMH_CATEGORY")) or
-        (list_format_contains_type(response_list_format, "REGEX", "PMH_CATEGORY"))):
+def qa_contains_snomed_category(question_list_format, response_list_format, hierarchy, category):
+    """
+    Returns True if the question or response has a SNOMED concept that is a
+    descendant of one of the concepts in SNOMED_CATEGORY_ANCESTORS[category].
+    """
+    if (hierarchy is None) or (category not in SNOMED_CATEGORY_ANCESTORS):
+        return False
+    ancestor_ids = SNOMED_CATEGORY_ANCESTORS[category]
+    return (list_format_contains_descendant(question_list_format, hierarchy, ancestor_ids) or
+            list_format_contains_descendant(response_list_format, hierarchy, ancestor_ids))
+
+
+def get_qa_category_mask(question_list_format, response_list_format, hierarchy=None):
+    """
+    Returns a mask with bit i set if the question or response has a label of
+    CATEGORY_LABEL_TYPES[i] (or, with hierarchy, a SNOMED concept under that category).
+    """
+    label_registry = LabelRegistry()
+    for list_format in [question_list_format, response_list_format]:
+        if isinstance(list_format, TokenList):
+            label_registry = list_format.label_registry
+        elif isinstance(list_format, TokenSpan):
+            label_registry = list_format.token_list.label_registry
+    type_mask = (list_format_type_mask(question_list_format, label_registry) |
+                 list_format_type_mask(response_list_format, label_registry))
+    category_mask = 0
+    for bit, (category, label_type, label_category) in enumerate(CATEGORY_LABEL_TYPES):
+        if type_mask & label_registry.label_type_bits.get((label_type, label_category), 0):
+            category_mask |= 1 << bit
+        elif (hierarchy is not None) and qa_contains_snomed_category(
+                question_list_format, response_list_format, hierarchy, category):
+            category_mask |= 1 << bit
+    return category_mask
+
+
+def determine_categories_of_qas(category_masks, pmh_mentioned=False):
+    """
+    Categorize a transcript's Q&A pairs, in order, from their masks (see get_qa_category_mask).
+    A pair gets the first category in CATEGORY_LABEL_TYPES whose bit is set; pairs with
+    no bits set are PMH if PMH was mentioned before them, otherwise HPI.
+    """
+    category_masks = np.asarray(category_masks, dtype=np.int64)
+    lowest_bits = category_masks & -category_masks
+    category_idxs = np.where(category_masks > 0,
+                             np.log2(np.maximum(lowest_bits, 1)).astype(np.int64),
+                             len(CATEGORY_LABEL_TYPES))
+    categories = np.array([category for category, _, _ in CATEGORY_LABEL_TYPES] + [HPI], dtype=object)[category_idxs]
+    is_pmh = categories == PMH
+    pmh_mentioned_before = ((np.cumsum(is_pmh) - is_pmh) > 0) | pmh_mentioned
+    categories[(category_idxs == len(CATEGORY_LABEL_TYPES)) & pmh_mentioned_before] = PMH
+    return categories.tolist()
+
+
+def determine_category_of_qa(question_list_format, response_list_format, pmh_mentioned, hierarchy=None):
+    category_mask = get_qa_category_mask(question_list_format, response_list_format, hierarchy)
+    for bit, (category, _, _) in enumerate(CATEGORY_LABEL_TYPES):
+        if category_mask & (1 << bit):
+            return category
+    if pmh_mentioned:
         return PMH
     else:
-        if pmh_mentioned:
-            return PMH
-        else:
-            return HPI
+        return HPI
+
+
+def build_qa_pairs(transcript, hierarchy=None):
+    """
+    Returns the transcript's Q&A pairs in order, as dicts with the question, response,
+    their list formats and the category of the pair.
+    """
+    qa_pairs = []
+    for turn in transcript:
+        qa_label = find_qa_label_in_list_format(turn['list_format'])
+        if qa_label:
+            question_list_format = find_list_format_slice_with_label_id(transcript, qa_label['question_label_id'])
+            response_list_format = find_list_format_slice_with_label_id(transcript, qa_label['label_id'])
+            qa_pairs.append({
+                "question": qa_label['question'],
+                "response": qa_label['response'],
+                "question_list_format": question_list_format,
+                "response_list_format": response_list_format,
+                "category_mask": get_qa_category_mask(question_list_format, response_list_format, hierarchy),
+            })
+    categories = determine_categories_of_qas([qa_pair['category_mask'] for qa_pair in qa_pairs])
+    for qa_pair, category in zip(qa_pairs, categories):
+        qa_pair['category'] = category
+    return qa_pairs
 
 
 def summarize_qa(question, response):
@@ -70,63 +136,119 @@ def summarize_qa(question, response):
     return summary
 
 
+def extractive_summary(question, response):
+    """
+    Fast fallback summary: the question and the first sentence of the response.
+    """
+    response_match = find_first_sentence_response_to_question({"text": response})
+    first_sentence = response_match.group(1) if response_match else response
+    return "{} {}".format(question.strip(), first_sentence.strip())
+
+
+def wait_for_summarizer(summarizer_future, deadline=None):
+    """
+    Wait for the summarization model loading in summarizer_future (see
+    generate_summary.init_model_in_background) until the deadline (a time.perf_counter()
+    time, or None to wait until it loads). Returns the summarizer, or None if the
+    deadline passed first.
+    """
+    try:
+        return summarizer_future.result(
+            timeout=max(deadline - time.perf_counter(), 0) if deadline is not None else None)
+    except concurrent.futures.TimeoutError:
+        return None
+
+
+def summarize_qa_pairs(qa_pairs, batch_size=16, deadline=None, use_model=True, pair_seconds=None):
+    """
+    Summarize all Q&A pairs in batches. Adds a 'summary' to each pair, and 'degraded',
+    which is True if the summary is extractive (see extractive_summary).
+    deadline is a time.perf_counter() time. Batches are summarized by the model
+    while the time left covers the slowest batch so far (before the first batch,
+    pair_seconds per pair, e.g. generate_summary.pair_seconds from warming up the
+    model), and the remaining pairs get extractive summaries. Without use_model
+    (e.g. the deadline passed while the model was loading), all summaries are extractive.
+    """
+    print("Summarizing {} Q&A pairs...".format(len(qa_pairs)))
+    for qa_pair in qa_pairs:
+        qa_pair['summary'] = None
+        qa_pair['degraded'] = False
+    if use_model:
+        batches = [qa_pairs]
+        if deadline is not None:
+            batches = [qa_pairs[batch_start:batch_start + batch_size]
+                       for batch_start in range(0, len(qa_pairs), batch_size)]
+        max_batch_seconds = None
+        for batch in batches:
+            start_time = time.perf_counter()
+            batch_seconds = max_batch_seconds
+            if batch_seconds is None:
+                batch_seconds = pair_seconds * len(batch) if pair_seconds is not None else 0
+            if (deadline is not None) and (deadline - start_time <= batch_seconds):
+                break
+            summaries = generate_summary.summarize_batch(
+                [qa_pair['question'] for qa_pair in batch],
+                [qa_pair['response'] for qa_pair in batch],
+                batch_size=batch_size)
+            for qa_pair, summary in zip(batch, summaries):
+                qa_pair['summary'] = summary
+            max_batch_seconds = max(max_batch_seconds or 0, time.perf_counter() - start_time)
+    for qa_pair in qa_pairs:
+        if qa_pair['summary'] is None:
+            qa_pair['summary'] = extractive_summary(qa_pair['question'], qa_pair['response'])
+            qa_pair['degraded'] = True
+    return qa_pairs
+
+
 def add_regex_labels_to_transcript(transcript):
-    label_id = 0
+    """
+    Label the regex marker matches of every turn, and label the response to each
+    question the doctor asks. Label ids come from the list formats' LabelRegistry,
+    shared by the turns (see share_label_registry).
+    """
+    share_label_registry(transcript)
     for turn_idx, turn in enumerate(transcript):
-        for marker_category, marker_regexes_list in REGEX_MARKERS.items():
-            for marker_regex in marker_regexes_list:
-                matches = list(re.finditer(marker_regex, turn['text'], re.IGNORECASE, overlapped=True))
-                if len(matches) == 0:
-                    continue
-                for match_idx, match in enumerate(matches):
-                    match_text = match.groups()[0]
-                    # Need to manually find start/end indexes since match.span returns span of full match (including non-capturing groups)
-                    start_index = turn['text'].lower().find(match_text.lower(), match.span()[0]) 
-                    end_index = start_index + len(match_text)
-                    label = {
-                        "label_id": label_id,
-                        "type": "REGEX",
-                        "match": match_text,
-                        "category": marker_category,
+        for marker_category, matches in find_regex_markers(turn['text']):
+            for match_idx, (match_text, start_index, end_index) in enumerate(matches):
+                label = {
+                    "type": "REGEX",
+                    "match": match_text,
+                    "category": marker_category,
+                }
+                add_label_to_items(turn['list_format'], label, start_index, end_index)
+
+                # If doctor asked a question, find the response (next statement by patient)
+                if ((marker_category == "QUESTION") and 
+                    (turn['speaker'] == 'Doctor') and
+                    (match_idx == len(matches) - 1) and # Select last question if there are multiple
+                    (turn_idx < len(transcript) - 1)): # Make sure there's another turn after
+                    next_turn = transcript[turn_idx + 1]
+                    response_text = next_turn["text"]
+                    response_label = {
+                        "type": "QUESTION_RESPONSE",
+                        "question_label_id": label['label_id'],
+                        "question": match_text,
+                        "response": response_text,
+                        "category": None,
                     }
-                    label_id += 1
-                    add_label_to_items(turn['list_format'], label, start_index, end_index)
-
-                    # If doctor asked a question, find the response (next statement by patient)
-                    if ((marker_category == "QUESTION") and 
-                        (turn['speaker'] == 'Doctor') and
-                        (match_idx == len(matches) - 1) and # Select last question if there are multiple
-                        (turn_idx < len(transcript) - 1)): # Make sure there's another turn after
-                        next_turn = transcript[turn_idx + 1]
-                        response_text = next_turn["text"]
-                        response_label = {
-                            "label_id": label_id,
-                            "type": "QUESTION_RESPONSE",
-                            "question_label_id": label['label_id'],
-                            "question": match_text,
-                            "response": response_text,
-                            "category": None,
-                        }
-                        label_id += 1
-                        add_label_to_items(next_turn['list_format'], response_label, 0, len(response_text))
-
-
-def add_snomed_labels_to_transcript(transcript, snomed_terms):
-    label_id = 10000
+                    add_label_to_items(next_turn['list_format'], response_label, 0, len(response_text))
+
+
+def add_snomed_labels_to_transcript(transcript, term_matcher):
+    """
+    Label every whole-word occurrence of every SNOMED term in the transcript.
+    term_matcher is a SnomedTermMatcher built from the SNOMED terms.
+    """
+    share_label_registry(transcript)
     for turn in transcript:
-        for term_category, terms_list in snomed_terms.items():
-            for term in terms_list:
-                if match_full_term(term, turn['text']):
-                    label = {
-                        "label_id": label_id,
-                        "type": "SNOMED_CT",
-                        "term": term,
-                        "category": term_category
-                    }
-                    label_id += 1
-                    start_index = turn['text'].lower().find(term.lower())
-                    end_index = start_index + len(term)
-                    add_label_to_items(turn['list_format'], label, start_index, end_index)
+        for term_id, start_index, end_index in term_matcher.find_matches(turn['text']):
+            label = {
+                "type": "SNOMED_CT",
+                "term": term_matcher.term(term_id),
+                "concept_ids": term_matcher.concept_ids(term_id).tolist(),
+                "category": term_matcher.category(term_id)
+            }
+            add_label_to_items(turn['list_format'], label, start_index, end_index)
 
 
 if __name__ == "__main__":
@@ -135,26 +257,60 @@ if __name__ == "__main__":
     parser.add_argument("--transcript", type=str, required=True)
     parser.add_argument("--print_transcript", action='store_true', required=False)
     parser.add_argument("--model_name", default="774M", type=str, required=False)
+    parser.add_argument("--batch_size", default=16, type=int, required=False, help="Q&A pairs summarized per batch")
+    parser.add_argument("--summary_cache", default=None, type=str, required=False, help="SQLite file to cache summaries in")
+    parser.add_argument("--summary_cache_size", default=100000, type=int, required=False)
+    parser.add_argument("--deterministic", action='store_true', required=False, help="Use greedy decoding")
+    parser.add_argument("--quantize", default=None, choices=["int8"], required=False, help="Quantize the summarization model (CPU only)")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"], required=False, help="Summarization model runtime")
+    parser.add_argument("--small_model_name", default=None, type=str, required=False,
+                        help="Summarize with this t5-small checkpoint first, and only use the large model when its summary fails the check")
+    parser.add_argument("--max_small_input_words", default=48, type=int, required=False,
+                        help="Q&A pairs with more words go straight to the large model")
+    parser.add_argument("--num_candidates", default=1, type=int, required=False,
+                        help="Summaries generated per Q&A pair, the first that passes the summary check is used")
+    parser.add_argument("--deadline", default=None, type=float, required=False,
+                        help="Seconds from start the note must be ready in. Q&A pairs the model can't summarize in time get extractive summaries")
+    parser.add_argument("--no_background_load", action='store_true', required=False,
+                        help="Load the summarization model before labelling instead of during it")
     args = parser.parse_args()
     print("Arguments: {}".format(args))
+    start_time = time.perf_counter()
+    deadline = start_time + args.deadline if args.deadline is not None else None
+
+    # Load the summarization model in the background, while the transcript is labelled.
+    # With a single CPU they would only compete for it, so the model is loaded first.
+    print("Initializing summarization model...")
+    summarizer_future = generate_summary.init_model_in_background(
+        model_name=args.model_name, cache_path=args.summary_cache,
+        cache_size=args.summary_cache_size,
+        deterministic=args.deterministic,
+        quantize=args.quantize,
+        backend=args.backend,
+        small_model_name=args.small_model_name,
+        max_small_input_words=args.max_small_input_words,
+        num_candidates=args.num_candidates)
+    if args.no_background_load or (os.cpu_count() or 1) == 1:
+        wait_for_summarizer(summarizer_future, deadline)
 
+    labeling_start_time = time.perf_counter()
     print("Loading SNOMED terms...")
-    snomed_terms = snomed.load_snomed_terms(args.terms_folder)
+    term_matcher = snomed.load_snomed_index(args.terms_folder)
+    hierarchy = snomed.load_snomed_hierarchy(args.terms_folder)
 
     with open(args.transcript, 'r') as f:
         transcript = json.load(f)
 
     # Add list format info to transcript
-    new_transcript = []
-    for turn in transcript['transcript']:
-        turn['list_format'] = string_to_list_format(turn['text'])
-        new_transcript.append(turn)
-    transcript = new_transcript
+    transcript = transcript['transcript']
+    add_list_format_to_transcript(transcript)
 
     print("Finding phrases with regex...")
     add_regex_labels_to_transcript(transcript)
     print("Finding phrases with SNOMED vocabulary...")
-    add_snomed_labels_to_transcript(transcript, snomed_terms)
+    add_snomed_labels_to_transcript(transcript, term_matcher)
+    labeling_time = time.perf_counter()
+    print("Loaded SNOMED terms and labelled transcript in {:.2f} s".format(labeling_time - labeling_start_time))
 
     # Print labelled transcript
     if args.print_transcript:
@@ -166,30 +322,39 @@ if __name__ == "__main__":
 
     note = {category: [] for category in CATEGORIES}
     
-    # Init summarization model
-    print("Initializing summarization model...")
-    generate_summary.init_model(model_name=args.model_name)
+    # Wait for the summarization model
+    summarizer = wait_for_summarizer(summarizer_future, deadline)
+    if summarizer is None:
+        print("Deadline passed while loading the summarization model, using extractive summaries")
+    generate_summary.set_term_matcher(term_matcher) # Checked summaries must keep the SNOMED terms
+    print("Waited {:.2f} s for the summarization model ({:.2f} s since start)".format(
+        time.perf_counter() - labeling_time, time.perf_counter() - start_time))
 
     # Build Q&A pairs
     print("Building summary...")
-    pmh_mentioned = False
-    for turn in transcript:
-        qa_label = find_qa_label_in_list_format(turn['list_format'])
-        if qa_label:
-            question = qa_label['question']
-            response = qa_label['response']
-            question_list_format = find_list_format_slice_with_label_id(transcript, qa_label['question_label_id'])
-            response_list_format = find_list_format_slice_with_label_id(transcript, qa_label['label_id'])
-            qa_summary = summarize_qa(question, response)
-            category = determine_category_of_qa(question_list_format, response_list_format, pmh_mentioned)
-            note[category].append(qa_summary)
-            first = False
-            if category == PMH:
-                pmh_mentioned = True
-            print("Question: {}".format(question))
-            print("Response: {}".format(response))
-            print("Summary: {}".format(qa_summary))
-            print()
+    summary_start_time = time.perf_counter()
+    qa_pairs = build_qa_pairs(transcript, hierarchy)
+    summarize_qa_pairs(qa_pairs, batch_size=args.batch_size, deadline=deadline, use_model=summarizer is not None,
+                       pair_seconds=generate_summary.pair_seconds)
+    num_degraded = sum(1 for qa_pair in qa_pairs if qa_pair['degraded'])
+    print("Summarized {} Q&A pairs in {:.2f} s ({} extractive)".format(
+        len(qa_pairs), time.perf_counter() - summary_start_time, num_degraded))
+    if summarizer is not None and summarizer.cache is not None:
+        print("Summary cache: {}".format(summarizer.cache.stats()))
+    if summarizer is not None and args.small_model_name:
+        tiered_stats = summarizer.stats()
+        print("Escalated {} of {} Q&A pairs ({:.1%}) to the large model".format(
+            tiered_stats['escalated'], tiered_stats['summaries'], tiered_stats['escalated_fraction']))
+        print("Small model: {:.2f} s, large model: {:.2f} s, estimated time saved: {}".format(
+            tiered_stats['small_seconds'], tiered_stats['large_seconds'],
+            "{:.2f} s".format(tiered_stats['latency_saved_seconds'])
+            if tiered_stats['latency_saved_seconds'] is not None else "n/a (nothing escalated)"))
+    for qa_pair in qa_pairs:
+        note[qa_pair['category']].append(qa_pair['summary'] + (" *" if qa_pair['degraded'] else ""))
+        print("Question: {}".format(qa_pair['question']))
+        print("Response: {}".format(qa_pair['response']))
+        print("Summary: {}{}".format(qa_pair['summary'], " (extractive)" if qa_pair['degraded'] else ""))
+        print()
     print()
 
     # Find CC (first SNOMED disorder or findings term mentioned in transcript)
@@ -205,3 +370,13 @@ if __name__ == "__main__":
         else:
             print()
         print()
+    if num_degraded > 0:
+        print("* Extractive summary (question and first sentence of the response), "
+              "the model couldn't summarize it before the deadline")
+
+    # The model is still loading after the deadline: exit without waiting for it, or for
+    # the interpreter shutdown to stop its loading thread in the middle of torch code
+    if not summarizer_future.done():
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
@@ -3,6 +3,8 @@
 import pytest
 
 from scribe import *
+from snomed_ct.term_matcher import SnomedTermMatcher
+from snomed_ct.hierarchy import SnomedHierarchy
 from colorama import Fore
 
 
@@ -177,3 +179,256 @@ def test_slice_list_format():
     sliced_list_format = slice_list_format(list_format, 13, 16)
     assert sliced_list_format[0]['text'] == 'hi'
     assert sliced_list_format[1]['text'] == '?'
+
+
+def test_token_list_stores_each_label_once():
+    list_format = string_to_list_format("Hello world, hi? There.")
+    label = {"type": "REGEX", "category": "QUESTION"}
+    add_label_to_items(list_format, label, 6, 6 + len("world, hi"))
+    add_label_to_items(list_format, label, 100, 200) # No tokens in range
+    assert list_format.label_spans == [(label, 2, 6)]
+    assert list_format_labels(list_format) == [label]
+    assert [token['labels'] for token in list_format[1:4]] == [(), (label,), (label,)]
+    with pytest.raises(AttributeError):
+        list_format[2]['labels'].append(label) # Labels are added with add_label_to_items
+    assert list_format_to_string(slice_list_format(list_format, 13, 16)) == "hi?"
+    other_label = {"type": "REGEX", "category": "ANSWER"}
+    add_label_to_items(list_format, other_label, 0, 5)
+    assert list_format_labels(list_format) == [other_label, label]
+    assert slice_list_format(list_format, 0, 10).labels() == [other_label, label]
+    assert slice_list_format(list_format, 13, 16).labels() == [label]
+    with pytest.raises(ValueError):
+        add_label_to_items(list_format, label, -1, 5)
+
+
+def test_print_token_list():
+    colour_map = {
+        "SNOMED_CT": Fore.GREEN,
+        "REGEX": Fore.RED
+    }
+    list_format = string_to_list_format("Hello world")
+    add_label_to_items(list_format, {"type": "SNOMED_CT"}, 0, 5)
+    coloured_string = list_format_to_coloured_string(list_format, colour_map)
+    assert coloured_string == '\x1b[32mHello\x1b[0m \x1b[0mworld\x1b[0m'
+
+
+def test_snomed_term_matcher_finds_all_whole_word_occurrences():
+    terms = {
+        "disorders": ["Asthma", "Chest pain"],
+        "findings": ["pain", "Ache"],
+    }
+    term_matcher = SnomedTermMatcher.from_terms(terms)
+    text = "Chest pain, no headache. The pain is bad. Asthma"
+    matches = [(term_matcher.term(term_id), term_matcher.category(term_id), text[start:end])
+               for term_id, start, end in term_matcher.find_matches(text)]
+    assert matches == [
+        ("Asthma", "disorders", "Asthma"),
+        ("Chest pain", "disorders", "Chest pain"),
+        ("pain", "findings", "pain"),
+        ("pain", "findings", "pain"),
+    ]
+
+
+def test_snomed_term_matcher_same_as_match_full_term():
+    terms = {
+        "disorders": ["red rash", "rash", "neck, femur", "Mr.", "a"],
+    }
+    term_matcher = SnomedTermMatcher.from_terms(terms)
+    for text in ["a red rash", "redness", "rashes;rash", "neck, femur", "neck,femur", "Mr.Smith", "Mr. Smith"]:
+        found = {term_matcher.term(term_id) for term_id, _, _ in term_matcher.find_matches(text)}
+        expected = {term for term in terms["disorders"] if match_full_term(term, text)}
+        assert found == expected
+
+
+def test_add_snomed_labels_to_transcript():
+    term_matcher = SnomedTermMatcher.from_terms({"findings": ["pain"]})
+    text = "Pain here. Pain there."
+    transcript = [{"speaker": "Patient", "text": text, "list_format": string_to_list_format(text)}]
+    add_snomed_labels_to_transcript(transcript, term_matcher)
+    labelled = [token['text'] for token in transcript[0]['list_format'] if len(token['labels']) > 0]
+    assert labelled == ["Pain", "Pain"]
+    assert transcript[0]['list_format'][0]['labels'][0]['category'] == "findings"
+    assert transcript[0]['list_format'][0]['labels'][0]['concept_ids'] == []
+
+
+def test_load_snomed_index(tmp_path):
+    for term_category in snomed.TERMS_CATEGORIES:
+        (tmp_path / (term_category + '_terms.txt')).write_text("")
+    (tmp_path / 'findings_terms.txt').write_text("Chest pain\nPain\n")
+    term_matcher = snomed.load_snomed_index(str(tmp_path))
+    assert [term_matcher.term(term_id) for term_id, _, _ in term_matcher.find_matches("chest pain")] == ["Chest pain", "Pain"]
+
+    # Changing a terms file rebuilds the index
+    (tmp_path / 'disorders_terms.txt').write_text("Asthma\n")
+    term_matcher = snomed.load_snomed_index(str(tmp_path))
+    assert [term_matcher.category(term_id) for term_id, _, _ in term_matcher.find_matches("asthma")] == ["disorders"]
+
+
+def test_determine_category_of_qa_with_hierarchy():
+    allergic_disposition = SNOMED_CATEGORY_ANCESTORS[ALLERGIES][0]
+    hierarchy = SnomedHierarchy.from_edges([1, 2], [allergic_disposition, 1])
+    question_list_format = string_to_list_format("Anything else?")
+    response_list_format = string_to_list_format("Hay fever.")
+    add_label_to_items(response_list_format, {"type": "SNOMED_CT", "category": "disorders", "concept_ids": [2]}, 0, 9)
+    assert determine_category_of_qa(question_list_format, response_list_format, False) == HPI
+    assert determine_category_of_qa(question_list_format, response_list_format, False, hierarchy) == ALLERGIES
+
+
+def test_find_regex_markers():
+    markers = find_regex_markers("Any family history? I had surgeries.")
+    assert markers == [
+        ("QUESTION", [("Any family history?", 0, 19)]),
+        ("COMPLAINT", [("I had surgeries.", 20, 36)]),
+        ("PSH_CATEGORY", [("surgeries", 26, 35)]),
+        ("FH_CATEGORY", [("family", 4, 10)]),
+        ("FH_CATEGORY", [("family history", 4, 18)]),
+    ]
+
+
+def test_add_regex_labels_to_transcript():
+    transcript = [
+        {"speaker": "Doctor", "text": "Hi. Do you smoke?"},
+        {"speaker": "Patient", "text": "No."},
+    ]
+    add_list_format_to_transcript(transcript)
+    add_regex_labels_to_transcript(transcript)
+    question_label = find_list_format_slice_with_label_id(transcript, 0)
+    assert list_format_to_string(question_label) == "Do you smoke?"
+    qa_label = find_qa_label_in_list_format(transcript[1]['list_format'])
+    assert qa_label['question'] == "Do you smoke?"
+    assert qa_label['response'] == "No."
+    assert list_format_contains_type(transcript[0]['list_format'], "REGEX", "SH_CATEGORY")
+    assert list_format_contains_type(transcript[1]['list_format'], "REGEX", "NEGATION")
+
+
+def test_label_registry_gives_unique_label_ids():
+    term_matcher = SnomedTermMatcher.from_terms({"findings": ["pain"], "products": ["aspirin"]})
+    transcript = [
+        {"speaker": "Doctor", "text": "Any pain?"},
+        {"speaker": "Patient", "text": "Yes, I take aspirin for the pain."},
+    ]
+    label_registry = add_list_format_to_transcript(transcript)
+    add_regex_labels_to_transcript(transcript)
+    add_snomed_labels_to_transcript(transcript, term_matcher)
+    label_ids = [label['label_id'] for turn in transcript for label in list_format_labels(turn['list_format'])]
+    assert sorted(label_ids) == list(range(len(label_ids)))
+    assert [label['term'] for label in label_registry.labels_of_type("SNOMED_CT")] == ["pain", "pain", "aspirin"]
+    assert [label['term'] for label in label_registry.labels_of_type("SNOMED_CT", "products")] == ["aspirin"]
+
+    qa_label = find_qa_label_in_list_format(transcript[1]['list_format'])
+    question_list_format = find_list_format_slice_with_label_id(transcript, qa_label['question_label_id'])
+    response_list_format = find_list_format_slice_with_label_id(transcript, qa_label['label_id'])
+    assert list_format_to_string(question_list_format) == "Any pain?"
+    assert list_format_contains_type(response_list_format, "SNOMED_CT", "products")
+    assert not list_format_contains_type(question_list_format, "SNOMED_CT", "products")
+    assert list_format_contains_type(question_list_format, "SNOMED_CT")
+    assert determine_category_of_qa(question_list_format, response_list_format, False) == MEDICATIONS
+
+
+def test_label_transcript_built_turn_by_turn():
+    term_matcher = SnomedTermMatcher.from_terms({"findings": ["pain"], "products": ["aspirin"]})
+    transcript = [
+        {"speaker": "Doctor", "text": "Any pain?"},
+        {"speaker": "Patient", "text": "Yes, I take aspirin for the pain."},
+    ]
+    for turn in transcript:
+        turn['list_format'] = string_to_list_format(turn['text']) # Each turn with its own registry
+    add_regex_labels_to_transcript(transcript)
+    add_snomed_labels_to_transcript(transcript, term_matcher)
+    label_ids = [label['label_id'] for turn in transcript for label in list_format_labels(turn['list_format'])]
+    assert len(label_ids) == len(set(label_ids))
+    qa_label = find_qa_label_in_list_format(transcript[1]['list_format'])
+    question_list_format = find_list_format_slice_with_label_id(transcript, qa_label['question_label_id'])
+    response_list_format = find_list_format_slice_with_label_id(transcript, qa_label['label_id'])
+    assert list_format_to_string(question_list_format) == "Any pain?"
+    assert list_format_to_string(response_list_format) == transcript[1]['text']
+    assert determine_category_of_qa(question_list_format, response_list_format, False) == MEDICATIONS
+
+
+def test_find_label_id_in_turns_with_own_registries():
+    transcript = [
+        {"speaker": "Doctor", "text": "Do you smoke?"},
+        {"speaker": "Patient", "text": "No, never."},
+    ]
+    for turn in transcript:
+        turn['list_format'] = string_to_list_format(turn['text'])
+    add_label_to_items(transcript[1]['list_format'], {"type": "REGEX", "category": "ANSWER", "label_id": 5}, 0, 3)
+    assert [token['text'] for token in find_list_format_slice_with_label_id(transcript, 5)] == ["No", ","]
+
+    # Turns labelled in their own registries can't share one, as their label ids can collide
+    add_label_to_items(transcript[0]['list_format'], {"type": "REGEX", "category": "QUESTION"}, 0, 13)
+    with pytest.raises(ValueError):
+        add_regex_labels_to_transcript(transcript)
+
+
+def test_determine_categories_of_qas():
+    allergies_bit = 1 << 0
+    medications_bit = 1 << 1
+    pmh_bit = 1 << 5
+    category_masks = [0, medications_bit | pmh_bit, pmh_bit, allergies_bit | medications_bit, 0]
+    assert determine_categories_of_qas(category_masks) == [HPI, MEDICATIONS, PMH, ALLERGIES, PMH]
+    assert determine_categories_of_qas([0], pmh_mentioned=True) == [PMH]
+    assert determine_categories_of_qas([]) == []
+
+
+def test_build_qa_pairs_same_as_determine_category_of_qa():
+    term_matcher = SnomedTermMatcher.from_terms({"products": ["aspirin"]})
+    transcript = [
+        {"speaker": "Doctor", "text": "Any medical conditions?"},
+        {"speaker": "Patient", "text": "I had diabetes."},
+        {"speaker": "Doctor", "text": "Do you take aspirin?"},
+        {"speaker": "Patient", "text": "Yes."},
+        {"speaker": "Doctor", "text": "Any pain?"},
+        {"speaker": "Patient", "text": "No."},
+    ]
+    add_list_format_to_transcript(transcript)
+    add_regex_labels_to_transcript(transcript)
+    add_snomed_labels_to_transcript(transcript, term_matcher)
+    qa_pairs = build_qa_pairs(transcript)
+    pmh_mentioned = False
+    for qa_pair in qa_pairs:
+        category = determine_category_of_qa(qa_pair['question_list_format'], qa_pair['response_list_format'], pmh_mentioned)
+        assert qa_pair['category'] == category
+        pmh_mentioned = pmh_mentioned or category == PMH
+    assert [qa_pair['category'] for qa_pair in qa_pairs][1] == MEDICATIONS
+
+
+def test_extractive_summary():
+    assert extractive_summary("Do you smoke?", "No. I quit last year.") == "Do you smoke? No."
+    assert extractive_summary("Any allergies?", "not that I know of") == "Any allergies? not that I know of"
+
+
+def test_summarize_qa_pairs_after_deadline_is_extractive():
+    qa_pairs = [{"question": "Do you smoke?", "response": "No. I quit last year."}]
+    summarize_qa_pairs(qa_pairs, deadline=time.perf_counter() - 1)
+    assert qa_pairs[0]['summary'] == "Do you smoke? No."
+    assert qa_pairs[0]['degraded'] == True
+
+
+def test_summarize_qa_pairs_estimates_first_batch(monkeypatch):
+    def slow_summarize_batch(questions, answers, max_len=170, batch_size=16):
+        time.sleep(0.3)
+        return ["Summary of {}".format(question) for question in questions]
+
+    monkeypatch.setattr(generate_summary, 'summarize_batch', slow_summarize_batch)
+    qa_pairs = [{"question": "Do you smoke?", "response": "No. I quit last year."},
+                {"question": "Any allergies?", "response": "None."}]
+    # 2 pairs at 0.1 s each don't fit in the 0.15 s left, so no batch runs past the deadline
+    deadline = time.perf_counter() + 0.15
+    summarize_qa_pairs(qa_pairs, batch_size=2, deadline=deadline, pair_seconds=0.1)
+    assert time.perf_counter() < deadline
+    assert [qa_pair['summary'] for qa_pair in qa_pairs] == ["Do you smoke? No.", "Any allergies? None."]
+    assert all(qa_pair['degraded'] for qa_pair in qa_pairs)
+
+    # The first batch runs when its estimate fits, and the next batches use its time
+    summarize_qa_pairs(qa_pairs, batch_size=1, deadline=time.perf_counter() + 0.5, pair_seconds=0.01)
+    assert [qa_pair['summary'] for qa_pair in qa_pairs] == ["Summary of Do you smoke?", "Any allergies? None."]
+    assert [qa_pair['degraded'] for qa_pair in qa_pairs] == [False, True]
+
+
+def test_wait_for_summarizer_respects_deadline():
+    summarizer_future = concurrent.futures.Future()
+    assert wait_for_summarizer(summarizer_future, deadline=time.perf_counter() + 0.05) is None
+    summarizer_future.set_result("summarizer")
+    assert wait_for_summarizer(summarizer_future, deadline=time.perf_counter() - 1) == "summarizer"
+    assert wait_for_summarizer(summarizer_future) == "summarizer"
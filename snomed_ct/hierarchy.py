@@ -0,0 +1,149 @@
+"""
+SNOMED CT is-a hierarchy with precomputed ancestors for fast subsumption checks
+"""
+
+import os
+from bisect import bisect_left
+import numpy as np
+
+
+class SnomedHierarchy:
+    """
+    Is-a graph of SNOMED concepts stored in flat numpy arrays.
+
+    Concepts are numbered by their position in the sorted concept_ids array.
+    The graph is stored in CSR form:
+        - parent_offsets, parents: direct parents of each concept
+        - child_offsets, children: direct children of each concept
+        - ancestor_offsets, ancestors: sorted transitive closure of parents
+    so is_a(concept_id, ancestor_id) is two binary searches.
+    """
+
+    ARRAY_NAMES = [
+        "concept_ids", "parent_offsets", "parents", "child_offsets", "children",
+        "ancestor_offsets", "ancestors",
+    ]
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self._concept_ids = memoryview(arrays["concept_ids"])
+        self._ancestor_offsets = memoryview(arrays["ancestor_offsets"])
+        self._ancestors = memoryview(arrays["ancestors"])
+
+    @classmethod
+    def from_edges(cls, child_concept_ids, parent_concept_ids):
+        """
+        Build the hierarchy from parallel arrays of (child, parent) concept ids,
+        e.g. the active is-a relationships of an RF2 relationship file.
+        """
+        child_concept_ids = np.asarray(child_concept_ids, dtype=np.int64)
+        parent_concept_ids = np.asarray(parent_concept_ids, dtype=np.int64)
+        concept_ids = np.union1d(child_concept_ids, parent_concept_ids)
+        num_concepts = len(concept_ids)
+        child_nodes = np.searchsorted(concept_ids, child_concept_ids).astype(np.int32)
+        parent_nodes = np.searchsorted(concept_ids, parent_concept_ids).astype(np.int32)
+
+        def to_csr(from_nodes, to_nodes):
+            order = np.lexsort((to_nodes, from_nodes))
+            offsets = np.zeros(num_concepts + 1, dtype=np.int64)
+            np.cumsum(np.bincount(from_nodes, minlength=num_concepts), out=offsets[1:])
+            return offsets, to_nodes[order]
+
+        parent_offsets, parents = to_csr(child_nodes, parent_nodes)
+        child_offsets, children = to_csr(parent_nodes, child_nodes)
+
+        # Ancestors of each concept in topological order (parents before children)
+        ancestors = [None] * num_concepts
+        num_parents_left = np.diff(parent_offsets).tolist()
+        queue = [node for node in range(num_concepts) if num_parents_left[node] == 0]
+        num_visited = 0
+        while queue:
+            node = queue.pop()
+            num_visited += 1
+            node_parents = parents[parent_offsets[node]:parent_offsets[node + 1]]
+            if len(node_parents) == 0:
+                ancestors[node] = node_parents
+            else:
+                ancestors[node] = np.unique(np.concatenate(
+                    [node_parents] + [ancestors[parent] for parent in node_parents.tolist()]))
+            for child in children[child_offsets[node]:child_offsets[node + 1]].tolist():
+                num_parents_left[child] -= 1
+                if num_parents_left[child] == 0:
+                    queue.append(child)
+        if num_visited != num_concepts:
+            raise ValueError("Is-a relationships contain a cycle!")
+
+        ancestor_offsets = np.zeros(num_concepts + 1, dtype=np.int64)
+        np.cumsum([len(node_ancestors) for node_ancestors in ancestors], out=ancestor_offsets[1:])
+        ancestors = (np.concatenate(ancestors).astype(np.int32) if num_concepts > 0
+                     else np.array([], dtype=np.int32))
+        return cls({
+            "concept_ids": concept_ids,
+            "parent_offsets": parent_offsets,
+            "parents": parents,
+            "child_offsets": child_offsets,
+            "children": children,
+            "ancestor_offsets": ancestor_offsets,
+            "ancestors": ancestors,
+        })
+
+    def save(self, hierarchy_dir):
+        os.makedirs(hierarchy_dir, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(hierarchy_dir, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, hierarchy_dir):
+        """
+        Load a hierarchy saved with save(). Arrays are memory-mapped read-only.
+        """
+        return cls({name: np.load(os.path.join(hierarchy_dir, name + '.npy'), mmap_mode='r')
+                    for name in cls.ARRAY_NAMES})
+
+    def _node(self, concept_id):
+        node = bisect_left(self._concept_ids, concept_id)
+        if node < len(self._concept_ids) and self._concept_ids[node] == concept_id:
+            return node
+        return -1
+
+    def _concept_ids_of_nodes(self, nodes):
+        return self.arrays["concept_ids"][nodes]
+
+    def __contains__(self, concept_id):
+        return self._node(concept_id) >= 0
+
+    def parents(self, concept_id):
+        node = self._node(concept_id)
+        if node < 0:
+            return np.array([], dtype=np.int64)
+        offsets = self.arrays["parent_offsets"]
+        return self._concept_ids_of_nodes(self.arrays["parents"][offsets[node]:offsets[node + 1]])
+
+    def children(self, concept_id):
+        node = self._node(concept_id)
+        if node < 0:
+            return np.array([], dtype=np.int64)
+        offsets = self.arrays["child_offsets"]
+        return self._concept_ids_of_nodes(self.arrays["children"][offsets[node]:offsets[node + 1]])
+
+    def ancestors(self, concept_id):
+        node = self._node(concept_id)
+        if node < 0:
+            return np.array([], dtype=np.int64)
+        return self._concept_ids_of_nodes(
+            self.arrays["ancestors"][self._ancestor_offsets[node]:self._ancestor_offsets[node + 1]])
+
+    def is_a(self, concept_id, ancestor_id):
+        """
+        Returns True if concept_id is ancestor_id or one of its descendants.
+        """
+        if concept_id == ancestor_id:
+            return True
+        node = self._node(concept_id)
+        ancestor_node = self._node(ancestor_id)
+        if node < 0 or ancestor_node < 0:
+            return False
+        lo = self._ancestor_offsets[node]
+        hi = self._ancestor_offsets[node + 1]
+        idx = bisect_left(self._ancestors, ancestor_node, lo, hi)
+        return idx < hi and self._ancestors[idx] == ancestor_node
@@ -3,107 +3,282 @@ Generates keywords list from SNOMED CT files
 """
 
 import argparse
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 import os
 import regex as re
+import shutil
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import parent folder to sys.path
 from utilities import *
+from snomed_ct.term_matcher import SnomedTermMatcher
+from snomed_ct.hierarchy import SnomedHierarchy
+
+TERMS_CATEGORIES = ['disorders', 'events', 'findings', 'procedures', 'products', 'body_structures']
+INDEX_VERSION = 2
+
+# Semantic tag (in the fully specified name) of each terms category
+SEMANTIC_TAGS = {
+    'finding': 'findings',
+    'disorder': 'disorders',
+    'procedure': 'procedures',
+    'event': 'events',
+    'product': 'products',
+    'body structure': 'body_structures',
+}
+SEMANTIC_TAG_PATTERN = r'\((' + '|'.join(SEMANTIC_TAGS.keys()) + r')\)'
+IS_A_TYPE_ID = 116680003
+# Categories whose terms are expanded to all synonyms of the tagged concepts
+EXPAND_SYNONYMS_CATEGORIES = ['procedures', 'events', 'products', 'body_structures']
 
 
 def remove_parentheses_text(text):
     return re.sub(r'\(.+?\)', '', text).strip()
 
 
+def remove_parentheses_text_series(terms):
+    """
+    Vectorized remove_parentheses_text for a pandas Series of terms.
+    """
+    return terms.str.replace(r'\(.+?\)', '', regex=True).str.strip()
+
+
 def load_snomed_terms(terms_folder):
     terms = {}
-    terms_categories = ['disorders', 'events', 'findings', 'procedures', 'products', 'body_structures']
-    for term_category in  terms_categories:
+    for term_category in TERMS_CATEGORIES:
         with open(os.path.join(terms_folder, term_category + '_terms.txt'), 'r') as f:
             terms_in_category = [term.strip() for term in f.readlines()]
         terms[term_category] = terms_in_category
     return terms
 
 
+def get_term_concept_ids_path(terms_folder, term_category):
+    return os.path.join(terms_folder, term_category + '_concepts.npz')
+
+
+def load_snomed_term_concept_ids(terms_folder):
+    """
+    Load the term -> concept id tables written by write_snomed_terms. Returns a dict of
+    category -> (offsets, concept_ids), where the concept ids of the i-th term in
+    <category>_terms.txt are concept_ids[offsets[i]:offsets[i + 1]].
+    Categories without a table are left out.
+    """
+    term_concept_ids = {}
+    for term_category in TERMS_CATEGORIES:
+        path = get_term_concept_ids_path(terms_folder, term_category)
+        if os.path.exists(path):
+            with np.load(path) as table:
+                term_concept_ids[term_category] = (table['offsets'], table['concept_ids'])
+    return term_concept_ids
+
+
+def get_terms_files_hashes(terms_folder):
+    hashes = {}
+    for term_category in TERMS_CATEGORIES:
+        paths = [os.path.join(terms_folder, term_category + '_terms.txt'),
+                 get_term_concept_ids_path(terms_folder, term_category)]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                hashes[os.path.basename(path)] = hashlib.sha1(f.read()).hexdigest()
+    return hashes
+
+
+def build_snomed_index(terms_folder, index_dir):
+    """
+    Compile the terms files into a SnomedTermMatcher and save it to index_dir.
+    The index is written to a temporary folder first and then published with
+    utilities.publish_directory, so other processes never see a missing or
+    partially written index.
+    """
+    matcher = SnomedTermMatcher.from_terms(load_snomed_terms(terms_folder),
+                                           load_snomed_term_concept_ids(terms_folder))
+    manifest = {
+        "version": INDEX_VERSION,
+        "categories": TERMS_CATEGORIES,
+        "hashes": get_terms_files_hashes(terms_folder),
+    }
+    tmp_index_dir = "{}.tmp-{}".format(index_dir, os.getpid())
+    shutil.rmtree(tmp_index_dir, ignore_errors=True)
+    matcher.save(tmp_index_dir)
+    with open(os.path.join(tmp_index_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    publish_directory(tmp_index_dir, index_dir, get_directory_version(manifest))
+
+
+def load_snomed_index(terms_folder, index_dir=None):
+    """
+    Load the compiled SNOMED term index for terms_folder (by default stored in
+    <terms_folder>/index), rebuilding it if it is missing or the terms files
+    (or term -> concept id tables) changed.
+    Returns a memory-mapped SnomedTermMatcher.
+    """
+    if index_dir is None:
+        index_dir = os.path.join(terms_folder, 'index')
+    manifest_path = os.path.join(index_dir, 'manifest.json')
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    if ((manifest is None) or
+        (manifest['version'] != INDEX_VERSION) or
+        (manifest['categories'] != TERMS_CATEGORIES) or
+        (manifest['hashes'] != get_terms_files_hashes(terms_folder))):
+        print("Building SNOMED index in {}...".format(index_dir))
+        build_snomed_index(terms_folder, index_dir)
+    return SnomedTermMatcher.load(index_dir, TERMS_CATEGORIES)
+
+
+def get_hierarchy_dir(terms_folder):
+    return os.path.join(terms_folder, 'hierarchy')
+
+
+def load_snomed_hierarchy(terms_folder):
+    """
+    Load the memory-mapped is-a hierarchy written by write_snomed_hierarchy,
+    or None if the terms folder has no hierarchy.
+    """
+    hierarchy_dir = get_hierarchy_dir(terms_folder)
+    if not os.path.exists(hierarchy_dir):
+        return None
+    return SnomedHierarchy.load(hierarchy_dir)
+
+
+def load_active_concept_ids(concept_file, chunksize=500000):
+    """
+    Returns a sorted array of the ids of active concepts in the RF2 concept file.
+    """
+    active_ids = []
+    for chunk in pd.read_csv(concept_file, delimiter='\t', usecols=['id', 'active'],
+                             dtype={'id': np.int64, 'active': np.int8}, chunksize=chunksize):
+        active_ids.append(chunk['id'].values[chunk['active'].values == 1])
+    return np.unique(np.concatenate(active_ids)) if active_ids else np.array([], dtype=np.int64)
+
+
+def read_english_descriptions(description_file, active_concept_ids, chunksize=500000):
+    """
+    Yields chunks (conceptId, term) of the English descriptions of active concepts
+    in the RF2 description file, reading only the needed columns.
+    """
+    for chunk in pd.read_csv(description_file, delimiter='\t', usecols=['conceptId', 'languageCode', 'term'],
+                             dtype={'conceptId': np.int64, 'languageCode': 'category', 'term': object},
+                             chunksize=chunksize):
+        keep = ((chunk['languageCode'] == 'en').values &
+                np.isin(chunk['conceptId'].values, active_concept_ids))
+        yield chunk.loc[keep, ['conceptId', 'term']]
+
+
+def extract_snomed_terms(concept_file, description_file, chunksize=500000):
+    """
+    Extract the terms of each category from the RF2 concept and description files.
+    Descriptions are streamed in chunks, so memory use depends on the chunk size and
+    the number of extracted terms, not on the size of the release.
+
+    Makes two passes over the description file:
+        1) Find the semantic tag of each description with one regex. Terms of
+           categories that aren't expanded are collected directly; for the
+           others, the ids of the tagged concepts are collected.
+        2) Collect all synonyms of the tagged concepts of the expanded categories.
+    Returns a dict of category -> list of terms, sorted longest first, and a dict of
+    category -> (offsets, concept_ids) with the concept ids of each term
+    (see load_snomed_term_concept_ids). A term can belong to several concepts.
+    """
+    active_concept_ids = load_active_concept_ids(concept_file, chunksize)
+    term_frames = {term_category: [] for term_category in TERMS_CATEGORIES}
+    concept_ids = {term_category: [] for term_category in EXPAND_SYNONYMS_CATEGORIES}
+
+    for chunk in read_english_descriptions(description_file, active_concept_ids, chunksize):
+        tags = chunk['term'].str.extractall(SEMANTIC_TAG_PATTERN)[0]
+        rows = tags.index.get_level_values(0)
+        tagged = pd.DataFrame({
+            'category': tags.map(SEMANTIC_TAGS).values,
+            'conceptId': chunk.loc[rows, 'conceptId'].values,
+            'term': chunk.loc[rows, 'term'].values,
+        }).drop_duplicates()
+        for term_category, df_category in tagged.groupby('category'):
+            if term_category in EXPAND_SYNONYMS_CATEGORIES:
+                concept_ids[term_category].append(df_category['conceptId'].values)
+            else:
+                term_frames[term_category].append(pd.DataFrame({
+                    'term': remove_parentheses_text_series(df_category['term']).values,
+                    'conceptId': df_category['conceptId'].values,
+                }))
+
+    concept_ids = {term_category: np.unique(np.concatenate(ids)) if ids else np.array([], dtype=np.int64)
+                   for term_category, ids in concept_ids.items()}
+    for chunk in read_english_descriptions(description_file, active_concept_ids, chunksize):
+        chunk = chunk[chunk['term'].notna()]
+        for term_category, ids in concept_ids.items():
+            df_category = chunk[np.isin(chunk['conceptId'].values, ids)]
+            term_frames[term_category].append(pd.DataFrame({
+                'term': remove_parentheses_text_series(df_category['term']).values,
+                'conceptId': df_category['conceptId'].values,
+            }))
+
+    terms = {}
+    term_concept_ids = {}
+    for term_category, frames in term_frames.items():
+        if len(frames) == 0:
+            frames = [pd.DataFrame({'term': pd.Series([], dtype=object), 'conceptId': pd.Series([], dtype=np.int64)})]
+        df_terms = pd.concat(frames, ignore_index=True).drop_duplicates()
+        # Sort longest first (then alphabetically, so the output is deterministic)
+        df_terms['length'] = df_terms['term'].str.len()
+        df_terms = df_terms.sort_values(['length', 'term', 'conceptId'], ascending=[False, True, True])
+        counts = df_terms.groupby('term', sort=False).size()
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts.values, out=offsets[1:])
+        terms[term_category] = counts.index.tolist()
+        term_concept_ids[term_category] = (offsets, df_terms['conceptId'].values.astype(np.int64))
+    return terms, term_concept_ids
+
+
+def extract_snomed_hierarchy(relationship_file, chunksize=500000):
+    """
+    Build the is-a hierarchy from the active is-a relationships of the RF2
+    relationship file, streamed in chunks.
+    """
+    child_concept_ids = []
+    parent_concept_ids = []
+    for chunk in pd.read_csv(relationship_file, delimiter='\t',
+                             usecols=['active', 'sourceId', 'destinationId', 'typeId'],
+                             dtype={'active': np.int8, 'sourceId': np.int64,
+                                    'destinationId': np.int64, 'typeId': np.int64},
+                             chunksize=chunksize):
+        keep = (chunk['active'].values == 1) & (chunk['typeId'].values == IS_A_TYPE_ID)
+        child_concept_ids.append(chunk['sourceId'].values[keep])
+        parent_concept_ids.append(chunk['destinationId'].values[keep])
+    if len(child_concept_ids) == 0:
+        return SnomedHierarchy.from_edges([], [])
+    return SnomedHierarchy.from_edges(np.concatenate(child_concept_ids), np.concatenate(parent_concept_ids))
+
+
+def write_snomed_terms(terms, terms_folder, term_concept_ids=None):
+    os.makedirs(terms_folder, exist_ok=True)
+    for term_category, terms_list in terms.items():
+        with open(os.path.join(terms_folder, term_category + '_terms.txt'), 'w') as f:
+            for term in terms_list:
+                f.write('{}\n'.format(term))
+    for term_category, (offsets, concept_ids) in (term_concept_ids or {}).items():
+        np.savez(get_term_concept_ids_path(terms_folder, term_category),
+                 offsets=offsets, concept_ids=concept_ids)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--concept_file", type=str, required=True)
     parser.add_argument("--description_file", type=str, required=True)
+    parser.add_argument("--relationship_file", type=str, required=False,
+                        help="RF2 relationship file, to build the is-a hierarchy")
+    parser.add_argument("--terms_folder", type=str, default="terms")
+    parser.add_argument("--chunksize", type=int, default=500000, help="Number of RF2 rows read at a time")
     args = parser.parse_args()
 
-    df_concept = pd.read_csv(args.concept_file, delimiter='\t')
-    df_description = pd.read_csv(args.description_file, delimiter='\t')
-
-    df_concept_active = df_concept[df_concept['active'] == 1]
-    df_joined = pd.merge(df_concept_active, df_description, left_on='id', right_on='conceptId')
-    df_joined_en = df_joined[df_joined['languageCode'] == 'en']
-
-    df_findings = df_joined_en[df_joined_en['term'].str.contains('(finding)', regex=False, na=False)].copy()
-    df_disorders = df_joined_en[df_joined_en['term'].str.contains('(disorder)', regex=False, na=False)].copy()
-    df_procedures = df_joined_en[df_joined_en['term'].str.contains('(procedure)', regex=False, na=False)].copy()
-    df_events = df_joined_en[df_joined_en['term'].str.contains('(event)', regex=False, na=False)].copy()
-    df_products = df_joined_en[df_joined_en['term'].str.contains('(product)', regex=False, na=False)].copy()
-    df_body_structures = df_joined_en[df_joined_en['term'].str.contains('(body structure)', regex=False, na=False)].copy()
-
-    # df_findings_all = df_joined_en[df_joined_en['conceptId'].isin(df_findings['conceptId'])] # Expand synonyms
-    # df_disorders_all = df_joined_en[df_joined_en['conceptId'].isin(df_disorders['conceptId'])] # Expand synonyms
-    df_findings_all = df_findings # Don't expand synonyms
-    df_disorders_all = df_disorders # Don't expand synonyms
-    df_procedures_all = df_joined_en[df_joined_en['conceptId'].isin(df_procedures['conceptId'])].copy() # Expand synonyms
-    df_events_all = df_joined_en[df_joined_en['conceptId'].isin(df_events['conceptId'])].copy() # Expand synonyms
-    df_products_all = df_joined_en[df_joined_en['conceptId'].isin(df_products['conceptId'])].copy() # Expand synonyms
-    df_body_structures_all = df_joined_en[df_joined_en['conceptId'].isin(df_body_structures['conceptId'])].copy() # Expand synonyms
-
-    df_findings_all['term'] = df_findings_all['term'].apply(remove_parentheses_text)
-    df_disorders_all['term'] = df_disorders_all['term'].apply(remove_parentheses_text)
-    df_procedures_all['term'] = df_procedures_all['term'].apply(remove_parentheses_text)
-    df_events_all['term'] = df_events_all['term'].apply(remove_parentheses_text)
-    df_products_all['term'] = df_products_all['term'].apply(remove_parentheses_text)
-    df_body_structures_all['term'] = df_body_structures_all['term'].apply(remove_parentheses_text)
-
-    df_findings_all = df_findings_all.drop_duplicates('term')
-    df_disorders_all = df_disorders_all.drop_duplicates('term')
-    df_procedures_all = df_procedures_all.drop_duplicates('term')
-    df_events_all = df_events_all.drop_duplicates('term')
-    df_products_all = df_products_all.drop_duplicates('term')
-    df_body_structures_all = df_body_structures_all.drop_duplicates('term')
-
-    terms_findings = list(set(df_findings_all['term'].values.tolist()))
-    terms_disorders = list(set(df_disorders_all['term'].values.tolist()))
-    terms_procedures = list(set(df_procedures_all['term'].values.tolist()))
-    terms_events = list(set(df_events_all['term'].values.tolist()))
-    terms_products = list(set(df_products_all['term'].values.tolist()))
-    terms_body_structures = list(set(df_body_structures_all['term'].values.tolist()))
-
-    terms_findings.sort(key=len, reverse=True)
-    terms_disorders.sort(key=len, reverse=True)
-    terms_procedures.sort(key=len, reverse=True)
-    terms_events.sort(key=len, reverse=True)
-    terms_products.sort(key=len, reverse=True)
-    terms_body_structures.sort(key=len, reverse=True)
-
-    with open('terms/findings_terms.txt', 'w') as f:
-        for term in terms_findings:
-            f.write('{}\n'.format(term))
-
-    with open('terms/disorders_terms.txt', 'w') as f:
-        for term in terms_disorders:
-            f.write('{}\n'.format(term))
-
-    with open('terms/procedures_terms.txt', 'w') as f:
-        for term in terms_procedures:
-            f.write('{}\n'.format(term))
-
-    with open('terms/events_terms.txt', 'w') as f:
-        for term in terms_events:
-            f.write('{}\n'.format(term))
-
-    with open('terms/products_terms.txt', 'w') as f:
-        for term in terms_products:
-            f.write('{}\n'.format(term))
-
-    with open('terms/body_structures_terms.txt', 'w') as f:
-        for term in terms_body_structures:
-            f.write('{}\n'.format(term))
-
+    terms, term_concept_ids = extract_snomed_terms(args.concept_file, args.description_file, args.chunksize)
+    write_snomed_terms(terms, args.terms_folder, term_concept_ids)
+    if args.relationship_file:
+        hierarchy = extract_snomed_hierarchy(args.relationship_file, args.chunksize)
+        hierarchy.save(get_hierarchy_dir(args.terms_folder))
@@ -0,0 +1,124 @@
+# To run: python -m pytest snomed_ct/snomed_test.py
+
+import pytest
+
+from snomed import *
+
+
+CONCEPTS = [
+    # id, effectiveTime, active, moduleId, definitionStatusId
+    (1, 20200131, 1, 900, 900),
+    (2, 20200131, 1, 900, 900),
+    (3, 20200131, 1, 900, 900),
+    (4, 20200131, 0, 900, 900),
+    (5, 20200131, 1, 900, 900),
+]
+
+DESCRIPTIONS = [
+    # id, effectiveTime, active, moduleId, conceptId, languageCode, typeId, term, caseSignificanceId
+    (11, 20200131, 1, 900, 1, 'en', 900, 'Asthma (disorder)', 900),
+    (12, 20200131, 1, 900, 1, 'en', 900, 'Asthmatic', 900),
+    (21, 20200131, 1, 900, 2, 'en', 900, 'Appendectomy (procedure)', 900),
+    (22, 20200131, 1, 900, 2, 'en', 900, 'Excision of appendix', 900),
+    (23, 20200131, 1, 900, 2, 'fr', 900, 'Appendicectomie', 900),
+    (31, 20200131, 1, 900, 3, 'en', 900, 'Chest pain (finding)', 900),
+    (32, 20200131, 1, 900, 3, 'en', 900, 'Pain in chest', 900),
+    (51, 20200131, 1, 900, 5, 'en', 900, 'Appendectomy (procedure)', 900),
+    (41, 20200131, 1, 900, 4, 'en', 900, 'Inactive thing (procedure)', 900),
+]
+
+
+def write_rf2(path, header, rows):
+    with open(path, 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in rows:
+            f.write('\t'.join(str(value) for value in row) + '\n')
+
+
+@pytest.fixture
+def rf2_files(tmp_path):
+    concept_file = str(tmp_path / 'concept.txt')
+    description_file = str(tmp_path / 'description.txt')
+    write_rf2(concept_file, ['id', 'effectiveTime', 'active', 'moduleId', 'definitionStatusId'], CONCEPTS)
+    write_rf2(description_file, ['id', 'effectiveTime', 'active', 'moduleId', 'conceptId', 'languageCode',
+                                 'typeId', 'term', 'caseSignificanceId'], DESCRIPTIONS)
+    return concept_file, description_file
+
+
+@pytest.mark.parametrize("chunksize", [1, 3, 500000])
+def test_extract_snomed_terms(rf2_files, chunksize):
+    terms, term_concept_ids = extract_snomed_terms(*rf2_files, chunksize=chunksize)
+    assert terms['disorders'] == ['Asthma'] # Not expanded to synonyms
+    assert terms['findings'] == ['Chest pain']
+    assert terms['procedures'] == ['Excision of appendix', 'Appendectomy'] # Expanded, English only
+    assert terms['events'] == []
+    assert terms['products'] == []
+    assert terms['body_structures'] == []
+
+    offsets, concept_ids = term_concept_ids['procedures']
+    assert offsets.tolist() == [0, 1, 3]
+    assert concept_ids.tolist() == [2, 2, 5] # 'Appendectomy' belongs to two concepts
+
+
+def test_write_snomed_terms(rf2_files, tmp_path):
+    terms, term_concept_ids = extract_snomed_terms(*rf2_files)
+    write_snomed_terms(terms, str(tmp_path / 'terms'), term_concept_ids)
+    assert load_snomed_terms(str(tmp_path / 'terms')) == terms
+    loaded_term_concept_ids = load_snomed_term_concept_ids(str(tmp_path / 'terms'))
+    for term_category, (offsets, concept_ids) in term_concept_ids.items():
+        assert loaded_term_concept_ids[term_category][0].tolist() == offsets.tolist()
+        assert loaded_term_concept_ids[term_category][1].tolist() == concept_ids.tolist()
+
+    term_matcher = load_snomed_index(str(tmp_path / 'terms'))
+    matches = term_matcher.find_matches("Appendectomy and chest pain")
+    assert [(term_matcher.term(term_id), term_matcher.concept_ids(term_id).tolist())
+            for term_id, _, _ in matches] == [("Chest pain", [3]), ("Appendectomy", [2, 5])]
+
+
+def test_build_snomed_index_again(rf2_files, tmp_path):
+    terms, term_concept_ids = extract_snomed_terms(*rf2_files)
+    terms_folder = str(tmp_path / 'terms')
+    write_snomed_terms(terms, terms_folder, term_concept_ids)
+    index_dir = os.path.join(terms_folder, 'index')
+    # Index written before versioned index directories
+    os.makedirs(index_dir)
+    build_snomed_index(terms_folder, index_dir)
+    assert os.path.islink(index_dir)
+    term_matcher = load_snomed_index(terms_folder)
+    # Rebuilding the same version (e.g. by another process) keeps the published index
+    build_snomed_index(terms_folder, index_dir)
+    assert sorted(name for name in os.listdir(terms_folder) if name.startswith('index')) == \
+        sorted(['index', os.readlink(index_dir)])
+    assert len(term_matcher.find_matches("chest pain")) == 1
+    assert len(load_snomed_index(terms_folder).find_matches("chest pain")) == 1
+
+
+RELATIONSHIPS = [
+    # id, effectiveTime, active, moduleId, sourceId, destinationId, relationshipGroup, typeId, characteristicTypeId, modifierId
+    (101, 20200131, 1, 900, 2, 1, 0, IS_A_TYPE_ID, 900, 900),
+    (102, 20200131, 1, 900, 3, 1, 0, IS_A_TYPE_ID, 900, 900),
+    (103, 20200131, 1, 900, 4, 2, 0, IS_A_TYPE_ID, 900, 900),
+    (104, 20200131, 1, 900, 4, 3, 0, IS_A_TYPE_ID, 900, 900), # 4 has two parents
+    (105, 20200131, 0, 900, 5, 4, 0, IS_A_TYPE_ID, 900, 900), # Inactive
+    (106, 20200131, 1, 900, 5, 2, 0, 363698007, 900, 900), # Not is-a
+    (107, 20200131, 1, 900, 6, 4, 0, IS_A_TYPE_ID, 900, 900),
+]
+
+
+def test_extract_snomed_hierarchy(tmp_path):
+    relationship_file = str(tmp_path / 'relationship.txt')
+    write_rf2(relationship_file, ['id', 'effectiveTime', 'active', 'moduleId', 'sourceId', 'destinationId',
+                                  'relationshipGroup', 'typeId', 'characteristicTypeId', 'modifierId'], RELATIONSHIPS)
+    hierarchy = extract_snomed_hierarchy(relationship_file, chunksize=2)
+    hierarchy.save(get_hierarchy_dir(str(tmp_path)))
+    hierarchy = load_snomed_hierarchy(str(tmp_path))
+
+    assert sorted(hierarchy.parents(4).tolist()) == [2, 3]
+    assert sorted(hierarchy.children(1).tolist()) == [2, 3]
+    assert sorted(hierarchy.ancestors(6).tolist()) == [1, 2, 3, 4]
+    assert hierarchy.is_a(6, 1)
+    assert hierarchy.is_a(4, 4)
+    assert not hierarchy.is_a(1, 6)
+    assert not hierarchy.is_a(2, 3)
+    assert 5 not in hierarchy
+    assert not hierarchy.is_a(5, 2)
@@ -0,0 +1,264 @@
+"""
+Token-level Aho-Corasick matcher for SNOMED CT terms
+"""
+
+import os
+import sys
+from bisect import bisect_left
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import parent folder to sys.path
+from utilities import split_on_spaces_and_punctuation, StringTable
+
+
+# Characters allowed directly after a term (same as utilities.match_full_term)
+TERM_END_TOKENS = {' ', '.', ',', ';', '?', '!'}
+
+
+class SnomedTermMatcher:
+    """
+    Finds every whole-word occurrence of every SNOMED term in a text with one pass
+    over the text's tokens.
+
+    Terms and text are split with split_on_spaces_and_punctuation, so the automaton
+    walks over word, space and punctuation tokens. A match is kept only if it starts
+    at the beginning of the text or after a space, and ends at the end of the text or
+    before a space or punctuation (the same rule as utilities.match_full_term).
+
+    The automaton is stored in flat numpy arrays:
+        - child_offsets, child_tokens, child_nodes: goto transitions (CSR by node)
+        - fail: failure link of each node
+        - output_link: next node on the failure chain that ends a term (-1 if none)
+        - output_offsets, output_terms: term ids ending at each node (CSR by node)
+        - concept_offsets, concept_ids: SNOMED concept ids of each term (CSR by term)
+    Term ids follow the order of the terms dict (category order, then term order).
+    """
+
+    ARRAY_NAMES = [
+        "term_categories", "term_lengths", "concept_offsets", "concept_ids",
+        "child_offsets", "child_tokens", "child_nodes", "fail", "output_link",
+        "output_offsets", "output_terms",
+    ]
+
+    def __init__(self, categories, vocab, term_strings, arrays):
+        self.categories = categories
+        self.vocab = vocab
+        self.term_strings = term_strings
+        self.arrays = arrays
+        # memoryviews give fast Python int indexing (and work with bisect) for
+        # both in-memory and memory-mapped arrays
+        self._child_offsets = memoryview(arrays["child_offsets"])
+        self._child_tokens = memoryview(arrays["child_tokens"])
+        self._child_nodes = memoryview(arrays["child_nodes"])
+        self._fail = memoryview(arrays["fail"])
+        self._output_link = memoryview(arrays["output_link"])
+        self._output_offsets = memoryview(arrays["output_offsets"])
+        self._output_terms = memoryview(arrays["output_terms"])
+        self._term_lengths = memoryview(arrays["term_lengths"])
+        self._term_categories = memoryview(arrays["term_categories"])
+        self._concept_offsets = memoryview(arrays["concept_offsets"])
+
+    @classmethod
+    def from_terms(cls, terms, term_concept_ids=None):
+        """
+        Build the matcher from a dict of category -> list of terms
+        (as returned by snomed.load_snomed_terms), and optionally a dict of
+        category -> (offsets, concept_ids) aligned with the terms lists
+        (as returned by snomed.load_snomed_term_concept_ids).
+        """
+        categories = list(terms.keys())
+        vocab = {}
+        term_strings = []
+        term_categories = []
+        term_sequences = []
+        term_concepts = []
+        for category_idx, category in enumerate(categories):
+            concept_table = (term_concept_ids or {}).get(category)
+            for term_idx, term in enumerate(terms[category]):
+                tokens = split_on_spaces_and_punctuation(term.lower())
+                if len(tokens) == 0:
+                    continue
+                term_strings.append(term)
+                term_categories.append(category_idx)
+                term_sequences.append(tuple(vocab.setdefault(token, len(vocab)) for token in tokens))
+                if concept_table is not None:
+                    offsets, concept_ids = concept_table
+                    term_concepts.append(concept_ids[offsets[term_idx]:offsets[term_idx + 1]])
+                else:
+                    term_concepts.append([])
+
+        concept_offsets = np.zeros(len(term_concepts) + 1, dtype=np.int64)
+        np.cumsum([len(concepts) for concepts in term_concepts], out=concept_offsets[1:])
+        concept_ids = np.zeros(concept_offsets[-1], dtype=np.int64)
+        for term_id, concepts in enumerate(term_concepts):
+            concept_ids[concept_offsets[term_id]:concept_offsets[term_id + 1]] = concepts
+
+        # Build the trie by walking the term sequences in sorted order, so shared
+        # prefixes are always the most recently created path
+        parents = []
+        tokens = []
+        depths = [0]
+        term_nodes = [0] * len(term_sequences)
+        path = [0] # path[d] is the node at depth d for the previous sequence
+        previous = ()
+        for term_id in sorted(range(len(term_sequences)), key=term_sequences.__getitem__):
+            sequence = term_sequences[term_id]
+            common = 0
+            while (common < len(previous) and common < len(sequence) and
+                   previous[common] == sequence[common]):
+                common += 1
+            del path[common + 1:]
+            for depth in range(common, len(sequence)):
+                parents.append(path[-1])
+                tokens.append(sequence[depth])
+                depths.append(depth + 1)
+                path.append(len(depths) - 1)
+            term_nodes[term_id] = path[-1]
+            previous = sequence
+        num_nodes = len(depths)
+
+        # Goto transitions grouped by parent, sorted by token (CSR)
+        parents = np.array(parents, dtype=np.int32)
+        tokens = np.array(tokens, dtype=np.int32)
+        children = np.arange(1, num_nodes, dtype=np.int32)
+        order = np.lexsort((tokens, parents))
+        child_tokens = tokens[order]
+        child_nodes = children[order]
+        child_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parents, minlength=num_nodes), out=child_offsets[1:])
+
+        # Terms ending at each node (CSR)
+        term_nodes = np.array(term_nodes, dtype=np.int32)
+        output_terms = np.argsort(term_nodes, kind='stable').astype(np.int32)
+        output_offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_nodes, minlength=num_nodes), out=output_offsets[1:])
+
+        # Failure and output links, computed in breadth-first (depth) order
+        fail = np.zeros(num_nodes, dtype=np.int32)
+        output_link = np.full(num_nodes, -1, dtype=np.int32)
+        node_parents = np.zeros(num_nodes, dtype=np.int32)
+        node_parents[1:] = parents
+        node_tokens = np.zeros(num_nodes, dtype=np.int32)
+        node_tokens[1:] = tokens
+        matcher = cls(categories, vocab, StringTable.from_strings(term_strings), {
+            "term_categories": np.array(term_categories, dtype=np.int8),
+            "term_lengths": np.array([len(sequence) for sequence in term_sequences], dtype=np.int32),
+            "concept_offsets": concept_offsets,
+            "concept_ids": concept_ids,
+            "child_offsets": child_offsets,
+            "child_tokens": child_tokens,
+            "child_nodes": child_nodes,
+            "fail": fail,
+            "output_link": output_link,
+            "output_offsets": output_offsets,
+            "output_terms": output_terms,
+        })
+        has_output = np.diff(output_offsets) > 0
+        node_parents = node_parents.tolist()
+        node_tokens = node_tokens.tolist()
+        for node in np.argsort(np.array(depths), kind='stable').tolist()[1:]:
+            parent = node_parents[node]
+            if parent == 0:
+                continue # Depth 1 nodes fail to the root
+            token = node_tokens[node]
+            state = int(fail[parent])
+            child = matcher._goto(state, token)
+            while child < 0 and state != 0:
+                state = int(fail[state])
+                child = matcher._goto(state, token)
+            fail_node = max(child, 0)
+            fail[node] = fail_node
+            output_link[node] = fail_node if has_output[fail_node] else output_link[fail_node]
+        return matcher
+
+    def save(self, index_dir):
+        """
+        Save the automaton to index_dir as .npy files, which load() memory-maps.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        vocab_table = StringTable.from_strings(sorted(self.vocab, key=self.vocab.get))
+        arrays = dict(self.arrays)
+        arrays.update({
+            "vocab_data": vocab_table.data,
+            "vocab_offsets": vocab_table.offsets,
+            "term_strings_data": self.term_strings.data,
+            "term_strings_offsets": self.term_strings.offsets,
+        })
+        for name, array in arrays.items():
+            np.save(os.path.join(index_dir, name + '.npy'), array)
+
+    @classmethod
+    def load(cls, index_dir, categories):
+        """
+        Load an automaton saved with save(). Arrays are memory-mapped read-only,
+        so loading is fast and the pages are shared between processes.
+        """
+        def load_array(name):
+            return np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r')
+
+        vocab_table = StringTable(load_array("vocab_data"), load_array("vocab_offsets"))
+        vocab = {token: token_id for token_id, token in enumerate(vocab_table.tolist())}
+        term_strings = StringTable(load_array("term_strings_data"), load_array("term_strings_offsets"))
+        return cls(categories, vocab, term_strings,
+                   {name: load_array(name) for name in cls.ARRAY_NAMES})
+
+    def _goto(self, node, token_id):
+        lo = self._child_offsets[node]
+        hi = self._child_offsets[node + 1]
+        idx = bisect_left(self._child_tokens, token_id, lo, hi)
+        if idx < hi and self._child_tokens[idx] == token_id:
+            return self._child_nodes[idx]
+        return -1
+
+    def term(self, term_id):
+        return self.term_strings[term_id]
+
+    def category(self, term_id):
+        return self.categories[self._term_categories[term_id]]
+
+    def concept_ids(self, term_id):
+        """
+        Returns the SNOMED concept ids of the term as a numpy int64 array
+        (empty if the index was built without concept ids).
+        """
+        return self.arrays["concept_ids"][self._concept_offsets[term_id]:self._concept_offsets[term_id + 1]]
+
+    def find_matches(self, text):
+        """
+        Returns a list of (term_id, start_index, end_index) for every whole-word
+        occurrence of every term in text, sorted by term_id then start_index.
+        """
+        tokens = split_on_spaces_and_punctuation(text)
+        token_starts = []
+        index = 0
+        for token in tokens:
+            token_starts.append(index)
+            index += len(token)
+        token_starts.append(index)
+
+        matches = []
+        state = 0
+        for token_idx, token in enumerate(tokens):
+            token_id = self.vocab.get(token.lower(), -1)
+            if token_id < 0:
+                state = 0
+                continue
+            child = self._goto(state, token_id)
+            while child < 0 and state != 0:
+                state = self._fail[state]
+                child = self._goto(state, token_id)
+            state = max(child, 0)
+
+            # Check the term boundary after this token once for all terms ending here
+            if token_idx + 1 < len(tokens) and tokens[token_idx + 1] not in TERM_END_TOKENS:
+                continue
+            node = state
+            while node > 0:
+                for output_idx in range(self._output_offsets[node], self._output_offsets[node + 1]):
+                    term_id = self._output_terms[output_idx]
+                    start_token_idx = token_idx - self._term_lengths[term_id] + 1
+                    if start_token_idx == 0 or tokens[start_token_idx - 1] == ' ':
+                        matches.append((term_id, token_starts[start_token_idx], token_starts[token_idx + 1]))
+                node = self._output_link[node]
+        matches.sort()
+        return matches
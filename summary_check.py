@@ -0,0 +1,75 @@
+"""
+Checks that a generated summary of a question and answer only uses their words
+(so the model didn't make anything up)
+"""
+
+from nltk.stem.snowball import SnowballStemmer
+
+from utilities import split_on_spaces_and_punctuation
+
+
+def clean_word(word):
+    word = word.lower()
+    word = stemmer.stem(word)
+    return word
+
+stemmer = SnowballStemmer("english")
+allowed_words = [
+    "to", "the", "a", "it", "and", "patient", "says", "had", "in", "his",
+    "her", "he", "she", '.', 'as', ',', 'start', 'at', 'while', 'was', "began",
+    "noticing", "does", "not", "saw", "that", "patient's", "doesn't", "is",
+    "felt", "feels",
+]
+allowed_words = [clean_word(word) for word in allowed_words]
+not_allowed_words = [
+    "I", "my", "?", "!", "your", '..', "I'll",
+]
+not_allowed_words = [clean_word(word) for word in not_allowed_words]
+
+def check_summary(term_matcher, question, answer, summary,
+                  require_snomed_terms=False):
+    """
+    Check that summary only contains words from the question and answer, or stop words,
+    and also contains all of the SNOMED terms present in the question and answer.
+    term_matcher is a SnomedTermMatcher (see snomed.load_snomed_index), and is
+    only needed with require_snomed_terms.
+    """
+    question_words = [clean_word(word) for word in split_on_spaces_and_punctuation(question)]
+    answer_words = [clean_word(word) for word in split_on_spaces_and_punctuation(answer)]
+    all_allowed_words = set(question_words + answer_words + allowed_words)
+
+    summary_words = [clean_word(word) for word in split_on_spaces_and_punctuation(summary)]
+    for summary_word in summary_words:
+        if summary_word.lower() not in all_allowed_words:
+            return False, "{} not in allowed words".format(summary_word)
+        if summary_word.lower() in not_allowed_words:
+            return False, "{} not allowed".format(summary_word)
+    if require_snomed_terms:
+        snomed_term_ids = set()
+        for text in [question, answer]:
+            for term_id, _, _ in term_matcher.find_matches(text):
+                snomed_term_ids.add(term_id)
+        summary_term_ids = set(term_id for term_id, _, _ in term_matcher.find_matches(summary))
+        for term_id in sorted(snomed_term_ids - summary_term_ids):
+            return False, "SNOMED term '{}' missing".format(term_matcher.term(term_id))
+
+    return True, "Passed"
+
+
+def choose_summary(term_matcher, question, answer, candidates):
+    """
+    Returns the first of the candidate summaries that passes check_summary (also
+    requiring the SNOMED terms if term_matcher isn't None), or else the first
+    non-empty one.
+    """
+    for summary in candidates:
+        if summary.strip() == '':
+            continue
+        summary_valid, _ = check_summary(term_matcher, question, answer, summary,
+                                         require_snomed_terms=term_matcher is not None)
+        if summary_valid:
+            return summary
+    for summary in candidates:
+        if summary.strip() != '':
+            return summary
+    return candidates[0]
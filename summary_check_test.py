@@ -0,0 +1,25 @@
+# To run: python -m pytest summary_check_test.py
+
+import pytest
+
+from summary_check import *
+from snomed_ct.term_matcher import SnomedTermMatcher
+
+
+def test_check_summary_requires_snomed_terms():
+    term_matcher = SnomedTermMatcher.from_terms({"disorders": ["hypertension"]})
+    question = "AA BB hypertension?"
+    answer = "CC."
+    summary_valid, _ = check_summary(term_matcher, question, answer, "his she AA.")
+    assert summary_valid == True
+    summary_valid, reason = check_summary(term_matcher, question, answer, "his she AA.", require_snomed_terms=True)
+    assert summary_valid == False
+    assert reason == "SNOMED term 'hypertension' missing"
+
+
+def test_choose_summary():
+    question = "Do you smoke?"
+    answer = "No."
+    assert choose_summary(None, question, answer, ["", "I smoke.", "Does not smoke."]) == "Does not smoke."
+    assert choose_summary(None, question, answer, ["", "I smoke.", "My smoke."]) == "I smoke."
+    assert choose_summary(None, question, answer, ["", ""]) == ""
@@ -0,0 +1,74 @@
+"""
+Compares a quantized summarizer to the fp32 one on the validation split used by
+train_qa_summarizer.py: ROUGE-1 F1 of each, the ROUGE delta, and generation time.
+
+Example:
+    python evaluate_quantization.py --model_name model --model t5-large --qa_data ../qa_data
+"""
+
+import argparse
+import os
+import sys
+import time
+from rouge_score import rouge_scorer
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+
+from utils import *
+from train_qa_summarizer import QuestionAnswerSummaryDataset
+
+
+def evaluate_summarizer(summarizer, validation_data, max_len=128, batch_size=16):
+    """
+    Returns (average ROUGE-1 F1, seconds) of summarizing validation_data.
+    """
+    scorer = rouge_scorer.RougeScorer(['rouge1'])
+    start_time = time.perf_counter()
+    summaries = summarizer.summarize_batch(
+        [data['question'] for data in validation_data],
+        [data['answer'] for data in validation_data],
+        max_len=max_len, batch_size=batch_size)
+    elapsed_time = time.perf_counter() - start_time
+    total_rouge1_f1_score = 0
+    for data, summary in zip(validation_data, summaries):
+        total_rouge1_f1_score += scorer.score(data['summary'], summary)['rouge1'].fmeasure
+    return total_rouge1_f1_score / max(len(validation_data), 1), elapsed_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="model")
+    parser.add_argument("--model", type=str, default="t5-large")
+    parser.add_argument("--checkpoints_dir", type=str, default="checkpoints")
+    parser.add_argument("--qa_data", type=str, required=True)
+    parser.add_argument("--test_size", type=float, default=0.1)
+    parser.add_argument("--input_max_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--quantize", type=str, default="int8", choices=["int8"])
+    args = parser.parse_args()
+
+    print("Arguments: {}".format(args))
+
+    validation_dataset = QuestionAnswerSummaryDataset(
+        mode="validation",
+        data_folder=args.qa_data,
+        input_max_length=args.input_max_length,
+        test_size=args.test_size)
+    validation_data = validation_dataset.get_data()
+    print("{} items in validation dataset".format(len(validation_data)))
+
+    results = {}
+    for quantize in [None, args.quantize]:
+        summarizer = Summarizer.from_checkpoint(
+            args.model_name, args.model, args.checkpoints_dir, device='cpu',
+            decoding_config=DETERMINISTIC_DECODING_CONFIG, quantize=quantize)
+        rouge1_f1_score, elapsed_time = evaluate_summarizer(
+            summarizer, validation_data, max_len=args.input_max_length, batch_size=args.batch_size)
+        name = quantize or "fp32"
+        results[name] = (rouge1_f1_score, elapsed_time)
+        print("{}: ROUGE-1 F1 {} | {} s".format(name, round(rouge1_f1_score, 4), round(elapsed_time, 2)))
+
+    fp32_rouge, fp32_time = results["fp32"]
+    quantized_rouge, quantized_time = results[args.quantize]
+    print("ROUGE-1 F1 delta ({} - fp32): {}".format(args.quantize, round(quantized_rouge - fp32_rouge, 4)))
+    print("Speedup: {}x".format(round(fp32_time / max(quantized_time, 1e-9), 2)))
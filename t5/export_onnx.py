@@ -0,0 +1,233 @@
+"""
+Exports a checkpoint saved by utils.save_model to ONNX, for onnx_summarizer.OnnxSummarizer.
+
+Two graphs are written to <checkpoints_dir>/<model_name>-onnx:
+    - encoder.onnx: input_ids, attention_mask -> encoder_hidden_states and the
+      cross-attention keys and values of every decoder layer
+    - decoder.onnx: one decoder step with past (KV cache): input_ids (the last token),
+      encoder_attention_mask, cross-attention keys and values, and the self-attention
+      keys and values of the previous steps -> logits and the updated self-attention
+      keys and values
+plus config.json.
+
+Example:
+    python export_onnx.py --model_name model --model t5-large
+"""
+
+import argparse
+import json
+import os
+import sys
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+
+from utils import *
+from onnx_summarizer import get_onnx_dir
+
+
+def t5_attention(attention, hidden_states, key_states, value_states, position_bias):
+    """
+    T5 attention of hidden_states over precomputed key_states and value_states
+    (batch, heads, key_length, d_kv). T5 doesn't scale the scores.
+    """
+    batch_size, query_length, _ = hidden_states.shape
+    query_states = attention.q(hidden_states).view(batch_size, query_length, attention.n_heads, attention.key_value_proj_dim).transpose(1, 2)
+    scores = torch.matmul(query_states, key_states.transpose(2, 3)) + position_bias
+    weights = torch.softmax(scores.float(), dim=-1).type_as(scores)
+    output = torch.matmul(weights, value_states).transpose(1, 2).reshape(batch_size, query_length, -1)
+    return attention.o(output)
+
+
+def split_heads(attention, states):
+    batch_size, length, _ = states.shape
+    return states.view(batch_size, length, attention.n_heads, attention.key_value_proj_dim).transpose(1, 2)
+
+
+def relative_position_bias(attention, relative_position, bidirectional):
+    buckets = attention._relative_position_bucket(
+        relative_position,
+        bidirectional=bidirectional,
+        num_buckets=attention.relative_attention_num_buckets,
+        max_distance=attention.relative_attention_max_distance,
+    )
+    return attention.relative_attention_bias(buckets).permute([2, 0, 1]).unsqueeze(0)
+
+
+def mask_to_bias(attention_mask, dtype):
+    return (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+
+class T5EncoderForExport(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        encoder = self.model.encoder
+        hidden_states = encoder.embed_tokens(input_ids)
+        length = input_ids.shape[1]
+        positions = torch.arange(length, dtype=torch.long, device=input_ids.device)
+        first_attention = encoder.block[0].layer[0].SelfAttention
+        position_bias = (relative_position_bias(first_attention, positions[None, :] - positions[:, None], True) +
+                         mask_to_bias(attention_mask, hidden_states.dtype))
+        for block in encoder.block:
+            self_attention = block.layer[0]
+            normed = self_attention.layer_norm(hidden_states)
+            hidden_states = hidden_states + t5_attention(
+                self_attention.SelfAttention, normed,
+                split_heads(self_attention.SelfAttention, self_attention.SelfAttention.k(normed)),
+                split_heads(self_attention.SelfAttention, self_attention.SelfAttention.v(normed)),
+                position_bias)
+            feed_forward = block.layer[-1]
+            hidden_states = hidden_states + feed_forward.DenseReluDense(feed_forward.layer_norm(hidden_states))
+        hidden_states = encoder.final_layer_norm(hidden_states)
+
+        cross_key_values = []
+        for block in self.model.decoder.block:
+            cross_attention = block.layer[1].EncDecAttention
+            cross_key_values.append(split_heads(cross_attention, cross_attention.k(hidden_states)))
+            cross_key_values.append(split_heads(cross_attention, cross_attention.v(hidden_states)))
+        return (hidden_states, *cross_key_values)
+
+
+class T5DecoderWithPastForExport(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        config = model.config
+        self.scale_decoder_outputs = getattr(config, 'scale_decoder_outputs', config.tie_word_embeddings)
+
+    def forward(self, input_ids, encoder_attention_mask, *key_values):
+        decoder = self.model.decoder
+        num_layers = len(decoder.block)
+        cross_key_values = key_values[:2 * num_layers]
+        past_key_values = key_values[2 * num_layers:]
+
+        hidden_states = decoder.embed_tokens(input_ids)
+        past_length = past_key_values[0].shape[2]
+        key_positions = torch.arange(past_length + 1, dtype=torch.long, device=input_ids.device)
+        first_attention = decoder.block[0].layer[0].SelfAttention
+        position_bias = relative_position_bias(first_attention, (key_positions - past_length)[None, :], False)
+        cross_bias = mask_to_bias(encoder_attention_mask, hidden_states.dtype)
+
+        present_key_values = []
+        for layer_idx, block in enumerate(decoder.block):
+            self_attention = block.layer[0]
+            normed = self_attention.layer_norm(hidden_states)
+            key_states = torch.cat([past_key_values[2 * layer_idx],
+                                    split_heads(self_attention.SelfAttention, self_attention.SelfAttention.k(normed))], dim=2)
+            value_states = torch.cat([past_key_values[2 * layer_idx + 1],
+                                      split_heads(self_attention.SelfAttention, self_attention.SelfAttention.v(normed))], dim=2)
+            present_key_values += [key_states, value_states]
+            hidden_states = hidden_states + t5_attention(
+                self_attention.SelfAttention, normed, key_states, value_states, position_bias)
+
+            cross_attention = block.layer[1]
+            hidden_states = hidden_states + t5_attention(
+                cross_attention.EncDecAttention, cross_attention.layer_norm(hidden_states),
+                cross_key_values[2 * layer_idx], cross_key_values[2 * layer_idx + 1], cross_bias)
+
+            feed_forward = block.layer[-1]
+            hidden_states = hidden_states + feed_forward.DenseReluDense(feed_forward.layer_norm(hidden_states))
+        hidden_states = decoder.final_layer_norm(hidden_states)
+        if self.scale_decoder_outputs:
+            hidden_states = hidden_states * (self.model.model_dim ** -0.5)
+        logits = self.model.lm_head(hidden_states)
+        return (logits, *present_key_values)
+
+
+def export_onnx(model, onnx_dir, opset_version=17):
+    """
+    Export model (a T5ForConditionalGeneration) to onnx_dir.
+    """
+    os.makedirs(onnx_dir, exist_ok=True)
+    model = model.to('cpu').eval()
+    config = model.config
+    num_layers = config.num_decoder_layers
+    batch_size, length, past_length = 2, 7, 3
+
+    cross_names = []
+    past_names = []
+    present_names = []
+    for layer_idx in range(num_layers):
+        for kind in ['key', 'value']:
+            cross_names.append("cross_{}_{}".format(kind, layer_idx))
+            past_names.append("past_{}_{}".format(kind, layer_idx))
+            present_names.append("present_{}_{}".format(kind, layer_idx))
+
+    input_ids = torch.ones((batch_size, length), dtype=torch.long)
+    attention_mask = torch.ones((batch_size, length), dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(
+            T5EncoderForExport(model).eval(), # Export restores the mode of the module it exports
+            (input_ids, attention_mask),
+            os.path.join(onnx_dir, 'encoder.onnx'),
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['encoder_hidden_states'] + cross_names,
+            dynamic_axes=dict(
+                {'input_ids': {0: 'batch', 1: 'length'}, 'attention_mask': {0: 'batch', 1: 'length'},
+                 'encoder_hidden_states': {0: 'batch', 1: 'length'}},
+                **{name: {0: 'batch', 2: 'length'} for name in cross_names}),
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+        kv_shape = (batch_size, config.num_heads, past_length, config.d_kv)
+        cross_shape = (batch_size, config.num_heads, length, config.d_kv)
+        torch.onnx.export(
+            T5DecoderWithPastForExport(model).eval(),
+            (torch.ones((batch_size, 1), dtype=torch.long), attention_mask,
+             *[torch.zeros(cross_shape) for _ in cross_names],
+             *[torch.zeros(kv_shape) for _ in past_names]),
+            os.path.join(onnx_dir, 'decoder.onnx'),
+            input_names=['input_ids', 'encoder_attention_mask'] + cross_names + past_names,
+            output_names=['logits'] + present_names,
+            dynamic_axes=dict(
+                {'input_ids': {0: 'batch'}, 'encoder_attention_mask': {0: 'batch', 1: 'length'},
+                 'logits': {0: 'batch'}},
+                **{name: {0: 'batch', 2: 'length'} for name in cross_names},
+                **{name: {0: 'batch', 2: 'past_length'} for name in past_names},
+                **{name: {0: 'batch', 2: 'past_length + 1'} for name in present_names}),
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+    with open(os.path.join(onnx_dir, 'config.json'), 'w') as f:
+        json.dump({
+            "num_layers": num_layers,
+            "num_heads": config.num_heads,
+            "d_kv": config.d_kv,
+            "decoder_start_token_id": config.decoder_start_token_id,
+            "eos_token_id": config.eos_token_id,
+            "pad_token_id": config.pad_token_id,
+        }, f, indent=4)
+
+
+def quantize_onnx(onnx_dir):
+    """
+    Dynamically quantize the weights of the exported graphs to int8, in place.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    for graph_name in ['encoder.onnx', 'decoder.onnx']:
+        graph_path = os.path.join(onnx_dir, graph_name)
+        quantize_dynamic(graph_path, graph_path + '.int8', weight_type=QuantType.QInt8)
+        os.replace(graph_path + '.int8', graph_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="model")
+    parser.add_argument("--model", type=str, default="t5-large")
+    parser.add_argument("--checkpoints_dir", type=str, default="checkpoints")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"])
+    parser.add_argument("--opset_version", type=int, default=17)
+    args = parser.parse_args()
+
+    model = initialize_t5_model(args.model, pretrained=False)
+    load_model(model, args.model_name, args.checkpoints_dir)
+    onnx_dir = get_onnx_dir(args.model_name, args.checkpoints_dir)
+    export_onnx(model, onnx_dir, args.opset_version)
+    if args.quantize:
+        quantize_onnx(onnx_dir)
+    print("Exported to {}".format(onnx_dir))
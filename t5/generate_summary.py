@@ -1,29 +1,144 @@
 import os
 import sys
+import time
 import torch
 import csv
+import threading
+from concurrent.futures import Future
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import parent folder to sys.path
 
 from utils import *
+from summary_cache import SummaryCache
+from tiered_summarizer import TieredSummarizer
+import summary_check
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = None
+summarizer = None # Summarizer created by init_model
+term_matcher = None # SnomedTermMatcher used to check summaries, see set_term_matcher
+pair_seconds = None # Seconds warm_up_model took to summarize one Q&A pair
 
 
-def init_model(model_name, model_type='t5-large', checkpoints_dir='checkpoints'):
-    global model
-    model = initialize_t5_model(model_type)
-    load_model(model, model_name, checkpoints_dir)
-    model = model.to(device)
+def set_term_matcher(snomed_term_matcher):
+    """
+    Check that summaries keep the SNOMED terms of the question and answer, when
+    choosing between candidates or deciding to escalate to the large model.
+    """
+    global term_matcher
+    term_matcher = snomed_term_matcher
+    if isinstance(summarizer, TieredSummarizer):
+        summarizer.term_matcher = snomed_term_matcher
+
+
+def choose_summary(question, answer, candidates):
+    return summary_check.choose_summary(term_matcher, question, answer, candidates)
+
+
+def load_summarizer(model_name, model_type='t5-large', checkpoints_dir='checkpoints',
+                    cache=None, deterministic=False, quantize=None, backend='torch', num_candidates=1):
+    if backend == 'onnx':
+        if quantize:
+            raise ValueError("Quantize ONNX models when exporting them (export_onnx.py --quantize int8)")
+        if num_candidates > 1:
+            raise ValueError("The ONNX backend only generates one (greedy) summary")
+        from onnx_summarizer import OnnxSummarizer
+        return OnnxSummarizer.from_checkpoint(model_name, checkpoints_dir, cache=cache)
+    if backend != 'torch':
+        raise ValueError("Invalid backend: {}".format(backend))
+    decoding_config = DETERMINISTIC_DECODING_CONFIG if deterministic else None
+    return Summarizer.from_checkpoint(model_name, model_type, checkpoints_dir, device=device,
+                                      decoding_config=decoding_config, cache=cache,
+                                      quantize=quantize, num_candidates=num_candidates,
+                                      choose_summary=choose_summary)
+
+
+def init_model(model_name, model_type='t5-large', checkpoints_dir='checkpoints',
+               cache_path=None, cache_size=100000, deterministic=False, quantize=None, backend='torch',
+               small_model_name=None, small_model_type='t5-small', max_small_input_words=48,
+               num_candidates=1):
+    """
+    Load the summarizer. With cache_path, summaries are cached in that SQLite file
+    (at most cache_size entries). deterministic uses greedy decoding, so cached
+    summaries are the ones the model would generate again.
+    quantize='int8' runs a dynamically quantized model on the CPU.
+    backend='onnx' runs the ONNX export of the checkpoint (see export_onnx.py) with
+    ONNX Runtime, which always decodes greedily.
+    With small_model_name (e.g. trained with train_qa_summarizer.py --model t5-small),
+    pairs are summarized by that model first, and only escalated to model_name when
+    they are long or the summary fails the check (see TieredSummarizer).
+    With num_candidates > 1, each prompt is decoded into that many summaries in one
+    generate call (sampled, or beams with deterministic), and the first that passes
+    summary_check.check_summary is used.
+    """
+    global summarizer
+    cache = SummaryCache(cache_path, max_entries=cache_size) if cache_path else None
+    summarizer = load_summarizer(model_name, model_type, checkpoints_dir, cache, deterministic, quantize, backend,
+                                 num_candidates)
+    if small_model_name:
+        small_summarizer = load_summarizer(small_model_name, small_model_type, checkpoints_dir, cache,
+                                           deterministic, quantize, backend, num_candidates)
+        summarizer = TieredSummarizer(small_summarizer, summarizer, term_matcher=term_matcher,
+                                      max_small_input_words=max_small_input_words)
+    return summarizer
+
+
+def warm_up_model(max_len=16):
+    """
+    Generate one (uncached) summary, so the first real batch doesn't pay for
+    one-time setup like allocating buffers and picking kernels.
+    The summary is generated a second time, after the setup, and that time is kept
+    in pair_seconds: an estimate of the cost of one pair before any batch has been timed.
+    """
+    global pair_seconds
+    summarizers = [summarizer]
+    if isinstance(summarizer, TieredSummarizer):
+        summarizers = [summarizer.small_summarizer, summarizer.large_summarizer]
+    prompts = [build_prompt("Do you have any allergies?", "No.")]
+    for tier_summarizer in summarizers:
+        tier_summarizer.generate_uncached(prompts, max_len=max_len)
+    start_time = time.perf_counter()
+    for tier_summarizer in summarizers:
+        tier_summarizer.generate_uncached(prompts, max_len=max_len)
+    pair_seconds = time.perf_counter() - start_time
+
+
+def init_model_in_background(warm_up=True, **kwargs):
+    """
+    Run init_model(**kwargs), then warm_up_model, in a background thread, so the
+    model loads while the caller does other work (e.g. labeling the transcript).
+    Returns a Future of the summarizer; its result() waits for the model and
+    raises any exception from loading it.
+    The thread is a daemon, so a caller that stops waiting (e.g. after a deadline)
+    can exit without waiting for the model to load.
+    """
+    future = Future()
+
+    def load():
+        future.set_running_or_notify_cancel()
+        try:
+            start_time = time.perf_counter()
+            init_model(**kwargs)
+            load_time = time.perf_counter()
+            if warm_up:
+                warm_up_model()
+            print("Summarization model loaded in {:.2f} s, warmed up in {:.2f} s ({:.3f} s per pair)".format(
+                load_time - start_time, time.perf_counter() - load_time, pair_seconds or 0))
+            future.set_result(summarizer)
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=load, daemon=True).start()
+    return future
 
 
 def summarize(question, answer, max_len=170):
-    prompt = build_prompt(question, answer)
-    summary = generate(model, prompt, max_len=max_len, device=device)
-    return summary
+    return summarizer.summarize(question, answer, max_len=max_len)
+
+
+def summarize_batch(questions, answers, max_len=170, batch_size=16):
+    return summarizer.summarize_batch(questions, answers, max_len=max_len, batch_size=batch_size)
 
 
 def generate_summaries_for_csv(csv_path):
@@ -36,8 +151,8 @@ def generate_summaries_for_csv(csv_path):
                 "question": row[0].strip(),
                 "answer": row[1].strip(),
             })
-    for data in data_list:
-        summary = summarize(data['question'], data['answer'])
+    summaries = summarize_batch([data['question'] for data in data_list], [data['answer'] for data in data_list])
+    for data, summary in zip(data_list, summaries):
         data['summary'] = summary
         print("Q: {}\nA: {}\nS: {}\n".format(data['question'], data['answer'], summary))
     output_filename = os.path.splitext(csv_path)[0] + "_with_summaries.csv"
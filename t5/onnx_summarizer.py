@@ -0,0 +1,129 @@
+"""
+Summarizer that runs a model exported by export_onnx.py with ONNX Runtime.
+Does greedy decoding with a KV cache, and tokenizes and decodes with the same
+tokenizer as utils.Summarizer, so it gives the same summaries as Summarizer
+with DETERMINISTIC_DECODING_CONFIG.
+"""
+
+import json
+import os
+import threading
+import numpy as np
+import onnxruntime
+
+from summary_cache import generate_with_cache, get_file_hash, get_summary_cache_key
+from utils import build_prompt, decode_output, get_tokenizer
+
+
+def get_onnx_dir(model_name, checkpoints_dir):
+    """
+    Returns the directory the ONNX export of checkpoint model_name is saved in
+    (next to the checkpoint, see utils.get_checkpoint_file_path).
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, checkpoints_dir, model_name + '-onnx')
+
+
+class OnnxSummarizer:
+    """
+    Same interface as utils.Summarizer (generate, generate_batch, summarize,
+    summarize_batch), backed by the encoder.onnx and decoder.onnx graphs of onnx_dir.
+    """
+
+    decoding_config = {"do_sample": False, "backend": "onnx"}
+
+    def __init__(self, onnx_dir, tokenizer=None, cache=None, num_threads=None):
+        with open(os.path.join(onnx_dir, 'config.json'), 'r') as f:
+            self.config = json.load(f)
+        self.tokenizer = tokenizer if tokenizer is not None else get_tokenizer()
+        session_options = onnxruntime.SessionOptions()
+        if num_threads:
+            session_options.intra_op_num_threads = num_threads
+        self.encoder = onnxruntime.InferenceSession(
+            os.path.join(onnx_dir, 'encoder.onnx'), session_options, providers=['CPUExecutionProvider'])
+        self.decoder = onnxruntime.InferenceSession(
+            os.path.join(onnx_dir, 'decoder.onnx'), session_options, providers=['CPUExecutionProvider'])
+        self.cache = cache
+        self.checkpoint_hash = None
+        if cache is not None:
+            self.checkpoint_hash = get_file_hash(os.path.join(onnx_dir, 'decoder.onnx'))
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_checkpoint(cls, model_name, checkpoints_dir='checkpoints', cache=None):
+        return cls(get_onnx_dir(model_name, checkpoints_dir), cache=cache)
+
+    def generate_padded_batch(self, inputs, max_len):
+        """
+        Greedy decoding of one batch of inputs. Returns the generated ids of each
+        input, starting with the decoder start token (like model.generate).
+        """
+        encodings = self.tokenizer(inputs).input_ids
+        length = max(len(ids) for ids in encodings)
+        input_ids = np.full((len(inputs), length), self.config['pad_token_id'], dtype=np.int64)
+        attention_mask = np.zeros((len(inputs), length), dtype=np.int64)
+        for idx, ids in enumerate(encodings):
+            input_ids[idx, :len(ids)] = ids
+            attention_mask[idx, :len(ids)] = 1
+
+        encoder_outputs = self.encoder.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})
+        decoder_inputs = {"encoder_attention_mask": attention_mask}
+        num_layers = self.config['num_layers']
+        for layer_idx in range(num_layers):
+            decoder_inputs["cross_key_{}".format(layer_idx)] = encoder_outputs[1 + 2 * layer_idx]
+            decoder_inputs["cross_value_{}".format(layer_idx)] = encoder_outputs[2 + 2 * layer_idx]
+            empty_past = np.zeros((len(inputs), self.config['num_heads'], 0, self.config['d_kv']), dtype=np.float32)
+            decoder_inputs["past_key_{}".format(layer_idx)] = empty_past
+            decoder_inputs["past_value_{}".format(layer_idx)] = empty_past
+
+        next_ids = np.full((len(inputs), 1), self.config['decoder_start_token_id'], dtype=np.int64)
+        finished = np.zeros(len(inputs), dtype=bool)
+        output_ids = [next_ids[:, 0]]
+        # max_len counts the decoder start token, like model.generate's max_length
+        for _ in range(max_len - 1):
+            decoder_inputs["input_ids"] = next_ids
+            decoder_outputs = self.decoder.run(None, decoder_inputs)
+            next_ids = decoder_outputs[0][:, -1, :].argmax(axis=-1)
+            next_ids = np.where(finished, self.config['pad_token_id'], next_ids)
+            output_ids.append(next_ids)
+            finished |= next_ids == self.config['eos_token_id']
+            if finished.all():
+                break
+            next_ids = next_ids[:, None].astype(np.int64)
+            for layer_idx in range(num_layers):
+                decoder_inputs["past_key_{}".format(layer_idx)] = decoder_outputs[1 + 2 * layer_idx]
+                decoder_inputs["past_value_{}".format(layer_idx)] = decoder_outputs[2 + 2 * layer_idx]
+        return np.stack(output_ids, axis=1)
+
+    def generate_uncached(self, inputs, max_len=128, batch_size=16):
+        """
+        Generate outputs for inputs, batch_size at a time, in batches of similar length.
+        """
+        input_lengths = [len(input_ids) for input_ids in self.tokenizer(inputs).input_ids]
+        order = sorted(range(len(inputs)), key=input_lengths.__getitem__)
+        outputs = [None] * len(inputs)
+        with self.lock:
+            for batch_start in range(0, len(order), batch_size):
+                batch_idxs = order[batch_start:batch_start + batch_size]
+                batch_output_ids = self.generate_padded_batch([inputs[idx] for idx in batch_idxs], max_len)
+                for idx, output_ids in zip(batch_idxs, batch_output_ids):
+                    outputs[idx] = decode_output(self.tokenizer, output_ids)
+        return outputs
+
+    def get_cache_key(self, input_, max_len):
+        return get_summary_cache_key(self.checkpoint_hash, self.decoding_config, max_len, input_)
+
+    def generate(self, input_, max_len=128):
+        return self.generate_batch([input_], max_len=max_len, batch_size=1)[0]
+
+    def generate_batch(self, inputs, max_len=128, batch_size=16):
+        return generate_with_cache(
+            self.cache, lambda input_: self.get_cache_key(input_, max_len), inputs,
+            lambda uncached_inputs: self.generate_uncached(uncached_inputs, max_len, batch_size))
+
+    def summarize(self, question, answer, max_len=170):
+        return self.generate(build_prompt(question, answer), max_len=max_len)
+
+    def summarize_batch(self, questions, answers, max_len=170, batch_size=16):
+        prompts = [build_prompt(question, answer) for question, answer in zip(questions, answers)]
+        return self.generate_batch(prompts, max_len=max_len, batch_size=batch_size)
@@ -0,0 +1,26 @@
+# To run: python -m pytest t5/onnx_summarizer_test.py
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from utils import *
+from utils_test import get_word_tokenizer, get_random_model
+from export_onnx import export_onnx
+from onnx_summarizer import OnnxSummarizer
+
+
+def test_onnx_summarizer_same_as_summarizer(tmp_path):
+    tokenizer = get_word_tokenizer()
+    model = get_random_model(len(tokenizer))
+    onnx_dir = str(tmp_path / 'onnx')
+    export_onnx(model, onnx_dir)
+
+    summarizer = Summarizer(model, tokenizer=tokenizer, decoding_config=DETERMINISTIC_DECODING_CONFIG)
+    onnx_summarizer = OnnxSummarizer(onnx_dir, tokenizer=tokenizer)
+    questions = ["Do you smoke?", "Any pain?", "Any allergies?"]
+    answers = ["No", "Yes chest pain.", "No"]
+    summaries = summarizer.summarize_batch(questions, answers, max_len=12)
+    assert len(set(summaries)) == len(summaries)
+    assert onnx_summarizer.summarize_batch(questions, answers, max_len=12) == summaries
+    assert onnx_summarizer.summarize(questions[1], answers[1], max_len=12) == summaries[1]
@@ -0,0 +1,125 @@
+"""
+Batching of QuestionAnswerSummaryDataset items for training: padding to the
+longest item of each batch, and batches of items of similar length.
+"""
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+# Label id that the loss ignores
+IGNORE_LABEL_ID = -100
+
+
+def pad_ids(ids_list, pad_id, length):
+    """
+    Returns (input_ids, attention_mask), both (batch, 1, length), of the 1D id tensors
+    in ids_list padded with pad_id.
+    """
+    input_ids = torch.full((len(ids_list), 1, length), pad_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(ids_list), 1, length), dtype=torch.long)
+    for idx, ids in enumerate(ids_list):
+        input_ids[idx, 0, :len(ids)] = ids
+        attention_mask[idx, 0, :len(ids)] = 1
+    return input_ids, attention_mask
+
+
+def collate_qa_batch(items, pad_token_id=0, pad_to_length=None):
+    """
+    Collate dataset items (with unpadded prompt_data and label_data, see
+    QuestionAnswerSummaryDataset(pad_to_max_length=False)) into a batch padded to its
+    longest prompt and label, or to at least pad_to_length. Padded label positions
+    are IGNORE_LABEL_ID, so they don't count in the loss.
+    Also adds num_tokens (prompt and label tokens) and num_padded_tokens.
+    """
+    batch = {key: [item[key] for item in items] for key in ["question", "answer", "prompt", "label"]}
+    num_tokens = 0
+    num_padded_tokens = 0
+    for key, pad_id in [("prompt_data", pad_token_id), ("label_data", IGNORE_LABEL_ID)]:
+        ids_list = [item[key]["input_ids"].view(-1) for item in items]
+        length = max(len(ids) for ids in ids_list)
+        if pad_to_length is not None:
+            length = max(length, pad_to_length)
+        input_ids, attention_mask = pad_ids(ids_list, pad_id, length)
+        batch[key] = {"input_ids": input_ids, "attention_mask": attention_mask}
+        num_tokens += sum(len(ids) for ids in ids_list)
+        num_padded_tokens += input_ids.numel()
+    batch["num_tokens"] = num_tokens
+    batch["num_padded_tokens"] = num_padded_tokens
+    return batch
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that shuffles the items, sorts each run of
+    batch_size * bucket_size_multiplier items by length and cuts it into batches,
+    then shuffles the batches. Each batch has items of similar length, so little
+    of it is padding.
+
+    With max_tokens, batches are packed instead: they take items (in the same
+    order) while batch_size * longest length stays within max_tokens, so batches
+    of short items hold more items.
+    Call set_epoch before each epoch to get a different order. The batches are built
+    once per epoch, so len() is cheap.
+
+    For distributed training, every process (num_replicas in total) builds the same
+    batches from the same seed and takes every num_replicas-th batch from rank.
+    Leftover batches are dropped so all processes run the same number of steps.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size_multiplier=50, max_tokens=None, shuffle=True, seed=0,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.batches = None # Batches of self.epoch, see get_batches
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.batches = None
+        self.epoch = epoch
+
+    def get_batches(self):
+        if self.batches is None:
+            self.batches = self.build_batches()
+        return self.batches
+
+    def build_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        bucket_size = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for bucket_start in range(0, len(order), bucket_size):
+            bucket = order[bucket_start:bucket_start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')].tolist()
+            if self.max_tokens is None:
+                batches += [bucket[batch_start:batch_start + self.batch_size]
+                            for batch_start in range(0, len(bucket), self.batch_size)]
+                continue
+            batch = []
+            for idx in bucket:
+                # Sorted by length, so idx is the longest item of the batch
+                if len(batch) > 0 and (len(batch) + 1) * self.lengths[idx] > self.max_tokens:
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if len(batch) > 0:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[idx] for idx in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas][self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return len(self.get_batches())
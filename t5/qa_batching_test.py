@@ -0,0 +1,79 @@
+# To run: python -m pytest t5/qa_batching_test.py
+
+import os
+import sys
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from qa_batching import *
+
+
+def get_item(prompt_ids, label_ids):
+    """
+    Unpadded item of train_qa_summarizer.QuestionAnswerSummaryDataset with the given ids.
+    """
+    return {
+        "question": "Q", "answer": "A", "prompt": "P", "label": "L",
+        "prompt_data": {"input_ids": torch.tensor([prompt_ids])},
+        "label_data": {"input_ids": torch.tensor([label_ids])},
+    }
+
+
+def test_collate_qa_batch():
+    batch = collate_qa_batch([get_item([5, 6, 1], [7, 1]), get_item([5, 1], [8, 9, 10, 1])], pad_token_id=0)
+    assert batch["prompt_data"]["input_ids"].tolist() == [[[5, 6, 1]], [[5, 1, 0]]]
+    assert batch["prompt_data"]["attention_mask"].tolist() == [[[1, 1, 1]], [[1, 1, 0]]]
+    assert batch["label_data"]["input_ids"].tolist() == [[[7, 1, -100, -100]], [[8, 9, 10, 1]]]
+    assert batch["num_tokens"] == 11
+    assert batch["num_padded_tokens"] == 14
+
+    batch = collate_qa_batch([get_item([5, 1], [7, 1])], pad_token_id=0, pad_to_length=4)
+    assert batch["prompt_data"]["input_ids"].tolist() == [[[5, 1, 0, 0]]]
+    assert batch["label_data"]["input_ids"].tolist() == [[[7, 1, -100, -100]]]
+
+
+def test_length_bucket_batch_sampler():
+    lengths = [5, 1, 4, 2, 3, 6, 8, 7]
+    sampler = LengthBucketBatchSampler(lengths, batch_size=2, bucket_size_multiplier=4)
+    batches = list(sampler)
+    assert sorted(idx for batch in batches for idx in batch) == list(range(len(lengths)))
+    assert sorted(sorted(lengths[idx] for idx in batch) for batch in batches) == [[1, 2], [3, 4], [5, 6], [7, 8]]
+    assert sampler.get_batches() is sampler.get_batches() # Built once per epoch
+    sampler.set_epoch(1)
+    assert sampler.get_batches() != batches
+    assert sorted(idx for batch in sampler for idx in batch) == list(range(len(lengths)))
+
+    # Packed batches stay within max_tokens (batch size * longest length)
+    sampler = LengthBucketBatchSampler(lengths, batch_size=2, bucket_size_multiplier=4, max_tokens=8)
+    batches = list(sampler)
+    assert sorted(idx for batch in batches for idx in batch) == list(range(len(lengths)))
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[idx] for idx in batch) <= 8
+    assert sorted(len(batch) for batch in batches) == [1, 1, 1, 1, 2, 2]
+
+
+def test_length_bucket_batch_sampler_replicas():
+    lengths = [5, 1, 4, 2, 3, 6, 8, 7, 9, 10]
+    shards = [list(LengthBucketBatchSampler(lengths, batch_size=2, num_replicas=2, rank=rank)) for rank in range(2)]
+    assert len(shards[0]) == len(shards[1]) == 2
+    idxs = [idx for shard in shards for batch in shard for idx in batch]
+    assert len(idxs) == len(set(idxs)) == 8
+
+    # Every epoch, packed or not, the replicas get the same number of disjoint batches,
+    # and fewer than num_replicas batches are dropped
+    lengths = list(range(1, 24))
+    for max_tokens in [None, 12]:
+        samplers = [LengthBucketBatchSampler(lengths, batch_size=2, bucket_size_multiplier=3, max_tokens=max_tokens,
+                                             num_replicas=3, rank=rank) for rank in range(3)]
+        unsharded_sampler = LengthBucketBatchSampler(lengths, batch_size=2, bucket_size_multiplier=3,
+                                                     max_tokens=max_tokens)
+        for epoch in range(3):
+            for sampler in samplers + [unsharded_sampler]:
+                sampler.set_epoch(epoch)
+            all_batches = list(unsharded_sampler)
+            shards = [list(sampler) for sampler in samplers]
+            assert len(shards[0]) == len(shards[1]) == len(shards[2]) == len(samplers[0]) > 0
+            batches = [batch for shard in shards for batch in shard]
+            idxs = [idx for batch in batches for idx in batch]
+            assert len(idxs) == len(set(idxs))
+            assert len(all_batches) - 3 < len(batches) <= len(all_batches)
@@ -0,0 +1,49 @@
+"""
+Training epoch of the Q&A summarizer (see train_qa_summarizer.py), with gradient
+accumulation, bfloat16 autocast and distributed data-parallel training.
+"""
+
+import contextlib
+import torch
+
+
+def train_epoch(train_model, optimizer, dataloader, device='cpu', gradient_accumulation_steps=1, bf16=False,
+                distributed=False, verbose=True):
+    """
+    Train train_model for one pass over the batches of dataloader (see
+    qa_batching.collate_qa_batch), and return the numbers of tokens and padded tokens.
+    The optimizer steps every gradient_accumulation_steps batches, and after the last one,
+    on the mean of the gradients of the batches since the last step.
+    In distributed training, train_model is the DistributedDataParallel wrapper, and
+    the processes only average the gradients (all-reduce) before an optimizer step.
+    """
+    device = torch.device(device)
+    train_model.train()
+    num_tokens = 0
+    num_padded_tokens = 0
+    num_batches = len(dataloader)
+    optimizer.zero_grad()
+    for i, data in enumerate(dataloader):
+        optimizer_step = (i + 1) % gradient_accumulation_steps == 0 or i + 1 == num_batches
+        # Batches accumulated for this step (fewer in the last group)
+        group_start = i - i % gradient_accumulation_steps
+        group_size = min(gradient_accumulation_steps, num_batches - group_start)
+        sync_context = train_model.no_sync() if distributed and not optimizer_step else contextlib.nullcontext()
+        with sync_context:
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                output = train_model(
+                    input_ids=data["prompt_data"]["input_ids"].to(device).squeeze(1),
+                    attention_mask=data["prompt_data"]["attention_mask"].to(device).squeeze(1),
+                    labels=data["label_data"]["input_ids"].to(device).squeeze(1),
+                    return_dict=True,
+                )
+            loss = output.loss
+            (loss / group_size).backward()
+        if optimizer_step:
+            optimizer.step()
+            optimizer.zero_grad()
+        num_tokens += data["num_tokens"]
+        num_padded_tokens += data["num_padded_tokens"]
+        if verbose:
+            print("Train Loss: {}".format(round(loss.item(), 4)))
+    return num_tokens, num_padded_tokens
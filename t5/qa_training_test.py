@@ -0,0 +1,102 @@
+# To run: python -m pytest t5/qa_training_test.py
+
+import contextlib
+import copy
+import os
+import sys
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from qa_batching import collate_qa_batch
+from qa_batching_test import get_item
+from qa_training import train_epoch
+from utils_test import get_random_model
+
+
+class NoSyncRecorder(torch.nn.Module):
+    """
+    Stands in for the DistributedDataParallel wrapper, counting the batches run in no_sync.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.num_no_sync_batches = 0
+
+    def forward(self, **kwargs):
+        return self.model(**kwargs)
+
+    @contextlib.contextmanager
+    def no_sync(self):
+        self.num_no_sync_batches += 1
+        yield
+
+
+class CountingSGD(torch.optim.SGD):
+
+    def __init__(self, params):
+        super().__init__(params, lr=0.1)
+        self.num_steps = 0
+
+    def step(self, closure=None):
+        self.num_steps += 1
+        return super().step(closure)
+
+
+# Same prompt and label lengths, so the mean loss of a batch is the mean of the items' losses
+ITEMS = [get_item([5, 6, 7, 1], [8, 9, 1]), get_item([10, 11, 12, 1], [13, 14, 1]),
+         get_item([6, 7, 8, 1], [9, 10, 1]), get_item([11, 12, 13, 1], [14, 15, 1])]
+
+
+def assert_same_parameters(model, other_model):
+    for parameter, other_parameter in zip(model.parameters(), other_model.parameters()):
+        assert torch.allclose(parameter, other_parameter, atol=1e-6)
+
+
+def test_train_epoch_gradient_accumulation():
+    model = get_random_model(32)
+    accumulated_model = copy.deepcopy(model)
+    num_tokens, num_padded_tokens = train_epoch(
+        model, CountingSGD(model.parameters()),
+        [collate_qa_batch(ITEMS[:2]), collate_qa_batch(ITEMS[2:])], verbose=False)
+    assert num_tokens == num_padded_tokens == 28
+
+    # Accumulating the gradients of 2 batches of 1 item steps like 1 batch of 2 items
+    optimizer = CountingSGD(accumulated_model.parameters())
+    train_model = NoSyncRecorder(accumulated_model)
+    train_epoch(train_model, optimizer, [collate_qa_batch([item]) for item in ITEMS],
+                gradient_accumulation_steps=2, distributed=True, verbose=False)
+    assert optimizer.num_steps == 2
+    assert train_model.num_no_sync_batches == 2 # The gradients are only synced before a step
+    assert_same_parameters(model, accumulated_model)
+
+    # The optimizer also steps after the last batch, on the mean gradient of its shorter group
+    train_epoch(model, CountingSGD(model.parameters()),
+                [collate_qa_batch(ITEMS[:2]), collate_qa_batch(ITEMS[2:3])], verbose=False)
+    optimizer = CountingSGD(accumulated_model.parameters())
+    train_model = NoSyncRecorder(accumulated_model)
+    train_epoch(train_model, optimizer, [collate_qa_batch([item]) for item in ITEMS[:3]],
+                gradient_accumulation_steps=2, distributed=True, verbose=False)
+    assert optimizer.num_steps == 2
+    assert train_model.num_no_sync_batches == 1
+    assert_same_parameters(model, accumulated_model)
+
+
+def test_train_epoch_distributed_with_gradient_checkpointing(tmp_path):
+    model = get_random_model(32)
+    ddp_model = copy.deepcopy(model)
+    train_epoch(model, CountingSGD(model.parameters()),
+                [collate_qa_batch(ITEMS[:2]), collate_qa_batch(ITEMS[2:])], verbose=False)
+
+    # Checkpointing is enabled before wrapping the model, as in train_qa_summarizer.py
+    ddp_model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    dist.init_process_group("gloo", init_method="file://{}".format(tmp_path / "store"), rank=0, world_size=1)
+    try:
+        train_model = DistributedDataParallel(ddp_model)
+        train_epoch(train_model, CountingSGD(ddp_model.parameters()), [collate_qa_batch([item]) for item in ITEMS],
+                    gradient_accumulation_steps=2, distributed=True, verbose=False)
+    finally:
+        dist.destroy_process_group()
+    assert_same_parameters(model, ddp_model)
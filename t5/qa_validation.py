@@ -0,0 +1,169 @@
+"""
+Validation of the Q&A summarizer during training (see train_qa_summarizer.py):
+the validation loss, and the ROUGE-1 F1 of summaries generated in batches and
+scored in a pool of worker processes.
+
+Validation can also run in a separate process on a saved checkpoint
+(start_validation_process), so the next epoch doesn't wait for it.
+"""
+
+import concurrent.futures
+import functools
+import multiprocessing
+import time
+import torch
+from rouge_score import rouge_scorer
+from torch.utils.data import DataLoader
+
+from qa_batching import collate_qa_batch
+
+from utils import *
+
+
+scorer = None
+
+def rouge1_f1(label, summary):
+    global scorer
+    if scorer is None:
+        scorer = rouge_scorer.RougeScorer(['rouge1'])
+    return scorer.score(label, summary)['rouge1'].fmeasure
+
+
+def get_rouge_executor(num_workers):
+    """
+    Returns a pool of num_workers processes to score ROUGE in (see score_rouge1),
+    or None if num_workers <= 1. The processes are spawned, as forking a process
+    running torch threads can deadlock, so the pool is slow to start and should be
+    reused across epochs.
+    """
+    if num_workers <= 1:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def score_rouge1(labels, summaries, executor=None):
+    """
+    Returns the ROUGE-1 F1 of every summary against its label, scored in the
+    processes of executor (see get_rouge_executor) if given.
+    """
+    if executor is None or len(labels) < 2:
+        return [rouge1_f1(label, summary) for label, summary in zip(labels, summaries)]
+    chunksize = max(1, len(labels) // 32) # Few enough chunks to keep the overhead low
+    return list(executor.map(rouge1_f1, labels, summaries, chunksize=chunksize))
+
+
+def validation_loss(model, dataloader, device='cpu'):
+    """
+    Returns the loss of model over the batches of dataloader, summed over the items
+    (each batch's loss weighted by its number of items), and the number of items.
+    """
+    total_loss = 0
+    total_items = 0
+    with torch.no_grad():
+        for data in dataloader:
+            num_items = len(data["prompt_data"]["input_ids"])
+            output = model(
+                input_ids=data["prompt_data"]["input_ids"].to(device).squeeze(1),
+                attention_mask=data["prompt_data"]["attention_mask"].to(device).squeeze(1),
+                labels=data["label_data"]["input_ids"].to(device).squeeze(1),
+                return_dict=True,
+            )
+            total_loss += output.loss.item() * num_items
+            total_items += num_items
+    return total_loss, total_items
+
+
+def validate(model, summarizer, dataloader, max_len=128, batch_size=16, executor=None, verbose=True,
+             world_size=1):
+    """
+    Returns a dict with the validation loss, the ROUGE-1 F1 averaged over the
+    validation items, and the seconds it took.
+    The summaries are generated batch_size at a time by summarizer (which shares model),
+    and scored in the processes of executor (see get_rouge_executor) if given.
+    The loss and ROUGE-1 F1 are both over the items of dataloader's sampler.
+    In distributed training (world_size > 1), every process validates its share of
+    the items (the sampler should give each item to one process, without the repeated
+    items of a DistributedSampler) and the results are all-reduced, so every process
+    returns the same loss and ROUGE-1 F1.
+    """
+    start_time = time.perf_counter()
+    model.eval()
+    total_loss, total_loss_items = validation_loss(model, dataloader, summarizer.device)
+    dataset_data = dataloader.dataset.get_data()
+    validation_data = [dataset_data[idx] for idx in dataloader.sampler]
+    summaries = summarizer.summarize_batch(
+        [data['question'] for data in validation_data],
+        [data['answer'] for data in validation_data],
+        max_len=max_len, batch_size=batch_size)
+    if verbose:
+        for data, summary in zip(validation_data, summaries):
+            print("-----\nQ: {} | A: {}".format(data['question'], data['answer']))
+            print("Summary: {}\n".format(summary))
+        print("-----")
+    scores = score_rouge1([data['summary'] for data in validation_data], summaries, executor)
+    totals = torch.tensor([total_loss, total_loss_items, sum(scores), len(scores)], dtype=torch.float64)
+    if world_size > 1:
+        torch.distributed.all_reduce(totals)
+    total_loss, total_loss_items, total_rouge1_f1_score, num_items = totals.tolist()
+    return {
+        "loss": total_loss / max(total_loss_items, 1),
+        "rouge1_f1": total_rouge1_f1_score / max(num_items, 1),
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def print_validation_results(results, epoch):
+    print("Epoch {} Validation Loss: {}".format(epoch, round(results["loss"], 4)))
+    print("Epoch {} Validation ROUGE-1 F1: {}".format(epoch, round(results["rouge1_f1"], 4)))
+    print("Epoch {} Validation time: {:.2f} s".format(epoch, results["seconds"]))
+
+
+def validate_checkpoint(model_type, model_name, checkpoints_dir, data_folder, epoch, input_max_length=128,
+                        test_size=0.1, tokenized_data_dir=None, batch_size=16, num_workers=1):
+    """
+    Validate the model saved with save_model(model, model_name, checkpoints_dir) on
+    the CPU, on the validation split of data_folder (see QuestionAnswerSummaryDataset),
+    and print the results.
+    """
+    # Imported here, as train_qa_summarizer imports this module
+    from train_qa_summarizer import QuestionAnswerSummaryDataset
+
+    dataset = QuestionAnswerSummaryDataset(
+        mode="validation",
+        data_folder=data_folder,
+        input_max_length=input_max_length,
+        test_size=test_size,
+        tokenized_data_dir=tokenized_data_dir,
+        pad_to_max_length=False)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        collate_fn=functools.partial(collate_qa_batch, pad_token_id=dataset.tokenizer.pad_token_id))
+    model = initialize_t5_model(model_type, pretrained=False)
+    load_model(model, model_name, checkpoints_dir)
+    summarizer = Summarizer(model, tokenizer=dataset.tokenizer, device='cpu')
+    executor = get_rouge_executor(num_workers)
+    try:
+        results = validate(model, summarizer, dataloader, max_len=input_max_length, batch_size=batch_size,
+                           executor=executor, verbose=False)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print_validation_results(results, epoch)
+
+
+def start_validation_process(model_type, model_name, checkpoints_dir, data_folder, epoch, input_max_length=128,
+                             test_size=0.1, tokenized_data_dir=None, batch_size=16, num_workers=1):
+    """
+    Run validate_checkpoint in a new process, and return the (started) process.
+    The process is spawned (not forked, which can deadlock with torch threads or
+    fail with CUDA), so it only gets picklable arguments and loads the validation
+    data from the tokenized cache.
+    """
+    process = multiprocessing.get_context("spawn").Process(
+        target=validate_checkpoint,
+        args=(model_type, model_name, checkpoints_dir, data_folder, epoch),
+        kwargs={"input_max_length": input_max_length, "test_size": test_size,
+                "tokenized_data_dir": tokenized_data_dir, "batch_size": batch_size, "num_workers": num_workers})
+    process.start()
+    return process
@@ -0,0 +1,62 @@
+# To run: python -m pytest t5/qa_validation_test.py
+
+import os
+import sys
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from qa_validation import *
+from qa_batching_test import get_item
+from utils_test import get_random_model
+
+
+def test_score_rouge1():
+    labels = ["Patient has chest pain.", "Patient does not smoke.", "Patient has no allergies."]
+    summaries = ["Patient has chest pain.", "Patient smokes.", "No allergies."]
+    scores = score_rouge1(labels, summaries)
+    assert scores[0] == 1
+    assert 0 < scores[1] < 1
+    with get_rouge_executor(2) as executor:
+        assert score_rouge1(labels, summaries, executor) == scores
+    assert get_rouge_executor(1) is None
+
+
+class ListDataset(torch.utils.data.Dataset):
+
+    def __init__(self, items, data):
+        self.items = items
+        self.data = data
+
+    def get_data(self):
+        return self.data
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+
+class LabelSummarizer:
+    """
+    Summarizes the pairs of 'Q1' and 'Q3' as their labels, and the others wrong.
+    """
+    device = 'cpu'
+
+    def summarize_batch(self, questions, answers, max_len=128, batch_size=16):
+        return ["Patient has pain." if question in ["Q1", "Q3"] else "Unrelated words." for question in questions]
+
+
+def test_validate_scores_the_sampler_items():
+    data = [{"question": "Q{}".format(idx), "answer": "A", "summary": "Patient has pain."} for idx in range(5)]
+    items = [get_item([5, 6, 1], [7, 1]), get_item([5, 1], [8, 9, 10, 1]), get_item([6, 1], [7, 8, 1]),
+             get_item([7, 8, 9, 1], [9, 1]), get_item([5, 1], [7, 1])]
+    # The items of one process of 2: items 1 and 3, without the repeated items of a DistributedSampler
+    dataloader = torch.utils.data.DataLoader(ListDataset(items, data), batch_size=1, sampler=[1, 3],
+                                             collate_fn=collate_qa_batch)
+    model = get_random_model(32)
+    results = validate(model, LabelSummarizer(), dataloader, verbose=False)
+    assert results["rouge1_f1"] == 1
+    total_loss, num_items = validation_loss(model, dataloader)
+    assert num_items == 2
+    assert results["loss"] == total_loss / 2
@@ -0,0 +1,30 @@
+# To run: python -m pytest t5/summarizer_loading_test.py
+
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import parent folder to sys.path
+from t5 import generate_summary # Like scribe.py (gpt/ has a generate_summary too)
+from utils_test import get_random_model
+
+
+def test_init_model_in_background_raises_loading_error(tmp_path):
+    config_dir = str(tmp_path / 'config')
+    get_random_model(32).config.save_pretrained(config_dir)
+    summarizer_future = generate_summary.init_model_in_background(
+        model_name='missing', model_type=config_dir, checkpoints_dir=str(tmp_path / 'checkpoints'))
+    with pytest.raises(FileNotFoundError):
+        summarizer_future.result(timeout=60)
+
+
+def test_init_model_in_background_returns_summarizer(monkeypatch):
+    def init_model(**kwargs):
+        generate_summary.summarizer = kwargs
+        return kwargs
+
+    monkeypatch.setattr(generate_summary, 'init_model', init_model)
+    monkeypatch.setattr(generate_summary, 'summarizer', None)
+    summarizer_future = generate_summary.init_model_in_background(warm_up=False, model_name='model')
+    assert summarizer_future.result(timeout=60) == {'model_name': 'model'}
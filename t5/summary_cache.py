@@ -0,0 +1,122 @@
+"""
+On-disk cache of generated summaries, so repeated Q&A pairs (e.g. "Any allergies?" / "No.")
+and reruns on the same transcripts don't run the model again.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+def get_file_hash(file_path, chunk_size=1 << 20):
+    """
+    Returns the SHA-1 hex digest of the file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_summary_cache_key(checkpoint_hash, decoding_config, max_len, prompt):
+    """
+    Returns the cache key of a prompt summarized by the checkpoint with the given
+    hash and decoding parameters.
+    """
+    key_data = json.dumps([checkpoint_hash, decoding_config, max_len, prompt], sort_keys=True)
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+
+def generate_with_cache(cache, get_cache_key, inputs, generate_uncached):
+    """
+    Returns the outputs for inputs, taking them from cache (may be None) where
+    possible. generate_uncached(inputs) is called once with each distinct input
+    that isn't cached, and its outputs are added to the cache.
+    """
+    outputs = [None] * len(inputs)
+    if cache is not None:
+        for idx, input_ in enumerate(inputs):
+            outputs[idx] = cache.get(get_cache_key(input_))
+    uncached_idxs = {}
+    for idx, (input_, output) in enumerate(zip(inputs, outputs)):
+        if output is None:
+            uncached_idxs.setdefault(input_, []).append(idx)
+    if len(uncached_idxs) == 0:
+        return outputs
+    uncached_inputs = list(uncached_idxs.keys())
+    for input_, output in zip(uncached_inputs, generate_uncached(uncached_inputs)):
+        for idx in uncached_idxs[input_]:
+            outputs[idx] = output
+        if cache is not None:
+            cache.put(get_cache_key(input_), output)
+    return outputs
+
+
+class SummaryCache:
+    """
+    SQLite cache of key -> summary with least recently used eviction once it
+    has more than max_entries entries. Counts hits and misses.
+    Safe to share across threads.
+    """
+
+    def __init__(self, db_path, max_entries=100000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS summaries "
+                "(key TEXT PRIMARY KEY, summary TEXT NOT NULL, last_used INTEGER NOT NULL)")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self.use_counter, self.num_entries = self.connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0), COUNT(*) FROM summaries").fetchone()
+
+    def __len__(self):
+        return self.num_entries
+
+    def _next_use(self):
+        self.use_counter += 1
+        return self.use_counter
+
+    def get(self, key):
+        """
+        Returns the cached summary, or None if key isn't in the cache.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute("UPDATE summaries SET last_used = ? WHERE key = ?", (self._next_use(), key))
+            return row[0]
+
+    def put(self, key, summary):
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE summaries SET summary = ?, last_used = ? WHERE key = ?",
+                (summary, self._next_use(), key))
+            if cursor.rowcount > 0:
+                return
+            self.connection.execute(
+                "INSERT INTO summaries (key, summary, last_used) VALUES (?, ?, ?)",
+                (key, summary, self._next_use()))
+            self.num_entries += 1
+            if self.num_entries > self.max_entries:
+                cursor = self.connection.execute(
+                    "DELETE FROM summaries WHERE key IN "
+                    "(SELECT key FROM summaries ORDER BY last_used LIMIT ?)",
+                    (self.num_entries - self.max_entries,))
+                self.num_entries -= cursor.rowcount
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": self.num_entries}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,57 @@
+# To run: python -m pytest t5/summary_cache_test.py
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from summary_cache import *
+
+
+def test_summary_cache_get_and_put(tmp_path):
+    cache = SummaryCache(str(tmp_path / 'cache.db'))
+    assert cache.get("a") is None
+    cache.put("a", "Patient has no allergies.")
+    assert cache.get("a") == "Patient has no allergies."
+    cache.put("a", "Patient denies allergies.")
+    assert cache.get("a") == "Patient denies allergies."
+    assert cache.stats() == {"hits": 2, "misses": 1, "entries": 1}
+
+    # Entries persist
+    cache.close()
+    cache = SummaryCache(str(tmp_path / 'cache.db'))
+    assert cache.get("a") == "Patient denies allergies."
+    assert len(cache) == 1
+
+
+def test_summary_cache_evicts_least_recently_used(tmp_path):
+    cache = SummaryCache(str(tmp_path / 'cache.db'), max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+
+
+def test_get_summary_cache_key():
+    key = get_summary_cache_key("hash", {"do_sample": False}, 170, "summarize: <question> Any allergies? <answer> No.")
+    assert key == get_summary_cache_key("hash", {"do_sample": False}, 170, "summarize: <question> Any allergies? <answer> No.")
+    assert key != get_summary_cache_key("other hash", {"do_sample": False}, 170, "summarize: <question> Any allergies? <answer> No.")
+    assert key != get_summary_cache_key("hash", {"do_sample": True}, 170, "summarize: <question> Any allergies? <answer> No.")
+    assert key != get_summary_cache_key("hash", {"do_sample": False}, 128, "summarize: <question> Any allergies? <answer> No.")
+
+
+def test_generate_with_cache(tmp_path):
+    cache = SummaryCache(str(tmp_path / 'cache.db'))
+    generated = []
+
+    def generate_uncached(inputs):
+        generated.append(inputs)
+        return [input_.upper() for input_ in inputs]
+
+    assert generate_with_cache(cache, str, ["a", "b", "a"], generate_uncached) == ["A", "B", "A"]
+    assert generate_with_cache(cache, str, ["b", "c"], generate_uncached) == ["B", "C"]
+    assert generated == [["a", "b"], ["c"]]
+    assert generate_with_cache(None, str, ["a", "a"], generate_uncached) == ["A", "A"]
@@ -0,0 +1,99 @@
+"""
+Summarizer that tries a small model first, and only runs the large model on the
+Q&A pairs the small one can't be trusted with.
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import parent folder to sys.path
+
+from summary_check import check_summary
+from utilities import split_on_spaces_and_punctuation
+
+
+class TieredSummarizer:
+    """
+    Summarizes Q&A pairs with small_summarizer (e.g. a fine-tuned t5-small) and
+    escalates to large_summarizer the pairs that:
+        - have more than max_small_input_words words in the question and answer, or
+        - get an empty small-model summary, or one that fails check_summary (with
+          a term_matcher, the summary must also keep the SNOMED terms)
+    Both summarizers have the Summarizer interface (see utils.Summarizer).
+    Counts the escalated pairs and the time spent in each model (see stats).
+    """
+
+    def __init__(self, small_summarizer, large_summarizer, term_matcher=None, max_small_input_words=48):
+        self.small_summarizer = small_summarizer
+        self.large_summarizer = large_summarizer
+        self.term_matcher = term_matcher
+        self.max_small_input_words = max_small_input_words
+        self.cache = large_summarizer.cache
+        self.num_summaries = 0
+        self.num_escalated = 0
+        self.small_seconds = 0.0
+        self.large_seconds = 0.0
+
+    def count_words(self, question, answer):
+        return sum(1 for token in split_on_spaces_and_punctuation(question + ' ' + answer) if token != ' ')
+
+    def summary_valid(self, question, answer, summary):
+        if summary.strip() == '':
+            return False
+        summary_valid, _ = check_summary(self.term_matcher, question, answer, summary,
+                                         require_snomed_terms=self.term_matcher is not None)
+        return summary_valid
+
+    def summarize(self, question, answer, max_len=170):
+        return self.summarize_batch([question], [answer], max_len=max_len, batch_size=1)[0]
+
+    def summarize_batch(self, questions, answers, max_len=170, batch_size=16):
+        """
+        Returns the summaries of the (question, answer) pairs, in order.
+        """
+        summaries = [None] * len(questions)
+        small_idxs = [idx for idx, (question, answer) in enumerate(zip(questions, answers))
+                      if self.count_words(question, answer) <= self.max_small_input_words]
+        if len(small_idxs) > 0:
+            start_time = time.perf_counter()
+            small_summaries = self.small_summarizer.summarize_batch(
+                [questions[idx] for idx in small_idxs], [answers[idx] for idx in small_idxs],
+                max_len=max_len, batch_size=batch_size)
+            self.small_seconds += time.perf_counter() - start_time
+            for idx, summary in zip(small_idxs, small_summaries):
+                if self.summary_valid(questions[idx], answers[idx], summary):
+                    summaries[idx] = summary
+
+        large_idxs = [idx for idx, summary in enumerate(summaries) if summary is None]
+        if len(large_idxs) > 0:
+            start_time = time.perf_counter()
+            large_summaries = self.large_summarizer.summarize_batch(
+                [questions[idx] for idx in large_idxs], [answers[idx] for idx in large_idxs],
+                max_len=max_len, batch_size=batch_size)
+            self.large_seconds += time.perf_counter() - start_time
+            for idx, summary in zip(large_idxs, large_summaries):
+                summaries[idx] = summary
+
+        self.num_summaries += len(questions)
+        self.num_escalated += len(large_idxs)
+        return summaries
+
+    def stats(self):
+        """
+        Returns the number and fraction of escalated summaries, the seconds spent in
+        each model, and an estimate of the seconds saved compared to summarizing
+        every pair with the large model (from its time per escalated pair).
+        """
+        latency_saved_seconds = None
+        if self.num_escalated > 0:
+            large_only_seconds = self.large_seconds / self.num_escalated * self.num_summaries
+            latency_saved_seconds = large_only_seconds - self.small_seconds - self.large_seconds
+        return {
+            "summaries": self.num_summaries,
+            "escalated": self.num_escalated,
+            "escalated_fraction": self.num_escalated / max(self.num_summaries, 1),
+            "small_seconds": self.small_seconds,
+            "large_seconds": self.large_seconds,
+            "latency_saved_seconds": latency_saved_seconds,
+        }
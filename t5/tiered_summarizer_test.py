@@ -0,0 +1,47 @@
+# To run: python -m pytest t5/tiered_summarizer_test.py
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from tiered_summarizer import *
+
+
+class DictSummarizer:
+    """
+    Summarizes from a dict of answer -> summary, recording the answers it's asked for.
+    """
+
+    def __init__(self, summaries):
+        self.summaries = summaries
+        self.cache = None
+        self.answers = []
+
+    def summarize_batch(self, questions, answers, max_len=170, batch_size=16):
+        self.answers += answers
+        return [self.summaries.get(answer, '') for answer in answers]
+
+
+def test_tiered_summarizer_escalates_failed_and_long_pairs():
+    small_summarizer = DictSummarizer({
+        "No.": "Does not smoke.",
+        "I walk my dog.": "Patient says my dog bit me.", # Not in the question and answer
+        "Sometimes.": "", # Empty
+    })
+    large_summarizer = DictSummarizer({
+        "I walk my dog.": "Patient walks the dog.",
+        "Sometimes.": "Patient exercises sometimes.",
+        "Yes " * 10: "Patient has a long answer.",
+    })
+    summarizer = TieredSummarizer(small_summarizer, large_summarizer, max_small_input_words=12)
+    summaries = summarizer.summarize_batch(
+        ["Do you smoke?", "Do you exercise?", "Do you exercise?", "Any pain?"],
+        ["No.", "I walk my dog.", "Sometimes.", "Yes " * 10])
+    assert summaries == ["Does not smoke.", "Patient walks the dog.",
+                         "Patient exercises sometimes.", "Patient has a long answer."]
+    assert small_summarizer.answers == ["No.", "I walk my dog.", "Sometimes."]
+    assert large_summarizer.answers == ["I walk my dog.", "Sometimes.", "Yes " * 10]
+    stats = summarizer.stats()
+    assert stats["summaries"] == 4
+    assert stats["escalated"] == 3
+    assert stats["escalated_fraction"] == 0.75
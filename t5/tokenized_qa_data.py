@@ -0,0 +1,189 @@
+"""
+Tokenized cache of a folder of Q&A summary CSV files (see QuestionAnswerSummaryDataset),
+so training doesn't parse the CSVs and tokenize every prompt and label again on
+every run and epoch.
+
+The cache (by default <data_folder>/tokenized) holds, as memory-mapped .npy files:
+    - the question, answer and summary strings of every row, as StringTables
+    - the token ids of every prompt and label in CSR form: the ids of the i-th
+      prompt are prompt_ids[prompt_offsets[i]:prompt_offsets[i + 1]]
+and a manifest with the hashes of the CSV files and the tokenizer version, and is
+rebuilt when either changes.
+"""
+
+import csv
+import glob
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import transformers
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Import parent folder to sys.path
+
+from summary_cache import get_file_hash
+from utilities import StringTable, get_directory_version, publish_directory
+from utils import build_prompt
+
+
+TOKENIZED_DATA_VERSION = 1
+TEXT_COLUMNS = ["question", "answer", "summary"]
+
+
+def get_data_files(data_folder):
+    return sorted(glob.glob(os.path.join(data_folder, '*.csv'))) # Sort to maintain order
+
+
+def get_data_files_hashes(data_folder):
+    return {os.path.basename(path): get_file_hash(path) for path in get_data_files(data_folder)}
+
+
+def get_tokenizer_version(tokenizer):
+    return "{} {} {} {}".format(type(tokenizer).__name__, tokenizer.name_or_path,
+                                len(tokenizer), transformers.__version__)
+
+
+def add_punctuation_to_end_of_sentence(string):
+    if string[-1] in ['.', '?', '!']:
+        return string
+    else:
+        return string + '.'
+
+
+def read_qa_data(data_folder):
+    """
+    Returns the rows of the CSV files in data_folder as dicts of question, answer
+    and summary. Expects CSV files with (at least) 3 columns:
+        1) Question
+        2) Answer
+        3) Summary
+    Rows without a question, answer or summary are skipped.
+    """
+    data_list = []
+    for filename in get_data_files(data_folder):
+        with open(filename ,'r') as csv_file:
+            next(csv_file, None) # Skip header line (or return None is file empty)
+            csv_reader = csv.reader(csv_file)
+            for row in csv_reader:
+                # Exclude if no question, answer, or summary
+                if len(row[0]) == 0 or len(row[1]) == 0 or len(row[2]) == 0:
+                    continue
+                data_list.append({
+                    "question": row[0].strip(),
+                    "answer": row[1].strip(),
+                    "summary": add_punctuation_to_end_of_sentence(row[2].strip()), # Add punctuation if needed
+                })
+    return data_list
+
+
+def tokenize_to_csr(tokenizer, texts, batch_size=1024):
+    """
+    Tokenize texts in batches. Returns (offsets, ids) with the ids of texts[i]
+    in ids[offsets[i]:offsets[i + 1]].
+    """
+    ids = []
+    for batch_start in range(0, len(texts), batch_size):
+        ids += tokenizer(texts[batch_start:batch_start + batch_size]).input_ids
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(text_ids) for text_ids in ids], out=offsets[1:])
+    ids = (np.concatenate([np.asarray(text_ids, dtype=np.int32) for text_ids in ids]) if len(ids) > 0
+           else np.array([], dtype=np.int32))
+    return offsets, ids
+
+
+def build_tokenized_qa_data(data_folder, tokenizer, cache_dir):
+    """
+    Tokenize the Q&A data of data_folder and save it to cache_dir.
+    The cache is written to a temporary folder first and then published with
+    utilities.publish_directory, so other processes (e.g. the other ranks of
+    distributed training) never see a missing or partially written cache.
+    """
+    data_list = read_qa_data(data_folder)
+    arrays = {}
+    for column in TEXT_COLUMNS:
+        table = StringTable.from_strings([data[column] for data in data_list])
+        arrays[column + "_data"] = table.data
+        arrays[column + "_offsets"] = table.offsets
+    arrays["prompt_offsets"], arrays["prompt_ids"] = tokenize_to_csr(
+        tokenizer, [build_prompt(data["question"], data["answer"]) for data in data_list])
+    arrays["label_offsets"], arrays["label_ids"] = tokenize_to_csr(
+        tokenizer, [data["summary"] for data in data_list])
+
+    manifest = {
+        "version": TOKENIZED_DATA_VERSION,
+        "tokenizer": get_tokenizer_version(tokenizer),
+        "hashes": get_data_files_hashes(data_folder),
+        "names": sorted(arrays.keys()),
+    }
+    tmp_cache_dir = "{}.tmp-{}".format(cache_dir, os.getpid())
+    shutil.rmtree(tmp_cache_dir, ignore_errors=True)
+    os.makedirs(tmp_cache_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_cache_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_cache_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    publish_directory(tmp_cache_dir, cache_dir, get_directory_version(manifest))
+
+
+class TokenizedQAData:
+    """
+    Memory-mapped tokenized Q&A data. Row i has the strings question(i), answer(i)
+    and summary(i), and the token ids prompt_ids(i) and label_ids(i).
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.texts = {column: StringTable(arrays[column + "_data"], arrays[column + "_offsets"])
+                      for column in TEXT_COLUMNS}
+
+    @classmethod
+    def load(cls, cache_dir):
+        with open(os.path.join(cache_dir, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        return cls({name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+                    for name in manifest["names"]})
+
+    def __len__(self):
+        return len(self.arrays["prompt_offsets"]) - 1
+
+    def question(self, idx):
+        return self.texts["question"][idx]
+
+    def answer(self, idx):
+        return self.texts["answer"][idx]
+
+    def summary(self, idx):
+        return self.texts["summary"][idx]
+
+    def _ids(self, name, idx):
+        offsets = self.arrays[name + "_offsets"]
+        return self.arrays[name + "_ids"][offsets[idx]:offsets[idx + 1]]
+
+    def prompt_ids(self, idx):
+        return self._ids("prompt", idx)
+
+    def label_ids(self, idx):
+        return self._ids("label", idx)
+
+
+def load_tokenized_qa_data(data_folder, tokenizer, cache_dir=None):
+    """
+    Load the tokenized cache of data_folder (by default stored in <data_folder>/tokenized),
+    rebuilding it if it is missing, or the CSV files or the tokenizer changed.
+    Returns a memory-mapped TokenizedQAData.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(data_folder, 'tokenized')
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    if ((manifest is None) or
+        (manifest['version'] != TOKENIZED_DATA_VERSION) or
+        (manifest['tokenizer'] != get_tokenizer_version(tokenizer)) or
+        (manifest['hashes'] != get_data_files_hashes(data_folder))):
+        print("Tokenizing Q&A data in {}...".format(cache_dir))
+        build_tokenized_qa_data(data_folder, tokenizer, cache_dir)
+    return TokenizedQAData.load(cache_dir)
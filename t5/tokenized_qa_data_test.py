@@ -0,0 +1,58 @@
+# To run: python -m pytest t5/tokenized_qa_data_test.py
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from tokenized_qa_data import *
+
+
+class CharTokenizer:
+    """
+    Tokenizer with one token per character, and </s> (1) at the end.
+    """
+
+    name_or_path = "char"
+
+    def __len__(self):
+        return 256
+
+    def __call__(self, texts):
+        return transformers.BatchEncoding({"input_ids": [[ord(char) for char in text] + [1] for text in texts]})
+
+
+def write_csv(path, rows):
+    with open(path, 'w') as f:
+        f.write("question,answer,summary\n")
+        for row in rows:
+            f.write(",".join(row) + "\n")
+
+
+def test_load_tokenized_qa_data(tmp_path):
+    data_folder = str(tmp_path)
+    write_csv(os.path.join(data_folder, 'data.csv'), [
+        ("Do you smoke?", "No", "Patient does not smoke"),
+        ("Any allergies?", "", "Skipped, no answer."),
+        ("Any pain?", "Yes", "Patient has pain."),
+    ])
+    tokenizer = CharTokenizer()
+    tokenized_data = load_tokenized_qa_data(data_folder, tokenizer)
+    assert len(tokenized_data) == 2
+    assert tokenized_data.question(1) == "Any pain?"
+    assert tokenized_data.answer(1) == "Yes"
+    assert tokenized_data.summary(0) == "Patient does not smoke."
+    prompt = build_prompt("Do you smoke?", "No")
+    assert tokenized_data.prompt_ids(0).tolist() == [ord(char) for char in prompt] + [1]
+    assert tokenized_data.label_ids(1).tolist() == [ord(char) for char in "Patient has pain."] + [1]
+
+    # Rebuilt when the data changes
+    write_csv(os.path.join(data_folder, 'data.csv'), [("Any pain?", "No", "Patient has no pain.")])
+    tokenized_data = load_tokenized_qa_data(data_folder, tokenizer)
+    assert len(tokenized_data) == 1
+    assert tokenized_data.summary(0) == "Patient has no pain."
+
+    # Building the same cache again (e.g. in another process) keeps the published one
+    cache_dir = os.path.join(data_folder, 'tokenized')
+    build_tokenized_qa_data(data_folder, tokenizer, cache_dir)
+    assert os.path.islink(cache_dir)
+    assert load_tokenized_qa_data(data_folder, tokenizer).summary(0) == "Patient has no pain."
@@ -1,19 +1,47 @@
 import argparse
+import functools
 import os
-import glob
-import csv
+import resource
+import time
 import random
-from rouge_score import rouge_scorer
+import numpy as np
 from sklearn.model_selection import train_test_split
 import torch
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 from transformers import T5Tokenizer
 from transformers import Adafactor, AdamW
 
 from utils import *
+from tokenized_qa_data import load_tokenized_qa_data
+from qa_batching import collate_qa_batch, LengthBucketBatchSampler
+from qa_training import train_epoch
+from qa_validation import get_rouge_executor, validate, print_validation_results, start_validation_process
+
+# Models with at least this many parameters are trained with Adafactor by default,
+# as Adam's two moments per parameter don't fit in memory (t5-large has 738M parameters)
+ADAFACTOR_MIN_PARAMETERS = 500_000_000
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # In KB on Linux
+
 
 class QuestionAnswerSummaryDataset(Dataset):
-    def __init__(self, mode, data_folder, input_max_length=128, test_size=0.1):
+    """
+    Q&A pairs and summaries from the CSV files of data_folder, split into train and
+    validation sets. Reads the prompts and labels pre-tokenized from the cache in
+    tokenized_data_dir (see tokenized_qa_data.py), which is built the first time.
+    Prompts and labels are padded to input_max_length, or with pad_to_max_length=False
+    left unpadded for qa_batching.collate_qa_batch to pad.
+    """
+
+    def __init__(self, mode, data_folder, input_max_length=128, test_size=0.1, tokenized_data_dir=None,
+                 pad_to_max_length=True):
         if mode not in ["train", "validation"]:
             return ValueError("Invalid mode!")
         
@@ -21,86 +49,69 @@ class QuestionAnswerSummaryDataset(Dataset):
         self.data_folder = data_folder
         self.input_max_length = input_max_length
         self.test_size = test_size
+        self.pad_to_max_length = pad_to_max_length
 
-        self.tokenizer = T5Tokenizer.from_pretrained('t5-base')
+        self.tokenizer = get_tokenizer()
         self.random_seed = 42
 
-        self.train_data = None # self.load_data will populate
-        self.validation_data = None # self.load_data will populate
+        # Tokenized with the tokenizer that pads the items and decodes the summaries
+        self.tokenized_data = load_tokenized_qa_data(data_folder, self.tokenizer, tokenized_data_dir)
+        # Same split as splitting the list of rows
+        self.train_idxs, self.validation_idxs = train_test_split(
+            list(range(len(self.tokenized_data))),
+            test_size=self.test_size,
+            shuffle=True,
+            random_state=self.random_seed,
+        )
 
-        self.load_data(self.data_folder)
-    
-    def get_data(self):
+    def get_idxs(self):
         if self.mode == "train":
-            return self.train_data
+            return self.train_idxs
         elif self.mode == "validation":
-            return self.validation_data
-
-    def is_empty_string(self, string):
-        return len(string) == 0
-    
-    def add_punctuation_to_end_of_sentence(self, string):
-        if string[-1] in ['.', '?', '!']:
-            return string
-        else:
-            return string + '.'
-
-    def load_data(self, data_folder):
+            return self.validation_idxs
+
+    def get_data(self):
+        return [{
+            "question": self.tokenized_data.question(row),
+            "answer": self.tokenized_data.answer(row),
+            "summary": self.tokenized_data.summary(row),
+        } for row in self.get_idxs()]
+
+    def lengths(self):
         """
-        Load data from data_folder. Expects CSV files
-        with (at least) 3 columns:
-            1) Question
-            2) Answer
-            3) Summary
+        Returns the numbers of prompt and label tokens of the items.
         """
-        data_list = []
-        all_files = sorted(glob.glob(os.path.join(data_folder, '*.csv'))) # Sort to maintain order
-        for filename in all_files:
-            with open(filename ,'r') as csv_file:
-                next(csv_file, None) # Skip header line (or return None is file empty)
-                csv_reader = csv.reader(csv_file)
-                for row in csv_reader:
-                    # Exclude if no question, answer, or summary
-                    if (self.is_empty_string(row[0]) or
-                        self.is_empty_string(row[1]) or
-                        self.is_empty_string(row[2])):
-                        continue
-                    data_list.append({
-                        "question": row[0].strip(),
-                        "answer": row[1].strip(),
-                        "summary": self.add_punctuation_to_end_of_sentence(row[2].strip()), # Add punctuation if needed
-                    })
-        self.train_data, self.validation_data = train_test_split(
-            data_list,
-            test_size=self.test_size,
-            shuffle=True,
-            random_state=self.random_seed,
-        )
+        idxs = self.get_idxs()
+        return (np.diff(self.tokenized_data.arrays["prompt_offsets"])[idxs],
+                np.diff(self.tokenized_data.arrays["label_offsets"])[idxs])
+
+    def pad(self, ids):
+        """
+        Returns input_ids and attention_mask (1, input_max_length) of ids padded to
+        input_max_length, like the tokenizer with padding="max_length".
+        """
+        length = max(len(ids), self.input_max_length) if self.pad_to_max_length else len(ids)
+        input_ids = torch.full((1, length), self.tokenizer.pad_token_id, dtype=torch.long)
+        input_ids[0, :len(ids)] = torch.from_numpy(ids.astype(np.int64))
+        attention_mask = torch.zeros(input_ids.shape, dtype=torch.long)
+        attention_mask[0, :len(ids)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
 
     def __len__(self):
-        return len(self.get_data())
+        return len(self.get_idxs())
 
     def __getitem__(self, idx):
-        data = self.get_data()[idx]
-        prompt = build_prompt(data["question"], data["answer"])
-        label = data["summary"]
-        prompt_data = self.tokenizer(
-            prompt,
-            padding="max_length",
-            max_length=self.input_max_length,
-            return_tensors='pt')
-        label_data = self.tokenizer(
-            label,
-            padding="max_length",
-            max_length=self.input_max_length,
-            return_tensors='pt')
+        row = self.get_idxs()[idx]
+        question = self.tokenized_data.question(row)
+        answer = self.tokenized_data.answer(row)
+        label = self.tokenized_data.summary(row)
         return {
-            "question": data["question"],
-            "answer": data["answer"],
-            "prompt": prompt,
+            "question": question,
+            "answer": answer,
+            "prompt": build_prompt(question, answer),
             "label": label,
-            "prompt_data": prompt_data,
-            "label_data": label_data,
+            "prompt_data": self.pad(self.tokenized_data.prompt_ids(row)),
+            "label_data": self.pad(self.tokenized_data.label_ids(row)),
         }
 
 
@@ -116,50 +127,150 @@ if __name__ == "__main__":
     parser.add_argument("--model", type=str, default="t5-small")
     parser.add_argument("--input_max_length", type=int, default=128)
     parser.add_argument("--test_size", type=float, default=0.1)
-    parser.add_argument("--optimizer", type=str, default="Adam")
+    parser.add_argument("--tokenized_data_dir", type=str, default=None,
+                        help="Cache of the tokenized Q&A data (default: <qa_data>/tokenized)")
+    parser.add_argument("--pad_to_max_length", action='store_true', default=False,
+                        help="Pad every prompt and label to input_max_length, instead of to the longest in the batch")
+    parser.add_argument("--length_buckets", action='store_true', default=False,
+                        help="Batch training items of similar length together")
+    parser.add_argument("--max_batch_tokens", type=int, default=None,
+                        help="Pack length-bucketed batches with up to this many prompt and label tokens (with padding)")
+    parser.add_argument("--validation_workers", type=int, default=1,
+                        help="Processes that score the validation ROUGE")
+    parser.add_argument("--async_validation", action='store_true', default=False,
+                        help="Validate each epoch's checkpoint in a separate process (on the CPU) while training continues")
+    parser.add_argument("--optimizer", type=str, default=None, choices=["Adam", "AdamW", "Adafactor"],
+                        help="Default: Adafactor for models with {}+ parameters (e.g. t5-large), else Adam".format(
+                            ADAFACTOR_MIN_PARAMETERS))
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=1,
+                        help="Batches whose gradients are accumulated per optimizer step (effective batch size = batch_size * steps)")
+    parser.add_argument("--gradient_checkpointing", action='store_true', default=False,
+                        help="Recompute activations in the backward pass instead of storing them")
+    parser.add_argument("--bf16", action='store_true', default=False,
+                        help="Run the forward pass with bfloat16 autocast")
+    parser.add_argument("--checkpoint_format", type=str, default="pt", choices=CHECKPOINT_FORMATS)
+    parser.add_argument("--checkpoint_dtype", type=str, default=None, choices=["float16", "bfloat16"],
+                        help="Save the weights in this dtype")
+    parser.add_argument("--dist_backend", type=str, default="gloo",
+                        help="torch.distributed backend when launched with torchrun")
     args = parser.parse_args()
 
-    print("Arguments: {}".format(args))
+    # Distributed data-parallel training when launched with torchrun, e.g. 4 processes on one machine:
+    #     torchrun --nproc_per_node 4 train_qa_summarizer.py --qa_data ../qa_data --use_cpu
+    # Every process trains on its share of each epoch with batch_size items per batch.
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    distributed = world_size > 1
+    rank = 0
+    if distributed:
+        dist.init_process_group(args.dist_backend)
+        rank = dist.get_rank()
+    is_main_process = rank == 0
+
+    if is_main_process:
+        print("Arguments: {}".format(args))
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if args.use_cpu:
-        device = 'cpu'
-    print("Using device: {}".format(device))
+        device = torch.device("cpu")
+    elif distributed and torch.cuda.is_available():
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+    print("Using device: {} (process {} of {})".format(device, rank + 1, world_size))
+
+    # The main process builds the tokenized data cache while the others wait for it
+    if distributed and not is_main_process:
+        dist.barrier()
 
     train_dataset = QuestionAnswerSummaryDataset(
         mode="train",
         data_folder=args.qa_data,
         input_max_length=args.input_max_length,
-        test_size=args.test_size)
+        test_size=args.test_size,
+        tokenized_data_dir=args.tokenized_data_dir,
+        pad_to_max_length=False)
+    if distributed and is_main_process:
+        dist.barrier()
 
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True)
+    # Batches are padded to their longest prompt and label (pad labels are ignored by the loss)
+    collate_fn = functools.partial(
+        collate_qa_batch, pad_token_id=train_dataset.tokenizer.pad_token_id,
+        pad_to_length=args.input_max_length if args.pad_to_max_length else None)
+    prompt_lengths, label_lengths = train_dataset.lengths()
+    train_sampler = None
+    if args.length_buckets or args.max_batch_tokens:
+        train_sampler = LengthBucketBatchSampler(
+            prompt_lengths + label_lengths, args.batch_size, max_tokens=args.max_batch_tokens,
+            num_replicas=world_size, rank=rank)
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=train_sampler,
+            collate_fn=collate_fn)
+    elif distributed:
+        train_sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=True)
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            sampler=train_sampler,
+            collate_fn=collate_fn)
+    else:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            shuffle=True,
+            collate_fn=collate_fn)
+    # Share of training tokens that are padding when every item is padded to input_max_length
+    max_length_padding_fraction = 1 - (prompt_lengths.sum() + label_lengths.sum()) / (
+        np.maximum(prompt_lengths, args.input_max_length).sum() +
+        np.maximum(label_lengths, args.input_max_length).sum())
 
     validation_dataset = QuestionAnswerSummaryDataset(
         mode="validation",
         data_folder=args.qa_data,
         input_max_length=args.input_max_length,
-        test_size=args.test_size)
+        test_size=args.test_size,
+        tokenized_data_dir=args.tokenized_data_dir,
+        pad_to_max_length=False)
 
+    # Validated in parts by every process, except for async_validation (by the main process only)
+    validation_sampler = None
+    if distributed and not args.async_validation:
+        # Every world_size-th item, so each item is validated once (a DistributedSampler
+        # repeats items to give every process as many)
+        validation_sampler = list(range(rank, len(validation_dataset), world_size))
     validation_dataloader = torch.utils.data.DataLoader(
         validation_dataset,
-        batch_size=args.batch_size)
+        batch_size=args.batch_size,
+        sampler=validation_sampler,
+        collate_fn=collate_fn)
 
     # Print data stats
-    print("{} items in train dataset".format(len(train_dataset)))
-    print("{} items in validation dataset".format(len(validation_dataset)))
+    if is_main_process:
+        print("{} items in train dataset".format(len(train_dataset)))
+        print("{} items in validation dataset".format(len(validation_dataset)))
 
     # Define the model
-    model = initialize_t5_model(args.model)
-    model = model.to(device)
+    # The pretrained weights aren't loaded when they are replaced by a checkpoint
+    model = initialize_t5_model(args.model, pretrained=args.load_model is None)
 
     # Load model
     if args.load_model:
         load_model(model, args.load_model, args.checkpoints_dir)
+    model = model.to(device)
+    # Enabled before wrapping the model for DDP, which registers its gradient hooks on the
+    # model as it is. Non-reentrant checkpointing works with DDP (and no_sync) and with
+    # inputs that don't require gradients.
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    # The model trained in the loop (the wrapper averages the gradients of the processes)
+    train_model = model
+    if distributed:
+        train_model = DistributedDataParallel(model, device_ids=[device] if device.type == "cuda" else None)
 
     # Define optimizer
+    if args.optimizer is None:
+        num_parameters = sum(parameter.numel() for parameter in model.parameters())
+        args.optimizer = "Adafactor" if num_parameters >= ADAFACTOR_MIN_PARAMETERS else "Adam"
+        if is_main_process:
+            print("Using optimizer {} ({} parameters)".format(args.optimizer, num_parameters))
     if args.optimizer == "Adam":
         optimizer = torch.optim.Adam(model.parameters())
     elif args.optimizer == "AdamW":
@@ -169,58 +280,73 @@ if __name__ == "__main__":
     else:
         raise ValueError("Invalid optimizer")
 
-    # Define ROUGE Scorer
-    scorer = rouge_scorer.RougeScorer(['rouge1'])
+    # Summarizer used for validation (shares the model being trained)
+    summarizer = Summarizer(model, tokenizer=train_dataset.tokenizer, device=device)
+    # With async_validation, each epoch is saved to this checkpoint and validated by validation_process
+    validation_model_name = "{}_validation".format(args.model_name)
+    validation_process = None
+    # Scores the validation ROUGE (started once, as its processes are slow to start)
+    rouge_executor = None
+    if not args.async_validation:
+        rouge_executor = get_rouge_executor(args.validation_workers)
 
     # Train the model
     for epoch in range(args.num_epochs):
-        print("Epoch: {}".format(epoch + 1))
-
-        model.train()
-        for i, data in enumerate(train_dataloader):
-            optimizer.zero_grad()
-            data["prompt_data"]["input_ids"] = data["prompt_data"]["input_ids"].to(device)
-            data["prompt_data"]["attention_mask"] = data["prompt_data"]["attention_mask"].to(device)
-            data["label_data"]["input_ids"] = data["label_data"]["input_ids"].to(device)
-            output = model(
-                input_ids=data["prompt_data"]["input_ids"].squeeze(1),
-                attention_mask=data["prompt_data"]["attention_mask"].squeeze(1),
-                labels=data["label_data"]["input_ids"].squeeze(1),
-                return_dict=True,
-            )
-            loss = output.loss
-            loss.backward()
-            optimizer.step()
-            print("Train Loss: {}".format(round(loss.item(), 4)))
-
-        print("Running validation...")
-        model.eval()
-        with torch.no_grad():
-            total_loss = 0
-            total_batches = 0
-            total_rouge1_f1_score = 0
-            for i, data in enumerate(validation_dataloader):
-                data["prompt_data"]["input_ids"] = data["prompt_data"]["input_ids"].to(device)
-                data["prompt_data"]["attention_mask"] = data["prompt_data"]["attention_mask"].to(device)
-                data["label_data"]["input_ids"] = data["label_data"]["input_ids"].to(device)
-                output = model(
-                    input_ids=data["prompt_data"]["input_ids"].squeeze(1),
-                    attention_mask=data["prompt_data"]["attention_mask"].squeeze(1),
-                    labels=data["label_data"]["input_ids"].squeeze(1),
-                    return_dict=True,
-                )
-                total_loss += output.loss.item()
-                total_batches += 1
-
-                for idx, (prompt, label) in enumerate(zip(data["prompt"], data["label"])):
-                    pred_sentence = generate(model, prompt, max_len=args.input_max_length, device=device)
-                    print("-----\nQ: {} | A: {}".format(data["question"][idx], data["answer"][idx]))
-                    print("Summary: {}\n".format(pred_sentence))
-                    total_rouge1_f1_score += scorer.score(label, pred_sentence)['rouge1'].fmeasure
-            print("-----")
-
-            print("Validation Loss: {}".format(round(total_loss / total_batches, 4)))
-            print("Validation ROUGE-1 F1: {}".format(round(total_rouge1_f1_score / (total_batches * args.batch_size), 4)))
-
-    print("Saving model...")
-    save_model(model, args.model_name, args.checkpoints_dir)
+        if is_main_process:
+            print("Epoch: {}".format(epoch + 1))
+
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+        start_time = time.perf_counter()
+        num_tokens, num_padded_tokens = train_epoch(
+            train_model, optimizer, train_dataloader, device,
+            gradient_accumulation_steps=args.gradient_accumulation_steps, bf16=args.bf16,
+            distributed=distributed, verbose=is_main_process)
+        train_time = time.perf_counter() - start_time
+        if distributed:
+            # Tokens of all processes, in the time of the slowest one
+            totals = torch.tensor([num_tokens, num_padded_tokens, train_time], dtype=torch.float64)
+            dist.all_reduce(totals[:2])
+            dist.all_reduce(totals[2:], op=dist.ReduceOp.MAX)
+            num_tokens, num_padded_tokens, train_time = int(totals[0]), int(totals[1]), totals[2].item()
+        if is_main_process:
+            print("Trained on {} tokens in {:.2f} s: {:.1f} tokens/s".format(
+                num_tokens, train_time, num_tokens / train_time))
+            print("Padding: {:.1%} of batch tokens ({:.1%} when padding to input_max_length)".format(
+                1 - num_tokens / max(num_padded_tokens, 1), max_length_padding_fraction))
+            print("Peak RSS: {:.0f} MB".format(get_peak_rss_mb()))
+
+        if args.async_validation and is_main_process:
+            # Wait for the previous epoch's validation, which reads the checkpoint
+            start_time = time.perf_counter()
+            if validation_process is not None:
+                validation_process.join()
+            save_model(model, validation_model_name, args.checkpoints_dir, args.checkpoint_format)
+            validation_process = start_validation_process(
+                args.model, validation_model_name, args.checkpoints_dir, args.qa_data, epoch + 1,
+                input_max_length=args.input_max_length, test_size=args.test_size,
+                tokenized_data_dir=args.tokenized_data_dir, batch_size=args.batch_size,
+                num_workers=args.validation_workers)
+            print("Started validation in process {} ({:.2f} s of training time)".format(
+                validation_process.pid, time.perf_counter() - start_time))
+        elif not args.async_validation:
+            if is_main_process:
+                print("Running validation...")
+            results = validate(model, summarizer, validation_dataloader, max_len=args.input_max_length,
+                               batch_size=args.batch_size, executor=rouge_executor,
+                               verbose=is_main_process, world_size=world_size)
+            if is_main_process:
+                print_validation_results(results, epoch + 1)
+
+    if validation_process is not None:
+        validation_process.join()
+    if rouge_executor is not None:
+        rouge_executor.shutdown()
+
+    # Only the main process saves the model (the processes have the same weights)
+    if is_main_process:
+        print("Saving model...")
+        save_model(model, args.model_name, args.checkpoints_dir, args.checkpoint_format,
+                   getattr(torch, args.checkpoint_dtype) if args.checkpoint_dtype else None)
+    if distributed:
+        dist.destroy_process_group()
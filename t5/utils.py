@@ -1,6 +1,26 @@
 import os
+import threading
+from functools import lru_cache
 import torch
-from transformers import T5ForConditionalGeneration, T5Tokenizer
+from safetensors.torch import load_file, save_file
+from transformers import T5Config, T5ForConditionalGeneration, T5Tokenizer
+
+from summary_cache import generate_with_cache, get_file_hash, get_summary_cache_key
+
+
+# Decoding parameters passed to model.generate
+DEFAULT_DECODING_CONFIG = {
+    "do_sample": True,
+    "top_k": 120,
+    "top_p": 0.7,
+    "early_stopping": True,
+    "num_return_sequences": 1,
+}
+
+# Greedy decoding, so the same prompt always gets the same summary
+DETERMINISTIC_DECODING_CONFIG = {
+    "do_sample": False,
+}
 
 
 def build_prompt(question, answer):
@@ -10,34 +30,210 @@ def build_prompt(question, answer):
     return prompt
 
 
-def generate(model, input_, max_len=128, device='cpu'):
-    tokenizer = T5Tokenizer.from_pretrained('t5-base')
+@lru_cache(maxsize=None)
+def get_tokenizer(tokenizer_type='t5-base'):
+    """
+    Returns the T5 tokenizer, loading it only the first time.
+    """
+    return T5Tokenizer.from_pretrained(tokenizer_type)
+
+
+def get_candidate_decoding_config(decoding_config, num_candidates):
+    """
+    Returns decoding_config changed to return num_candidates sequences per input:
+    sampled ones, or with greedy decoding, the num_candidates best beams.
+    The encoder runs once per input either way.
+    """
+    decoding_config = dict(decoding_config)
+    decoding_config["num_return_sequences"] = num_candidates
+    if not decoding_config.get("do_sample", False):
+        decoding_config["num_beams"] = max(decoding_config.get("num_beams", 1), num_candidates)
+    return decoding_config
+
+
+def decode_output(tokenizer, output_ids):
+    """
+    Decode a generated sequence: drop the decoder start <pad>, and stop at
+    the first </s> (batched outputs are padded after it).
+    """
+    output_ids = output_ids.tolist()[1:]
+    if tokenizer.eos_token_id in output_ids:
+        output_ids = output_ids[:output_ids.index(tokenizer.eos_token_id)]
+    return tokenizer.decode(output_ids)
+
+
+def generate(model, input_, max_len=128, device='cpu', tokenizer=None, decoding_config=DEFAULT_DECODING_CONFIG):
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
     input_ids = tokenizer(input_, return_tensors='pt').input_ids
     input_ids = input_ids.to(device)
     beam_outputs = model.generate(
         input_ids=input_ids,
-        do_sample=True,
         max_length=max_len,
-        top_k=120,
-        top_p=0.7,
-        early_stopping=True,
-        num_return_sequences=1
+        **decoding_config
     )
-    # Crop out <pad> and </s> (first and last token)
-    final_output = beam_outputs[0][1:-1]
-    sentence = tokenizer.decode(final_output)
-    return sentence
+    num_return_sequences = decoding_config.get("num_return_sequences", 1)
+    if num_return_sequences > 1:
+        return [decode_output(tokenizer, output_ids) for output_ids in beam_outputs]
+    return decode_output(tokenizer, beam_outputs[0])
+
+
+def generate_batch(model, inputs, max_len=128, device='cpu', tokenizer=None,
+                   decoding_config=DEFAULT_DECODING_CONFIG, batch_size=16):
+    """
+    Generate an output for every input, batch_size inputs at a time.
+    Inputs are sorted by length so each padded batch has inputs of similar length,
+    and the outputs are returned in the order of inputs.
+    With num_return_sequences > 1 in decoding_config, the output of each input is
+    the list of its candidates.
+    """
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+    input_lengths = [len(input_ids) for input_ids in tokenizer(inputs).input_ids]
+    order = sorted(range(len(inputs)), key=input_lengths.__getitem__)
+    outputs = [None] * len(inputs)
+    for batch_start in range(0, len(order), batch_size):
+        batch_idxs = order[batch_start:batch_start + batch_size]
+        input_data = tokenizer([inputs[idx] for idx in batch_idxs], padding=True, return_tensors='pt')
+        beam_outputs = model.generate(
+            input_ids=input_data.input_ids.to(device),
+            attention_mask=input_data.attention_mask.to(device),
+            max_length=max_len,
+            **decoding_config
+        )
+        num_return_sequences = decoding_config.get("num_return_sequences", 1)
+        for batch_idx, idx in enumerate(batch_idxs):
+            candidates = [decode_output(tokenizer, output_ids) for output_ids in
+                          beam_outputs[batch_idx * num_return_sequences:(batch_idx + 1) * num_return_sequences]]
+            outputs[idx] = candidates if num_return_sequences > 1 else candidates[0]
+    return outputs
+
+
+class Summarizer:
+    """
+    Summarization session that owns the model, tokenizer, device and decoding
+    config, so they are loaded once and reused for every summary.
+    Calls to generate are serialized with a lock, so a Summarizer can be
+    shared across threads.
+
+    With a SummaryCache and the hash of the model's checkpoint, outputs are cached
+    by (checkpoint hash, decoding config, max_len, prompt), and only prompts that
+    aren't in the cache are run through the model.
+
+    With num_candidates > 1, every prompt is encoded once and decoded into
+    num_candidates summaries in the same generate call, and
+    choose_summary(question, answer, candidates) picks the one returned
+    (e.g. the first that passes summary_check.check_summary).
+    """
+
+    def __init__(self, model, tokenizer=None, device='cpu', decoding_config=None,
+                 cache=None, checkpoint_hash=None, num_candidates=1, choose_summary=None):
+        self.model = model.to(device)
+        self.tokenizer = tokenizer if tokenizer is not None else get_tokenizer()
+        self.device = device
+        self.decoding_config = dict(DEFAULT_DECODING_CONFIG)
+        self.decoding_config.update(decoding_config or {})
+        if num_candidates > 1:
+            if choose_summary is None:
+                raise ValueError("Summary candidates need a choose_summary function")
+            self.decoding_config = get_candidate_decoding_config(self.decoding_config, num_candidates)
+        self.choose_summary = choose_summary
+        if cache is not None and checkpoint_hash is None:
+            raise ValueError("A summary cache needs the checkpoint_hash of the model")
+        self.cache = cache
+        self.checkpoint_hash = checkpoint_hash
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_checkpoint(cls, model_name, model_type='t5-large', checkpoints_dir='checkpoints',
+                        device='cpu', decoding_config=None, cache=None, quantize=None,
+                        num_candidates=1, choose_summary=None):
+        """
+        Load the model saved with save_model(model, model_name, checkpoints_dir).
+        quantize='int8' loads a dynamically quantized model (see load_quantized_model),
+        which only runs on the CPU.
+        """
+        model = initialize_t5_model(model_type, pretrained=False)
+        if quantize:
+            model = load_quantized_model(model, model_name, checkpoints_dir, quantize)
+            device = 'cpu'
+        else:
+            load_model(model, model_name, checkpoints_dir)
+        model.eval()
+        checkpoint_hash = None
+        if cache is not None:
+            checkpoint_hash = get_file_hash(find_checkpoint_file_path(model_name, checkpoints_dir))
+            if quantize:
+                checkpoint_hash += '-' + quantize
+        return cls(model, device=device, decoding_config=decoding_config,
+                   cache=cache, checkpoint_hash=checkpoint_hash,
+                   num_candidates=num_candidates, choose_summary=choose_summary)
 
+    def get_cache_key(self, input_, max_len):
+        return get_summary_cache_key(self.checkpoint_hash, self.decoding_config, max_len, input_)
 
-def initialize_t5_model(t5_model_type):
+    def generate(self, input_, max_len=128):
+        return self.generate_batch([input_], max_len=max_len, batch_size=1)[0]
+
+    def generate_uncached(self, inputs, max_len=128, batch_size=16):
+        """
+        Returns the output of every input (the list of its candidates with num_candidates > 1).
+        """
+        with self.lock, torch.no_grad():
+            if len(inputs) == 1:
+                return [generate(self.model, inputs[0], max_len=max_len, device=self.device,
+                                 tokenizer=self.tokenizer, decoding_config=self.decoding_config)]
+            return generate_batch(self.model, inputs, max_len=max_len, device=self.device,
+                                  tokenizer=self.tokenizer, decoding_config=self.decoding_config,
+                                  batch_size=batch_size)
+
+    def generate_batch(self, inputs, max_len=128, batch_size=16, choose_output=None):
+        """
+        Returns the output of every input. With num_candidates > 1,
+        choose_output(input_, candidates) picks the output (by default the first candidate).
+        """
+        def generate_uncached(uncached_inputs):
+            outputs = self.generate_uncached(uncached_inputs, max_len, batch_size)
+            if self.decoding_config.get("num_return_sequences", 1) > 1:
+                outputs = [choose_output(input_, candidates) if choose_output else candidates[0]
+                           for input_, candidates in zip(uncached_inputs, outputs)]
+            return outputs
+
+        return generate_with_cache(
+            self.cache, lambda input_: self.get_cache_key(input_, max_len), inputs, generate_uncached)
+
+    def summarize(self, question, answer, max_len=170):
+        return self.summarize_batch([question], [answer], max_len=max_len, batch_size=1)[0]
+
+    def summarize_batch(self, questions, answers, max_len=170, batch_size=16):
+        """
+        Returns the summaries of the (question, answer) pairs, in order.
+        """
+        prompts = [build_prompt(question, answer) for question, answer in zip(questions, answers)]
+        pairs = dict(zip(prompts, zip(questions, answers)))
+        choose_output = None
+        if self.choose_summary is not None:
+            choose_output = lambda prompt, candidates: self.choose_summary(*pairs[prompt], candidates)
+        return self.generate_batch(prompts, max_len=max_len, batch_size=batch_size, choose_output=choose_output)
+
+
+def initialize_t5_model(t5_model_type, pretrained=True):
     """
     Initialize T5 model with size <t5_model_type>.
+    With pretrained=False, only the model skeleton is built, on the meta device
+    (no weights are allocated or initialized), for load_model to fill in.
     """
+    if not pretrained:
+        with torch.device('meta'):
+            return T5ForConditionalGeneration(T5Config.from_pretrained(t5_model_type))
     model = T5ForConditionalGeneration.from_pretrained(t5_model_type)
     return model
 
 
-def get_checkpoint_file_path(model_name, checkpoints_dir):
+CHECKPOINT_FORMATS = ['pt', 'safetensors']
+
+
+def get_checkpoint_file_path(model_name, checkpoints_dir, checkpoint_format='pt'):
     """
     Returns the full path where model should be saved.
     E.g. /home/kevin/scribe/checkpoints/model-5.pt
@@ -46,26 +242,120 @@ def get_checkpoint_file_path(model_name, checkpoints_dir):
     """
     script_dir = os.path.dirname(os.path.abspath(__file__))
     checkpoints_dir_full = os.path.join(script_dir, checkpoints_dir)
-    model_file_name = model_name + '.pt'
+    model_file_name = model_name + '.' + checkpoint_format
     checkpoint_file_path = os.path.join(checkpoints_dir_full, model_file_name)
     return checkpoint_file_path
 
 
-def save_model(model, model_name, checkpoints_dir):
+def find_checkpoint_file_path(model_name, checkpoints_dir):
+    """
+    Returns the path of the saved checkpoint model_name, in whichever format it was saved.
+    """
+    for checkpoint_format in CHECKPOINT_FORMATS:
+        checkpoint_file_path = get_checkpoint_file_path(model_name, checkpoints_dir, checkpoint_format)
+        if os.path.exists(checkpoint_file_path):
+            return checkpoint_file_path
+    raise FileNotFoundError("No checkpoint {} in {}".format(model_name, checkpoints_dir))
+
+
+def get_untied_state_dict(model, dtype=None):
+    """
+    Returns the state dict of model with each tensor stored once (T5 ties the
+    embeddings and lm_head), optionally cast to dtype.
+    """
+    state_dict = {}
+    data_ptrs = set()
+    for key, tensor in model.state_dict().items():
+        if tensor.data_ptr() in data_ptrs:
+            continue
+        data_ptrs.add(tensor.data_ptr())
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        state_dict[key] = tensor.contiguous()
+    return state_dict
+
+
+def save_model(model, model_name, checkpoints_dir, checkpoint_format='pt', dtype=None):
     """
-    Saves model with name <model>.pt in checkpoints_dir.
+    Saves model with name <model>.<checkpoint_format> in checkpoints_dir.
     Creates checkpoints_dir if it doesn't exist already.
+    'safetensors' checkpoints store tied weights once and can be saved with a
+    smaller dtype (e.g. torch.float16). A checkpoint with the same name in the
+    other format is removed, so load_model can't load a stale one.
     """
-    checkpoint_file_path = get_checkpoint_file_path(model_name, checkpoints_dir)
+    if checkpoint_format not in CHECKPOINT_FORMATS:
+        raise ValueError("Invalid checkpoint format: {}".format(checkpoint_format))
+    checkpoint_file_path = get_checkpoint_file_path(model_name, checkpoints_dir, checkpoint_format)
     checkpoints_dir_full = os.path.dirname(checkpoint_file_path)
     os.makedirs(checkpoints_dir_full, exist_ok=True)
-    torch.save(model.state_dict(), checkpoint_file_path)
+    if checkpoint_format == 'safetensors':
+        save_file(get_untied_state_dict(model, dtype), checkpoint_file_path)
+    elif dtype is not None:
+        torch.save(get_untied_state_dict(model, dtype), checkpoint_file_path)
+    else:
+        torch.save(model.state_dict(), checkpoint_file_path)
+    for other_format in CHECKPOINT_FORMATS:
+        other_file_path = get_checkpoint_file_path(model_name, checkpoints_dir, other_format)
+        if other_format != checkpoint_format and os.path.exists(other_file_path):
+            os.remove(other_file_path)
 
 
 def load_model(model, model_name, checkpoints_dir):
-    checkpoint_file_path = get_checkpoint_file_path(model_name, checkpoints_dir)
-    state_dict = torch.load(checkpoint_file_path)
-    model.load_state_dict(state_dict)
+    """
+    Loads the weights of checkpoint model_name into model, which can be a skeleton
+    from initialize_t5_model(pretrained=False). The checkpoint is memory-mapped,
+    and its tensors become the model's weights when they already have the model's
+    dtype, so the weights are read once and not copied.
+    """
+    checkpoint_file_path = find_checkpoint_file_path(model_name, checkpoints_dir)
+    if checkpoint_file_path.endswith('.safetensors'):
+        state_dict = load_file(checkpoint_file_path)
+    else:
+        state_dict = torch.load(checkpoint_file_path, map_location='cpu', mmap=True)
+    model_state_dict = model.state_dict()
+    for key, tensor in state_dict.items():
+        if key in model_state_dict and tensor.dtype != model_state_dict[key].dtype:
+            state_dict[key] = tensor.to(model_state_dict[key].dtype)
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    tied_keys = set(getattr(model, '_tied_weights_keys', None) or [])
+    missing_keys = [key for key in missing_keys if key not in tied_keys]
+    if missing_keys or unexpected_keys:
+        raise RuntimeError("Checkpoint {} doesn't match the model. Missing keys: {}. Unexpected keys: {}".format(
+            checkpoint_file_path, missing_keys, unexpected_keys))
+
+
+def quantize_model(model, quantize='int8'):
+    """
+    Dynamically quantize the Linear layers of model (weights stored as int8,
+    activations quantized on the fly). For CPU inference only.
+    """
+    if quantize != 'int8':
+        raise ValueError("Invalid quantization: {}".format(quantize))
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized_model(model, model_name, checkpoints_dir, quantize='int8'):
+    """
+    Returns model with the weights of checkpoint model_name, quantized.
+    The quantized weights are saved next to the checkpoint as <model_name>-<quantize>.pt
+    and reused while they are newer than the checkpoint.
+    """
+    checkpoint_file_path = find_checkpoint_file_path(model_name, checkpoints_dir)
+    quantized_file_path = get_checkpoint_file_path(model_name + '-' + quantize, checkpoints_dir)
+    if (os.path.exists(quantized_file_path) and
+        os.path.getmtime(quantized_file_path) >= os.path.getmtime(checkpoint_file_path)):
+        if any(param.is_meta for param in model.parameters()):
+            model = model.to_empty(device='cpu') # Weights are overwritten by the load below
+            model.tie_weights()
+        model = quantize_model(model, quantize)
+        model.load_state_dict(torch.load(quantized_file_path, map_location='cpu'))
+        return model
+    load_model(model, model_name, checkpoints_dir)
+    model = quantize_model(model, quantize)
+    torch.save(model.state_dict(), quantized_file_path + '.tmp')
+    os.replace(quantized_file_path + '.tmp', quantized_file_path) # So an interrupted save isn't reused
+    return model
 
 
 def num_params_transformer(
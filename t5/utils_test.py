@@ -0,0 +1,125 @@
+# To run: python -m pytest t5/utils_test.py
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import tokenizers
+import torch
+import transformers
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__))) # Import current folder to sys.path
+from utils import *
+
+
+WORDS = ["summarize:", "<question>", "<answer>", "Do", "you", "smoke?", "No", "Yes", "Any", "pain?",
+         "allergies?", "Patient", "has", "does", "not", "smoke.", "chest", "pain."]
+
+
+def get_word_tokenizer():
+    """
+    Tokenizer with one token per word, and </s> (1) at the end, like the T5 tokenizer.
+    """
+    vocab = {"<pad>": 0, "</s>": 1, "<unk>": 2}
+    vocab.update({word: idx + 3 for idx, word in enumerate(WORDS)})
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.WhitespaceSplit()
+    tokenizer.post_processor = tokenizers.processors.TemplateProcessing(
+        single="$A </s>", special_tokens=[("</s>", 1)])
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>", unk_token="<unk>")
+
+
+def get_random_model(vocab_size, seed=0):
+    """
+    Small T5 model with random weights, large enough that greedy decoding doesn't
+    just repeat one token. Without dropout, so training steps are deterministic.
+    """
+    torch.manual_seed(seed)
+    model = T5ForConditionalGeneration(T5Config(
+        vocab_size=vocab_size, d_model=16, d_ff=32, d_kv=8, num_layers=2, num_heads=2, dropout_rate=0.0,
+        decoder_start_token_id=0, eos_token_id=1, pad_token_id=0)).eval()
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.normal_(std=0.3)
+    return model
+
+
+def test_summarizer_same_as_generate():
+    tokenizer = get_word_tokenizer()
+    model = get_random_model(len(tokenizer))
+    summarizer = Summarizer(model, tokenizer=tokenizer, decoding_config=DETERMINISTIC_DECODING_CONFIG)
+    summary = summarizer.summarize("Any pain?", "Yes chest pain.", max_len=12)
+    assert summary == generate(model, build_prompt("Any pain?", "Yes chest pain."), max_len=12,
+                               tokenizer=tokenizer, decoding_config=DETERMINISTIC_DECODING_CONFIG)
+    assert summarizer.summarize("Any pain?", "Yes chest pain.", max_len=12) == summary
+
+    # The session can be shared across threads
+    with ThreadPoolExecutor(4) as executor:
+        summaries = list(executor.map(
+            lambda _: summarizer.summarize("Any pain?", "Yes chest pain.", max_len=12), range(8)))
+    assert summaries == [summary] * 8
+
+
+def test_summarize_batch_same_as_summarize():
+    tokenizer = get_word_tokenizer()
+    summarizer = Summarizer(get_random_model(len(tokenizer)), tokenizer=tokenizer,
+                            decoding_config=DETERMINISTIC_DECODING_CONFIG)
+    # Different lengths, so the pairs are sorted into padded batches out of order
+    questions = ["Any pain?", "Do you smoke?", "Any allergies?", "Do you smoke?", "Any pain?"]
+    answers = ["Yes chest pain.", "No", "No", "Yes Patient has chest pain.", "No chest pain."]
+    summaries = summarizer.summarize_batch(questions, answers, max_len=12, batch_size=2)
+    assert summaries == [summarizer.summarize(question, answer, max_len=12)
+                         for question, answer in zip(questions, answers)]
+    assert len(set(summaries)) > 1
+
+
+def get_logits(model):
+    with torch.no_grad():
+        return model(input_ids=torch.tensor([[6, 7, 8, 1]]), decoder_input_ids=torch.tensor([[0, 9]])).logits
+
+
+def test_load_quantized_model_reuses_until_checkpoint_changes(tmp_path):
+    config_dir = str(tmp_path / 'config')
+    checkpoints_dir = str(tmp_path / 'checkpoints')
+    model = get_random_model(32)
+    model.config.save_pretrained(config_dir)
+    save_model(model, 'model', checkpoints_dir)
+    quantized_model = load_quantized_model(initialize_t5_model(config_dir, pretrained=False), 'model', checkpoints_dir)
+    quantized_file_path = get_checkpoint_file_path('model-int8', checkpoints_dir)
+    quantized_mtime = os.path.getmtime(quantized_file_path)
+    assert torch.allclose(get_logits(quantized_model), get_logits(model), atol=0.5)
+
+    # Reused while newer than the checkpoint
+    reloaded_model = load_quantized_model(initialize_t5_model(config_dir, pretrained=False), 'model', checkpoints_dir)
+    assert os.path.getmtime(quantized_file_path) == quantized_mtime
+    assert torch.equal(get_logits(reloaded_model), get_logits(quantized_model))
+
+    # Quantized again when the checkpoint is saved again
+    os.utime(quantized_file_path, (quantized_mtime - 10, quantized_mtime - 10)) # Older than the new checkpoint
+    new_model = get_random_model(32, seed=1)
+    save_model(new_model, 'model', checkpoints_dir)
+    new_quantized_model = load_quantized_model(initialize_t5_model(config_dir, pretrained=False), 'model',
+                                               checkpoints_dir)
+    assert os.path.getmtime(quantized_file_path) >= os.path.getmtime(get_checkpoint_file_path('model', checkpoints_dir))
+    assert torch.equal(get_logits(new_quantized_model), get_logits(quantize_model(new_model)))
+    assert not torch.allclose(get_logits(new_quantized_model), get_logits(quantized_model))
+
+
+def test_save_and_load_model(tmp_path):
+    config_dir = str(tmp_path / 'config')
+    checkpoints_dir = str(tmp_path / 'checkpoints')
+    model = get_random_model(32)
+    model.config.save_pretrained(config_dir)
+    for checkpoint_format, dtype in [('pt', None), ('safetensors', None), ('safetensors', torch.float16),
+                                     ('pt', torch.float16)]:
+        save_model(model, 'model', checkpoints_dir, checkpoint_format, dtype)
+        assert find_checkpoint_file_path('model', checkpoints_dir).endswith('.' + checkpoint_format)
+        loaded_model = initialize_t5_model(config_dir, pretrained=False)
+        load_model(loaded_model, 'model', checkpoints_dir)
+        assert not any(parameter.is_meta for parameter in loaded_model.parameters())
+        # The tied lm_head is loaded from the (only) stored copy of the embeddings
+        assert loaded_model.lm_head.weight.data_ptr() == loaded_model.shared.weight.data_ptr()
+        state_dict = model.state_dict()
+        for key, tensor in loaded_model.state_dict().items():
+            expected = state_dict[key] if dtype is None else state_dict[key].to(dtype).to(tensor.dtype)
+            assert tensor.dtype == torch.float32 and torch.equal(tensor, expected), key
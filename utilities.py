@@ -1,4 +1,6 @@
 import sys
+from array import array
+from bisect import bisect_left
 from datetime import datetime
 import regex as re
 import pprint
@@ -6,7 +8,11 @@ from colr import color
 from colorama import Fore, Style
 from constants import *
 import csv
+import hashlib
+import json
+import numpy as np
 import os
+import shutil
 
 
 def capitalize(text):
@@ -60,6 +66,61 @@ def match_full_term(term, phrase):
     return False
 
 
+def compile_regex_markers(regex_markers=REGEX_MARKERS, marker_anchors=REGEX_MARKER_ANCHORS):
+    """
+    Compile every marker regex once. Returns a list of (category, compiled regex, anchor)
+    in the order of regex_markers, where anchor is None or (compiled anchor regex, max_distance)
+    (see REGEX_MARKER_ANCHORS).
+    """
+    compiled_markers = []
+    for marker_category, marker_regexes_list in regex_markers.items():
+        anchor = None
+        if marker_category in marker_anchors:
+            anchor_regex, max_distance = marker_anchors[marker_category]
+            anchor = (re.compile(anchor_regex, re.IGNORECASE), max_distance)
+        for marker_regex in marker_regexes_list:
+            compiled_markers.append((marker_category, re.compile(marker_regex, re.IGNORECASE), anchor))
+    return compiled_markers
+
+
+COMPILED_REGEX_MARKERS = compile_regex_markers()
+
+
+def find_marker_regex_matches(marker_regex, text, anchor=None):
+    """
+    Same matches as marker_regex.finditer(text, overlapped=True). With an anchor,
+    the marker is only tried at positions up to max_distance before an anchor match.
+    """
+    if anchor is None:
+        return list(marker_regex.finditer(text, overlapped=True))
+    anchor_regex, max_distance = anchor
+    start_indexes = set()
+    for anchor_match in anchor_regex.finditer(text, overlapped=True):
+        start_indexes.update(range(max(0, anchor_match.start() - max_distance), anchor_match.start() + 1))
+    matches = []
+    for start_index in sorted(start_indexes):
+        match = marker_regex.match(text, start_index)
+        if match:
+            matches.append(match)
+    return matches
+
+
+def find_regex_markers(text, compiled_markers=COMPILED_REGEX_MARKERS):
+    """
+    Find the (overlapping) matches of every marker regex in text.
+    Returns a list of (category, matches) with one entry per marker regex that matched,
+    where matches is a list of (match_text, start_index, end_index) of the first
+    capture group of each match.
+    """
+    markers = []
+    for marker_category, marker_regex, anchor in compiled_markers:
+        matches = [(match.group(1), match.start(1), match.end(1))
+                   for match in find_marker_regex_matches(marker_regex, text, anchor)]
+        if len(matches) > 0:
+            markers.append((marker_category, matches))
+    return markers
+
+
 def split_on_spaces_and_punctuation(text):
     """
     Split text on spaces and punctuation, keeping the spaces and punctuation.
@@ -69,34 +130,349 @@ def split_on_spaces_and_punctuation(text):
     return tokens
 
 
+class StringTable:
+    """
+    List of strings stored as one utf-8 byte array plus offsets, so it can be
+    saved as numpy arrays and memory-mapped without decoding every string.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self._data = memoryview(data)
+        self._offsets = memoryview(offsets)
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        return self._data[self._offsets[idx]:self._offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def tolist(self):
+        data = self._data.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 pp = pprint.PrettyPrinter(indent=4)
 def prp(data):
     pp.pprint(data)
 
 
-def string_to_list_format(text):
+class Token:
+    """
+    View of one token of a TokenList. Supports token['text'], token['index'] and
+    token['labels'] like the dicts of the original list format. The labels are a
+    tuple, as they are computed from the TokenList: add labels with TokenList.add_label.
+    """
+    __slots__ = ('token_list', 'idx')
+
+    def __init__(self, token_list, idx):
+        self.token_list = token_list
+        self.idx = idx
+
+    def __getitem__(self, key):
+        if key == 'text':
+            return self.token_list.token_text(self.idx)
+        if key == 'index':
+            return self.token_list.starts[self.idx]
+        if key == 'labels':
+            return self.token_list.token_labels(self.idx)
+        raise KeyError(key)
+
+    def __repr__(self):
+        return repr({key: self[key] for key in ['text', 'index', 'labels']})
+
+
+class TokenSpan:
+    """
+    View of the tokens [first, end) of a TokenList (e.g. from slice_list_format).
+    """
+    __slots__ = ('token_list', 'first', 'end')
+
+    def __init__(self, token_list, first, end):
+        self.token_list = token_list
+        self.first = first
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.first
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Token index out of range")
+        return Token(self.token_list, self.first + idx)
+
+    def __iter__(self):
+        for idx in range(self.first, self.end):
+            yield Token(self.token_list, idx)
+
+    def labels(self):
+        """
+        Returns the labels on any token of the span, each label once, in the order they were added.
+        """
+        sorted_label_spans = self.token_list.sorted_label_spans()
+        num_starting_before_end = bisect_left(sorted_label_spans, self.end, key=lambda label_span: label_span[1])
+        return [label for label, _, end in sorted_label_spans[:num_starting_before_end] if self.first < end]
+
+
+def get_label_type_keys(label):
+    """
+    Returns the (type, category) keys a label is indexed under: its own
+    (type, category) and (type, None), which matches any category.
+    """
+    label_type_key = (label['type'], label.get('category'))
+    if label_type_key[1] is None:
+        return [label_type_key]
+    return [label_type_key, (label['type'], None)]
+
+
+class LabelRegistry:
+    """
+    Allocates label ids that are unique across a transcript and indexes its labels:
+        - label_spans: label_id -> list of TokenSpans the label covers
+        - type_labels: (type, category) -> list of labels, where (type, None)
+          has the labels of that type in every category
+        - label_type_bits: (type, category) -> bit, used in the type masks of
+          TokenLists (see TokenList.type_mask)
+    """
+
+    def __init__(self):
+        self.next_label_id = 0
+        self.label_spans = {}
+        self.type_labels = {}
+        self.label_type_bits = {}
+
+    def label_type_bit(self, label_type, category=None):
+        label_type_key = (label_type, category)
+        if label_type_key not in self.label_type_bits:
+            self.label_type_bits[label_type_key] = 1 << len(self.label_type_bits)
+        return self.label_type_bits[label_type_key]
+
+    def label_type_mask(self, label):
+        type_mask = 0
+        for label_type_key in get_label_type_keys(label):
+            type_mask |= self.label_type_bit(*label_type_key)
+        return type_mask
+
+    def register_label(self, label):
+        """
+        Give the label the next label id if it doesn't have one and index it by type.
+        """
+        if label.get('label_id') is None:
+            label['label_id'] = self.next_label_id
+        self.next_label_id = max(self.next_label_id, label['label_id'] + 1)
+        if label['label_id'] not in self.label_spans:
+            self.label_spans[label['label_id']] = []
+            for label_type_key in get_label_type_keys(label):
+                self.type_labels.setdefault(label_type_key, []).append(label)
+
+    def add_span(self, label, token_list, first, end):
+        self.label_spans[label['label_id']].append(TokenSpan(token_list, first, end))
+
+    def find_slice(self, label_id):
+        token_spans = self.label_spans.get(label_id, [])
+        if len(token_spans) == 1:
+            return token_spans[0]
+        return [token for token_span in token_spans for token in token_span]
+
+    def labels_of_type(self, label_type, category=None):
+        return self.type_labels.get((label_type, category), [])
+
+
+class TokenList:
+    """
+    Compact list format of a text: the text is stored once with an array of token
+    start offsets, and each label is stored once with the range of tokens it covers.
+    Span lookups use bisect, so labelling a span costs O(log n).
+
+    Labels are registered in label_registry, which gives them their label ids.
+    Turns of one transcript should share a registry (see add_list_format_to_transcript).
+
+    Indexing and iterating give Token views, so code written for the list of dicts
+    format (token['text'], token['index'], token['labels']) keeps working.
     """
-    Convert text (string) to a list of dicts, with each dict containing the keys:
+    __slots__ = ('text', 'starts', 'label_spans', '_sorted_label_spans', 'token_type_masks', 'list_type_mask',
+                 'label_registry')
+
+    def __init__(self, text, starts, label_registry=None):
+        self.text = text
+        self.starts = starts # Start offset of each token, plus len(text) at the end
+        self.label_spans = [] # List of (label, first token, end token)
+        self._sorted_label_spans = None # label_spans sorted by first token, see sorted_label_spans
+        self.token_type_masks = [0] * (len(starts) - 1) # Label type bits of each token
+        self.list_type_mask = 0 # Label type bits of all tokens
+        self.label_registry = label_registry if label_registry is not None else LabelRegistry()
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            first, end, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError("TokenList slices must have step 1")
+            return TokenSpan(self, first, max(first, end))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Token index out of range")
+        return Token(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield Token(self, idx)
+
+    def token_text(self, idx):
+        return self.text[self.starts[idx]:self.starts[idx + 1]]
+
+    def token_labels(self, idx):
+        return tuple(label for label, first, end in self.label_spans if first <= idx < end)
+
+    def token_range(self, start_index, end_index):
+        """
+        Returns (first, end) such that tokens [first, end) start in [start_index, end_index).
+        """
+        first = bisect_left(self.starts, start_index, 0, len(self))
+        end = bisect_left(self.starts, end_index, first, len(self))
+        return first, end
+
+    def add_label(self, label, start_index, end_index):
+        self.label_registry.register_label(label)
+        first, end = self.token_range(start_index, end_index)
+        if first < end:
+            self.label_spans.append((label, first, end))
+            self._sorted_label_spans = None
+            type_mask = self.label_registry.label_type_mask(label)
+            for idx in range(first, end):
+                self.token_type_masks[idx] |= type_mask
+            self.list_type_mask |= type_mask
+            self.label_registry.add_span(label, self, first, end)
+
+    def type_mask(self, first=0, end=None):
+        """
+        Returns the OR of the label type bits (see LabelRegistry.label_type_bit)
+        of the tokens [first, end).
+        """
+        if first == 0 and (end is None or end >= len(self)):
+            return self.list_type_mask
+        type_mask = 0
+        for token_type_mask in self.token_type_masks[first:end]:
+            type_mask |= token_type_mask
+        return type_mask
+
+    def contains_type(self, label_type, category=None, first=0, end=None):
+        """
+        Returns True if a label of label_type (and category, if not None) covers
+        any of the tokens [first, end).
+        """
+        label_type_bit = self.label_registry.label_type_bits.get((label_type, category), 0)
+        return (self.type_mask(first, end) & label_type_bit) != 0
+
+    def sorted_label_spans(self):
+        """
+        Returns label_spans ordered by the first token (then by the order they were
+        added), sorted once and cached until the next add_label.
+        """
+        if self._sorted_label_spans is None:
+            self._sorted_label_spans = sorted(self.label_spans, key=lambda label_span: label_span[1])
+        return self._sorted_label_spans
+
+    def labels(self):
+        """
+        Returns every label once, ordered by the first token it covers (then by the
+        order they were added), the order a scan over the tokens would find them.
+        """
+        return [label for label, _, _ in self.sorted_label_spans()]
+
+
+def list_format_labels(list_format):
+    """
+    Returns the labels in list_format. For a TokenList or TokenSpan each label is
+    returned once; for a list of token dicts, once per token.
+    """
+    if isinstance(list_format, (TokenList, TokenSpan)):
+        return list_format.labels()
+    return [label for token in list_format for label in token['labels']]
+
+
+def string_to_list_format(text, label_registry=None):
+    """
+    Convert text (string) to a TokenList, whose tokens behave like dicts with the keys:
         - text: str
         - index: int
         - labels: list of dict
-    Each dict's text is a full word, whitespace, or punctuation
+    Each token's text is a full word, whitespace, or punctuation
     """
     tokens = split_on_spaces_and_punctuation(text)
+    starts = array('l', [0] * (len(tokens) + 1))
     index = 0
-    list_format = []
-    for token in tokens:
-        list_format.append({
-            "text": token,
-            "index": index,
-            "labels": []
-        })
+    for token_idx, token in enumerate(tokens):
+        starts[token_idx] = index
         index += len(token)
-    list_format = [item for item in list_format]
-    return list_format
+    starts[len(tokens)] = index
+    return TokenList(text, starts, label_registry)
+
+
+def add_list_format_to_transcript(transcript, label_registry=None):
+    """
+    Add a list_format to every turn of the transcript. All turns share one
+    LabelRegistry, so label ids are unique across the transcript.
+    """
+    if label_registry is None:
+        label_registry = LabelRegistry()
+    for turn in transcript:
+        turn['list_format'] = string_to_list_format(turn['text'], label_registry)
+    return label_registry
+
+
+def get_label_registries(transcript):
+    """
+    Returns the distinct LabelRegistries of the TokenList turns of transcript, in turn order.
+    """
+    label_registries = []
+    for turn in transcript:
+        list_format = turn['list_format']
+        if isinstance(list_format, TokenList) and not any(
+                list_format.label_registry is label_registry for label_registry in label_registries):
+            label_registries.append(list_format.label_registry)
+    return label_registries
+
+
+def share_label_registry(transcript):
+    """
+    Returns the LabelRegistry shared by the TokenList turns of transcript, so label ids
+    are unique across the transcript. Turns made one at a time, each with its own
+    registry (string_to_list_format(turn['text'])), are moved to the registry of the
+    first turn with labels; this is only possible for turns without labels yet.
+    """
+    label_registries = get_label_registries(transcript)
+    if len(label_registries) == 0:
+        return None
+    labelled_registries = [label_registry for label_registry in label_registries if label_registry.label_spans]
+    if len(labelled_registries) > 1:
+        raise ValueError("Turns are labelled in different label registries, so their label ids can collide. "
+                         "Create the list formats with add_list_format_to_transcript")
+    shared_registry = labelled_registries[0] if labelled_registries else label_registries[0]
+    for turn in transcript:
+        if isinstance(turn['list_format'], TokenList):
+            turn['list_format'].label_registry = shared_registry
+    return shared_registry
 
 
 def list_format_to_string(list_format):
+    if isinstance(list_format, TokenList):
+        return list_format.text
     string = ""
     for item in list_format:
         string += item['text']
@@ -104,6 +480,8 @@ def list_format_to_string(list_format):
 
 
 def slice_list_format(list_format, start_index, end_index):
+    if isinstance(list_format, TokenList):
+        return TokenSpan(list_format, *list_format.token_range(start_index, end_index))
     sliced_list_format = []
     for token in list_format:
         if start_index <= token['index'] < end_index:
@@ -131,13 +509,36 @@ def list_format_to_coloured_string(list_format, colour_map=COLOUR_MAP):
 def add_label_to_items(list_format, label, start_index, end_index):
     if start_index < 0:
         raise ValueError("Start index < 0 in add_label_to_items!")
+    if isinstance(list_format, TokenList):
+        list_format.add_label(label, start_index, end_index)
+        return list_format
     for item in list_format:
         if start_index <= item['index'] < end_index:
             item['labels'].append(label)
     return list_format
 
 
+def list_format_type_mask(list_format, label_registry):
+    """
+    Returns the OR of the label_registry type bits of the labels in list_format.
+    """
+    if isinstance(list_format, TokenList) and list_format.label_registry is label_registry:
+        return list_format.type_mask()
+    if isinstance(list_format, TokenSpan) and list_format.token_list.label_registry is label_registry:
+        return list_format.token_list.type_mask(list_format.first, list_format.end)
+    type_mask = 0
+    for label in list_format_labels(list_format):
+        type_mask |= label_registry.label_type_mask(label)
+    return type_mask
+
+
 def find_list_format_slice_with_label_id(transcript, label_id):
+    label_registries = get_label_registries(transcript)
+    if len(label_registries) == 1:
+        return label_registries[0].find_slice(label_id)
+    if len(label_registries) > 1:
+        # Turns with their own registries (see share_label_registry)
+        return [token for label_registry in label_registries for token in label_registry.find_slice(label_id)]
     sliced_list_format = []
     for turn in transcript:
         for token in turn['list_format']:
@@ -148,13 +549,32 @@ def find_list_format_slice_with_label_id(transcript, label_id):
 
 
 def list_format_contains_type(list_format, label_type, category=None):
-    for token in list_format:
-        for label in token['labels']:
-            if label['type'] == label_type:
-                if (category is None) or (label['category'] == category):
-                    return True            
+    if isinstance(list_format, TokenList):
+        return list_format.contains_type(label_type, category)
+    if isinstance(list_format, TokenSpan):
+        return list_format.token_list.contains_type(label_type, category, list_format.first, list_format.end)
+    for label in list_format_labels(list_format):
+        if label['type'] == label_type:
+            if (category is None) or (label['category'] == category):
+                return True
+    return False
+
+
+def list_format_contains_descendant(list_format, hierarchy, ancestor_ids):
+    """
+    Returns True if a SNOMED_CT label in list_format has a concept that is one
+    of ancestor_ids or a descendant of one of them.
+    """
+    for label in list_format_labels(list_format):
+        if label['type'] != "SNOMED_CT":
+            continue
+        for concept_id in label.get('concept_ids', []):
+            for ancestor_id in ancestor_ids:
+                if hierarchy.is_a(concept_id, ancestor_id):
+                    return True
     return False
 
+
 def print_conf(text, confidence, newline=True):
     red_255 = min(max(0, (confidence * 510) - 255), 255)
     red_hex = hex(int(red_255)).lstrip("0x")
@@ -214,3 +634,38 @@ def analyze_qa_data(qa_data_folder):
         round(sum(answer_word_counts) / len(answer_word_counts), 2)))
     print("Average # words in Ss: {}".format(
         round(sum(summary_word_counts) / len(summary_word_counts), 2)))
+
+
+def get_directory_version(manifest):
+    """
+    Returns a short hash of manifest (a JSON-serializable dict), used to name the
+    versioned directories of publish_directory.
+    """
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def publish_directory(build_dir, target_dir, version):
+    """
+    Make the fully written build_dir available as target_dir, without a moment where
+    target_dir is missing or partially written, even if several processes publish
+    at once. build_dir is renamed to <target_dir>.<version>, and target_dir is a
+    symlink to it, swapped with one atomic rename.
+    If the same version was already published (by another process), build_dir is
+    removed and the published one is used. Older versions are kept, as readers may
+    still have their files memory-mapped.
+    """
+    versioned_dir = "{}.{}".format(target_dir, version)
+    try:
+        os.rename(build_dir, versioned_dir)
+    except OSError:
+        if not os.path.isdir(versioned_dir):
+            raise
+        shutil.rmtree(build_dir, ignore_errors=True)
+    tmp_link = "{}.link-{}".format(target_dir, os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(versioned_dir), tmp_link)
+    if os.path.isdir(target_dir) and not os.path.islink(target_dir):
+        # Directory written before versioned directories were used
+        shutil.rmtree(target_dir, ignore_errors=True)
+    os.replace(tmp_link, target_dir)